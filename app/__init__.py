@@ -2,22 +2,13 @@
 from flask import Flask
 from dotenv import load_dotenv
 from datetime import datetime
-import jdatetime 
 import os
 
 load_dotenv()
 
 from .config import Config
 from .extensions import db, login, babel
-
-def to_jalali(gregorian_date):
-    if gregorian_date is None:
-        return ""
-    try:
-        jd_date = jdatetime.date.fromgregorian(date=gregorian_date)
-        return jd_date.strftime('%Y/%m/%d')
-    except Exception:
-        return gregorian_date 
+from .jalali import to_jalali
 
 def format_currency(value):
     try:
@@ -31,6 +22,9 @@ def get_locale():
 def create_app(config_class=Config):
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_object(config_class)
+
+    from app.log import configure_logging
+    configure_logging(app)
     try:
         os.makedirs(app.instance_path)
     except OSError:
@@ -50,6 +44,12 @@ def create_app(config_class=Config):
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
+    from app.cli import register_commands
+    register_commands(app)
+
+    from app.metrics import init_metrics
+    init_metrics(app)
+
     @app.context_processor
     def inject_now():
         return {'now': datetime.utcnow()}
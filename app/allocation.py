@@ -0,0 +1,151 @@
+# app/allocation.py
+from collections import namedtuple
+from sqlalchemy import update, bindparam
+
+StockRow = namedtuple('StockRow', ['id', 'product_id', 'unit_price', 'remaining_quantity', 'unit_of_measurement'])
+
+
+class MaxSegmentTree:
+    """
+    Array-backed segment tree holding the maximum of its leaves.
+    Answers "first position whose value is >= x" in O(log n).
+    """
+
+    EMPTY = -1
+
+    def __init__(self, values):
+        size = 1
+        while size < max(len(values), 1):
+            size *= 2
+        self.size = size
+        self.tree = [self.EMPTY] * (2 * size)
+        self.tree[size:size + len(values)] = values
+        for node in range(size - 1, 0, -1):
+            self.tree[node] = max(self.tree[2 * node], self.tree[2 * node + 1])
+
+    def __getitem__(self, index):
+        return self.tree[self.size + index]
+
+    def __setitem__(self, index, value):
+        node = self.size + index
+        self.tree[node] = value
+        node //= 2
+        while node:
+            self.tree[node] = max(self.tree[2 * node], self.tree[2 * node + 1])
+            node //= 2
+
+    def first_at_least(self, value):
+        """Returns the leftmost index whose value is >= value, or None."""
+        if self.tree[1] < value:
+            return None
+        node = 1
+        while node < self.size:
+            node *= 2
+            if self.tree[node] < value:
+                node += 1
+        return node - self.size
+
+
+class StockAllocator:
+    """
+    In-memory snapshot of the items that still have stock.
+
+    Picks follow the invoice allocation rule: the highest unit_price item whose
+    remaining_quantity covers the needed quantity, preferring items that have not
+    been used yet in the current invoice. Items are sorted by price and indexed by
+    two max segment trees over remaining_quantity: one for fresh items and a
+    fallback tier for items already used in the invoice, so every pick and every
+    decrement costs O(log n). Every pick is recorded so the caller can write all
+    decrements back in a single transaction.
+    """
+
+    def __init__(self, rows):
+        self.items = sorted(rows, key=lambda row: (-row.unit_price, row.id))
+        remaining = [row.remaining_quantity for row in self.items]
+        self.fresh = MaxSegmentTree(remaining)
+        self.used = MaxSegmentTree([MaxSegmentTree.EMPTY] * len(remaining))
+        self.used_indexes = set()
+        self.allocated = {}
+
+    @classmethod
+    def from_db(cls, db, Item):
+        """Loads every item with positive remaining_quantity in one query."""
+        rows = db.session.query(
+            Item.id, Item.product_id, Item.unit_price, Item.remaining_quantity, Item.unit_of_measurement
+        ).filter(Item.remaining_quantity > 0).all()
+        return cls(StockRow(*row) for row in rows)
+
+    def __len__(self):
+        return len(self.items)
+
+    def start_invoice(self):
+        """Moves the items used by the previous invoice back to the fresh tier."""
+        for index in self.used_indexes:
+            self.fresh[index] = self.used[index]
+            self.used[index] = MaxSegmentTree.EMPTY
+        self.used_indexes.clear()
+
+    def pick(self, quantity_needed):
+        """Returns the index of the chosen item (without taking it) or None if nothing has enough stock."""
+        index = self.fresh.first_at_least(quantity_needed)
+        if index is None:
+            index = self.used.first_at_least(quantity_needed)
+        return index
+
+    def take(self, index, quantity):
+        """Decrements the snapshot and records the allocation for write-back."""
+        item = self.items[index]
+        remaining = self.remaining_of(index) - quantity
+        if index in self.used_indexes:
+            self.used[index] = remaining
+        else:
+            self.fresh[index] = MaxSegmentTree.EMPTY
+            self.used[index] = remaining
+            self.used_indexes.add(index)
+        self.allocated[item.id] = self.allocated.get(item.id, 0) + quantity
+        return item
+
+    def describe(self):
+        """Fixed-size summary of the snapshot for diagnostics (never lists the items)."""
+        fresh_max = max(self.fresh.tree[1], 0)
+        used_max = max(self.used.tree[1], 0)
+        return (f"snapshot: {len(self.items)} items, {len(self.used_indexes)} used in this invoice, "
+                f"largest remaining {fresh_max} (unused) / {used_max} (used)")
+
+    def remaining_of(self, index):
+        if index in self.used_indexes:
+            return self.used[index]
+        return self.fresh[index]
+
+
+class AllocationConflict(Exception):
+    """Another transaction took stock the snapshot still counted; the allocation must be redone."""
+
+
+def write_allocations(db, Item, allocated):
+    """
+    Applies the recorded decrements as one executemany UPDATE.
+
+    Each decrement is guarded by remaining_quantity >= quantity, so it only succeeds
+    against stock that is still there, however stale the snapshot was; the updated
+    rows stay locked until the transaction ends. Rows are updated in id order so
+    concurrent writers lock them in the same order. Raises AllocationConflict when
+    a guard fails; the caller must then roll back and allocate again.
+    Does not commit; the caller owns the transaction.
+    """
+    if not allocated:
+        return
+    table = Item.__table__
+    stmt = (
+        update(table)
+        .where(table.c.id == bindparam('b_id'))
+        .where(table.c.remaining_quantity >= bindparam('b_quantity'))
+        .values(remaining_quantity=table.c.remaining_quantity - bindparam('b_quantity'))
+    )
+    result = db.session.execute(stmt, [
+        {'b_id': item_id, 'b_quantity': quantity} for item_id, quantity in sorted(allocated.items())
+    ])
+    if result.rowcount != len(allocated):
+        raise AllocationConflict(
+            f"{len(allocated) - result.rowcount} of {len(allocated)} items no longer have the allocated stock"
+        )
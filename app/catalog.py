@@ -0,0 +1,156 @@
+# app/catalog.py
+import base64
+import json
+from datetime import date
+from sqlalchemy import and_, or_
+from app import jalali
+
+# ستون‌های قابل مرتب‌سازی؛ همه NOT NULL هستند تا مقایسه keyset ساده بماند
+ITEM_SORT_FIELDS = ('document_date', 'product_id', 'unit_price', 'quantity', 'remaining_quantity', 'id')
+ITEM_DEFAULT_SORT = 'document_date'
+ITEM_DEFAULT_DIRECTION = 'desc'
+
+# filter name -> (model attribute, match mode)
+ITEM_TEXT_FILTERS = {
+    'product_id': ('product_id', 'prefix'),
+    'description': ('product_description', 'contains'),
+    'seller': ('seller', 'prefix'),
+    'category': ('item_category', 'prefix'),
+}
+ITEM_DATE_FILTERS = ('date_from', 'date_to')
+
+
+def _escape_like(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def parse_item_filters(args):
+    """
+    Reads the manage_items filters from the query string.
+    Returns (filters, messages); filters only contains the non-empty, valid values,
+    dates already converted to Gregorian.
+    """
+    filters = {}
+    messages = []
+    for name in ITEM_TEXT_FILTERS:
+        value = (args.get(name) or '').strip()
+        if value:
+            filters[name] = value
+    for name in ITEM_DATE_FILTERS:
+        raw = (args.get(name) or '').strip()
+        if not raw:
+            continue
+        parsed = jalali.to_gregorian(raw)
+        if parsed is None:
+            messages.append(('warning', f"تاریخ '{raw}' نامعتبر است و نادیده گرفته شد. قالب صحیح: 1403/01/15"))
+        else:
+            filters[name] = parsed
+    return filters, messages
+
+
+def filter_items(query, Item, filters, date_column=None):
+    """
+    Applies the parsed filters to an Item query (or select). The date range applies
+    to Item.document_date unless another date_column is given (e.g. the exit date
+    of a usage log query joined with Item).
+    """
+    date_column = Item.document_date if date_column is None else date_column
+    for name, (field, mode) in ITEM_TEXT_FILTERS.items():
+        if name not in filters:
+            continue
+        pattern = _escape_like(filters[name])
+        pattern = f'{pattern}%' if mode == 'prefix' else f'%{pattern}%'
+        query = query.filter(getattr(Item, field).like(pattern, escape='\\'))
+    if 'date_from' in filters:
+        query = query.filter(date_column >= filters['date_from'])
+    if 'date_to' in filters:
+        query = query.filter(date_column <= filters['date_to'])
+    return query
+
+
+def encode_cursor(value, item_id):
+    """Opaque, URL-safe cursor holding the sort value and the id of a boundary row."""
+    if isinstance(value, date):
+        value = value.isoformat()
+    raw = json.dumps([value, item_id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, sort_field):
+    """Returns (value, id) or None for a malformed cursor."""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        value, item_id = json.loads(raw)
+        item_id = int(item_id)
+        if sort_field == 'document_date':
+            value = date.fromisoformat(value)
+        elif sort_field in ('quantity', 'remaining_quantity', 'id'):
+            value = int(value)
+        elif sort_field == 'unit_price':
+            value = float(value)
+        elif not isinstance(value, str):
+            return None
+        return value, item_id
+    except (ValueError, TypeError, json.JSONDecodeError):
+        return None
+
+
+def items_page(Item, filters, sort=ITEM_DEFAULT_SORT, direction=ITEM_DEFAULT_DIRECTION,
+               after=None, before=None, per_page=50):
+    """
+    Keyset pagination over the item table.
+
+    Rows are ordered by (sort column, id) so the order is total; the next page starts
+    strictly after the last row shown ('after' cursor) and the previous page ends
+    strictly before the first one ('before' cursor). Each page is a single indexed
+    range scan of per_page + 1 rows, however deep the user has paged.
+    Returns (items, next_cursor, prev_cursor).
+    """
+    if sort not in ITEM_SORT_FIELDS:
+        sort = ITEM_DEFAULT_SORT
+    descending = direction != 'asc'
+    column = getattr(Item, sort)
+
+    query = filter_items(Item.query, Item, filters)
+
+    backwards = False
+    boundary = None
+    if before:
+        boundary = decode_cursor(before, sort)
+        backwards = boundary is not None
+    if boundary is None and after:
+        boundary = decode_cursor(after, sort)
+
+    # برای صفحه قبل ترتیب برعکس خوانده و سپس وارونه می‌شود
+    scan_descending = descending != backwards
+    if boundary is not None:
+        value, item_id = boundary
+        if sort == 'id':
+            condition = Item.id < item_id if scan_descending else Item.id > item_id
+        elif scan_descending:
+            condition = or_(column < value, and_(column == value, Item.id < item_id))
+        else:
+            condition = or_(column > value, and_(column == value, Item.id > item_id))
+        query = query.filter(condition)
+
+    if scan_descending:
+        order = [column.desc()] if sort == 'id' else [column.desc(), Item.id.desc()]
+    else:
+        order = [column.asc()] if sort == 'id' else [column.asc(), Item.id.asc()]
+    rows = query.order_by(*order).limit(per_page + 1).all()
+
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    next_cursor = prev_cursor = None
+    if rows:
+        first, last = rows[0], rows[-1]
+        if backwards:
+            prev_cursor = encode_cursor(getattr(first, sort), first.id) if has_more else None
+            next_cursor = encode_cursor(getattr(last, sort), last.id)
+        else:
+            next_cursor = encode_cursor(getattr(last, sort), last.id) if has_more else None
+            prev_cursor = encode_cursor(getattr(first, sort), first.id) if boundary is not None else None
+    return rows, next_cursor, prev_cursor
@@ -0,0 +1,103 @@
+# app/cli.py
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy.exc import SQLAlchemyError
+from app.extensions import db
+from app.models import Item, Settings
+from app.migrations import MIGRATIONS, LATEST_VERSION, applied_versions, upgrade
+from app.utils import calculate_inventory_values, get_inventory_values, INVENTORY_VALUE_SETTINGS
+from app.snapshot import (SNAPSHOT_TABLES, SnapshotError, export_snapshot, import_snapshot, read_manifest,
+                          table_row_counts)
+
+
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    """Creates any missing tables and applies pending migrations (existing data is left untouched)."""
+    db.create_all()
+    upgrade(db.engine)
+    click.echo(f"Database schema is up to date (version {LATEST_VERSION}).")
+
+
+@click.command('upgrade-db')
+@click.option('--to', 'target', type=int, default=None, help='Stop at this schema version.')
+@with_appcontext
+def upgrade_db_command(target):
+    """Applies pending schema migrations in place."""
+    applied = upgrade(db.engine, target)
+    for migration in applied:
+        click.echo(f"Applied {migration.version}: {migration.name}")
+    if not applied:
+        click.echo("No pending migrations.")
+
+
+@click.command('schema-version')
+@with_appcontext
+def schema_version_command():
+    """Shows applied and pending schema migrations."""
+    done = applied_versions(db.engine)
+    for migration in MIGRATIONS:
+        state = 'applied' if migration.version in done else 'pending'
+        click.echo(f"{migration.version}: {migration.name} [{state}]")
+
+
+@click.command('reconcile-inventory')
+@with_appcontext
+def reconcile_inventory_command():
+    """Recomputes the stored inventory values from the item table and reports drift."""
+    try:
+        stored = get_inventory_values(Settings)
+        # تراکنش خواندن بسته می‌شود تا بازمحاسبه از داده‌های تازه شروع کند
+        db.session.rollback()
+        computed = calculate_inventory_values(db, Item, Settings)
+    except SQLAlchemyError as e:
+        raise click.ClickException(f"Reconcile aborted, the stored values were not changed: {e}")
+    for setting_name, old_value, new_value in zip(INVENTORY_VALUE_SETTINGS, stored, computed):
+        drift = new_value - old_value
+        click.echo(f"{setting_name}: {new_value:,.2f} (drift {drift:+,.2f})")
+
+
+@click.command('export-snapshot')
+@click.argument('folder', type=click.Path(file_okay=False))
+@click.option('--table', 'tables', multiple=True, type=click.Choice(SNAPSHOT_TABLES),
+              help='Export only this table (repeatable). Default: all snapshot tables.')
+@with_appcontext
+def export_snapshot_command(folder, tables):
+    """Writes item, item_usage_log and settings to compressed Parquet files in FOLDER."""
+    try:
+        counts = export_snapshot(db, folder, tables or SNAPSHOT_TABLES, current_app.config['SNAPSHOT_BATCH_SIZE'])
+    except SnapshotError as e:
+        raise click.ClickException(str(e))
+    for table_name, count in counts.items():
+        click.echo(f"{table_name}: {count:,} rows")
+    click.echo(f"Snapshot written to {folder}")
+
+
+@click.command('import-snapshot')
+@click.argument('folder', type=click.Path(exists=True, file_okay=False))
+@click.option('--yes', is_flag=True, help='Do not ask for confirmation.')
+@with_appcontext
+def import_snapshot_command(folder, yes):
+    """Replaces the snapshot tables with the content of FOLDER (written by export-snapshot)."""
+    try:
+        manifest = read_manifest(folder)
+        if not yes:
+            current = table_row_counts(db, [name for name in SNAPSHOT_TABLES if name in manifest.get('tables', {})])
+            for table_name, count in current.items():
+                click.echo(f"{table_name}: {count:,} rows will be replaced by {manifest['tables'][table_name]:,}")
+            click.confirm("Continue?", abort=True)
+        counts = import_snapshot(db, folder, current_app.config['SNAPSHOT_BATCH_SIZE'])
+    except SnapshotError as e:
+        raise click.ClickException(str(e))
+    for table_name, count in counts.items():
+        click.echo(f"{table_name}: {count:,} rows imported")
+
+
+def register_commands(app):
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(upgrade_db_command)
+    app.cli.add_command(schema_version_command)
+    app.cli.add_command(reconcile_inventory_command)
+    app.cli.add_command(export_snapshot_command)
+    app.cli.add_command(import_snapshot_command)
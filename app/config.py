@@ -1,11 +1,55 @@
 import os
 
+
+def engine_options(database_url):
+    """
+    Connection pool settings per process (every gunicorn worker has its own pool, so
+    workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) must stay below MySQL's max_connections).
+    pool_pre_ping and pool_recycle replace connections the server has already closed
+    ("MySQL server has gone away") instead of failing the request.
+    """
+    # SQLite (تست دستی و بنچمارک) با pool پیش‌فرض خودش کار می‌کند
+    if not database_url or database_url.startswith('sqlite'):
+        return {}
+    return {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 5)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') != '0',
+    }
+
+
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') 
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SCRIPT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
     UPLOAD_FOLDER = os.path.join(SCRIPT_DIR, 'uploads')
     OUTPUT_FILE = os.path.join(SCRIPT_DIR, "sjt.xlsm") 
     DEFAULT_START_INVOICE_NUMBER = 1901
-    ALLOWED_EXTENSIONS = {'xlsx', 'xls', 'xlsm'}
\ No newline at end of file
+    ALLOWED_EXTENSIONS = {'xlsx', 'xls', 'xlsm'}
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+    LOG_SAMPLE_FIRST = int(os.environ.get('LOG_SAMPLE_FIRST', 10))
+    LOG_SAMPLE_EVERY = int(os.environ.get('LOG_SAMPLE_EVERY', 100))
+    ITEMS_UPSERT_CHUNK_SIZE = int(os.environ.get('ITEMS_UPSERT_CHUNK_SIZE', 1000))
+    ITEMS_STREAMING_MIN_BYTES = int(os.environ.get('ITEMS_STREAMING_MIN_BYTES', 5 * 1024 * 1024))
+    ITEMS_STREAMING_CHUNK_SIZE = int(os.environ.get('ITEMS_STREAMING_CHUNK_SIZE', 5000))
+    ITEMS_MAX_ROW_MESSAGES = int(os.environ.get('ITEMS_MAX_ROW_MESSAGES', 100))
+    ITEMS_PER_PAGE = int(os.environ.get('ITEMS_PER_PAGE', 50))
+    EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 1000))
+    SNAPSHOT_BATCH_SIZE = int(os.environ.get('SNAPSHOT_BATCH_SIZE', 5000))
+    SETTINGS_REFRESH_SECONDS = float(os.environ.get('SETTINGS_REFRESH_SECONDS', 2))
+    DASHBOARD_TOP_N = int(os.environ.get('DASHBOARD_TOP_N', 10))
+    DASHBOARD_CACHE_SECONDS = float(os.environ.get('DASHBOARD_CACHE_SECONDS', 300))
+    OUTPUT_WORKERS = int(os.environ.get('OUTPUT_WORKERS', min(4, os.cpu_count() or 1)))
+    ALLOCATION_RETRIES = int(os.environ.get('ALLOCATION_RETRIES', 3))
+    INVOICE_CACHE_MAX_AGE_SECONDS = float(os.environ.get('INVOICE_CACHE_MAX_AGE_SECONDS', 7 * 24 * 3600))
+    INVOICE_CACHE_MAX_BYTES = int(os.environ.get('INVOICE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+    INVOICE_JOB_WORKERS = int(os.environ.get('INVOICE_JOB_WORKERS', 1))
+    INVOICE_JOB_POLL_SECONDS = float(os.environ.get('INVOICE_JOB_POLL_SECONDS', 5))
+    # باید از زمان پردازش طولانی‌ترین فایل بیشتر باشد
+    INVOICE_JOB_LEASE_SECONDS = float(os.environ.get('INVOICE_JOB_LEASE_SECONDS', 180))
+    # شبکه‌هایی که اجازه خواندن /metrics را دارند (با کاما جدا شوند)
+    METRICS_ALLOWED_NETWORKS = [network.strip() for network in os.environ.get('METRICS_ALLOWED_NETWORKS', '127.0.0.1/32,::1/128').split(',') if network.strip()]
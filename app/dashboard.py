@@ -0,0 +1,95 @@
+# app/dashboard.py
+import threading
+import time
+from collections import namedtuple
+from sqlalchemy import func, case
+
+DashboardStock = namedtuple('DashboardStock', ['product_id', 'product_description', 'quantity', 'remaining_quantity'])
+DashboardUsage = namedtuple('DashboardUsage', ['product_id', 'exit_date', 'invoice_number_used', 'quantity_used', 'price_at_usage'])
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _inventory_counters(db, Item):
+    row = db.session.query(
+        func.count(Item.id),
+        func.sum(case((Item.remaining_quantity > 0, 1), else_=0)),
+        func.sum(Item.quantity),
+        func.sum(Item.remaining_quantity),
+    ).one()
+    total_items, in_stock_items, total_quantity, remaining_quantity = (value or 0 for value in row)
+    return {
+        'total_items': int(total_items),
+        'in_stock_items': int(in_stock_items),
+        'out_of_stock_items': int(total_items) - int(in_stock_items),
+        'total_quantity': int(total_quantity),
+        'remaining_quantity': int(remaining_quantity),
+    }
+
+
+def _stock_slice(db, Item, descending, limit):
+    """Items with stock ordered by remaining_quantity; an index range scan on (remaining_quantity, id)."""
+    order = [Item.remaining_quantity.desc(), Item.id.desc()] if descending else [Item.remaining_quantity.asc(), Item.id.asc()]
+    rows = db.session.query(
+        Item.product_id, Item.product_description, Item.quantity, Item.remaining_quantity
+    ).filter(Item.remaining_quantity > 0).order_by(*order).limit(limit).all()
+    return [DashboardStock(*row) for row in rows]
+
+
+def _recent_usages(db, Item, ItemUsageLog, limit):
+    rows = db.session.query(
+        Item.product_id, ItemUsageLog.exit_date, ItemUsageLog.invoice_number_used,
+        ItemUsageLog.quantity_used, ItemUsageLog.price_at_usage
+    ).join(Item, Item.id == ItemUsageLog.item_id).order_by(
+        ItemUsageLog.exit_date.desc(), ItemUsageLog.id.desc()
+    ).limit(limit).all()
+    return [DashboardUsage(*row) for row in rows]
+
+
+def load_inventory_overview(db, Item, ItemUsageLog, top_n=10):
+    """Runs the dashboard queries: counters, the low-stock and top-stock slices and the recent usages."""
+    return {
+        'counters': _inventory_counters(db, Item),
+        'low_stock': _stock_slice(db, Item, descending=False, limit=top_n),
+        'top_stock': _stock_slice(db, Item, descending=True, limit=top_n),
+        'recent_usages': _recent_usages(db, Item, ItemUsageLog, limit=top_n),
+    }
+
+
+def get_dashboard_data(db, Item, ItemUsageLog, settings, top_n=10, max_age=300):
+    """
+    Returns everything the dashboard shows.
+
+    The start invoice number, the inventory values and the inventory version token
+    come from the settings service cache. The item and usage queries are cached per
+    process and reused while the version token is unchanged. Every inventory write
+    replaces the token in its own transaction (see bump_inventory_version), so other
+    processes pick up the change as soon as their settings cache refreshes.
+    max_age bounds staleness for writes made outside the application.
+    """
+    initial_value, remaining_value, used_value = settings.inventory_values()
+
+    key = (settings.inventory_version(), top_n)
+    now = time.monotonic()
+    with _cache_lock:
+        cached = _cache.get('overview')
+    if cached is None or cached[0] != key or now - cached[1] > max_age:
+        overview = load_inventory_overview(db, Item, ItemUsageLog, top_n)
+        with _cache_lock:
+            _cache['overview'] = (key, now, overview)
+    else:
+        overview = cached[2]
+
+    return dict(
+        overview,
+        start_invoice_number=settings.start_invoice_number(),
+        initial_value=initial_value,
+        remaining_value=remaining_value,
+        used_value=used_value,
+    )
+
+
+def clear_dashboard_cache():
+    with _cache_lock:
+        _cache.clear()
@@ -0,0 +1,202 @@
+# app/excel_writer.py
+import io
+import math
+import os
+import re
+import threading
+import zipfile
+import posixpath
+import numbers
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape, quoteattr
+
+MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PKG_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+
+_ILLEGAL_XML_CHARS = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+_SHEET_DATA = re.compile(r'<sheetData\b[^>]*?(?:/>|>(.*?)</sheetData>)', re.S)
+_MERGE_CELLS = re.compile(r'<mergeCells\b[^>]*?(?:/>|>.*?</mergeCells>)', re.S)
+_DIMENSION = re.compile(r'<dimension\b[^>]*/>')
+_ROOT_TAG = re.compile(r'<worksheet\b[^>]*>', re.S)
+_NS_DECLARATION = re.compile(r'xmlns(?::(\w+))?="([^"]*)"')
+_CELL_REF = re.compile(r'([A-Z]+)(\d+)')
+
+
+def column_letter(index):
+    """1 -> 'A', 27 -> 'AA'."""
+    letters = ''
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def column_index(letters):
+    """'A' -> 1, 'AA' -> 27."""
+    index = 0
+    for char in letters:
+        index = index * 26 + ord(char) - ord('A') + 1
+    return index
+
+
+def cell_xml(ref, value, style=None):
+    """Serializes one cell; strings are written inline so no sharedStrings update is needed."""
+    style_attr = f' s="{style}"' if style is not None else ''
+    if value is None or value == '':
+        return f'<c r="{ref}"{style_attr}/>' if style is not None else ''
+    if isinstance(value, bool):
+        return f'<c r="{ref}"{style_attr} t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, numbers.Number):
+        if isinstance(value, float) and not math.isfinite(value):
+            return f'<c r="{ref}"{style_attr}/>' if style is not None else ''
+        if isinstance(value, numbers.Integral) or (float(value).is_integer() and abs(value) < 1e15):
+            return f'<c r="{ref}"{style_attr}><v>{int(value)}</v></c>'
+        return f'<c r="{ref}"{style_attr}><v>{float(value)!r}</v></c>'
+    text = _ILLEGAL_XML_CHARS.sub('', str(value))
+    space = ' xml:space="preserve"' if text != text.strip() else ''
+    return f'<c r="{ref}"{style_attr} t="inlineStr"><is><t{space}>{escape(text)}</t></is></c>'
+
+
+class SjtTemplate:
+    """
+    Pre-parsed copy of the sjt.xlsm output template.
+
+    The archive is rebuilt once without the active worksheet (and without
+    calcChain.xml, which would point at cleared formulas); every output is then a
+    byte copy of that archive plus one freshly written worksheet XML. Everything
+    else in the package, including vbaProject.bin, is kept untouched.
+    Like the previous openpyxl based writer, rows from 2 downwards are cleared
+    (keeping their styles) and merged ranges are removed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with zipfile.ZipFile(path) as archive:
+            members = [(info, archive.read(info.filename)) for info in archive.infolist()]
+        contents = {info.filename: data for info, data in members}
+
+        self.sheet_path = self._active_sheet_path(contents)
+        self._parse_sheet(contents[self.sheet_path].decode('utf-8'))
+
+        skipped = {self.sheet_path, 'xl/calcChain.xml'}
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for info, data in members:
+                if info.filename in skipped:
+                    continue
+                if info.filename == '[Content_Types].xml':
+                    data = re.sub(rb'<Override[^>]*PartName="/xl/calcChain.xml"[^>]*/>', b'', data)
+                elif info.filename == 'xl/_rels/workbook.xml.rels':
+                    data = re.sub(rb'<Relationship[^>]*Target="[^"]*calcChain.xml"[^>]*/>', b'', data)
+                archive.writestr(info, data, compress_type=zipfile.ZIP_DEFLATED)
+        self.base_archive = buffer.getvalue()
+
+    @staticmethod
+    def _active_sheet_path(contents):
+        workbook = ET.fromstring(contents['xl/workbook.xml'])
+        view = workbook.find(f'{{{MAIN_NS}}}bookViews/{{{MAIN_NS}}}workbookView')
+        active_tab = int(view.get('activeTab', 0)) if view is not None else 0
+        sheets = workbook.findall(f'{{{MAIN_NS}}}sheets/{{{MAIN_NS}}}sheet')
+        relation_id = sheets[min(active_tab, len(sheets) - 1)].get(f'{{{REL_NS}}}id')
+
+        relations = ET.fromstring(contents['xl/_rels/workbook.xml.rels'])
+        for relation in relations.findall(f'{{{PKG_REL_NS}}}Relationship'):
+            if relation.get('Id') == relation_id:
+                target = relation.get('Target')
+                if target.startswith('/'):
+                    return target.lstrip('/')
+                return posixpath.normpath(posixpath.join('xl', target))
+        raise ValueError("Active worksheet not found in the template workbook.")
+
+    def _parse_sheet(self, xml):
+        match = _SHEET_DATA.search(xml)
+        if match is None:
+            raise ValueError("Template worksheet has no sheetData element.")
+        root_tag = _ROOT_TAG.search(xml).group(0)
+        declarations = dict((prefix or '', uri) for prefix, uri in _NS_DECLARATION.findall(root_tag))
+        prefixes = {uri: prefix for prefix, uri in declarations.items()}
+
+        self.head = _MERGE_CELLS.sub('', xml[:match.start()])
+        self.tail = _MERGE_CELLS.sub('', xml[match.end():])
+        self.header_row = ''
+        self.template_rows = {}
+
+        inner = match.group(1) or ''
+        namespaces = ' '.join(
+            f'xmlns:{prefix}={quoteattr(uri)}' if prefix else f'xmlns={quoteattr(uri)}'
+            for prefix, uri in declarations.items()
+        )
+        for row in ET.fromstring(f'<sheetData {namespaces}>{inner}</sheetData>'):
+            number = int(row.get('r'))
+            if number == 1:
+                self.header_row = self._row_source(inner)
+                continue
+            attributes = []
+            for name, value in row.attrib.items():
+                if name in ('r', 'spans'):
+                    continue
+                if name.startswith('{'):
+                    uri, local = name[1:].split('}')
+                    name = f'{prefixes[uri]}:{local}'
+                attributes.append(f' {name}={quoteattr(value)}')
+            styles = {}
+            for cell in row.findall(f'{{{MAIN_NS}}}c'):
+                if cell.get('s') is not None:
+                    styles[column_index(_CELL_REF.match(cell.get('r')).group(1))] = cell.get('s')
+            self.template_rows[number] = (''.join(attributes), styles)
+        self.template_max_row = max(self.template_rows, default=1)
+
+    @staticmethod
+    def _row_source(inner):
+        match = re.search(r'<row\b[^>]*\br="1"[^>]*?(?:/>|>.*?</row>)', inner, re.S)
+        return match.group(0) if match else ''
+
+    def render_rows(self, rows, start_row=2):
+        """
+        Builds the sheetData rows for the given value rows. Each row is a sequence of
+        (column_index, value) pairs.
+        """
+        parts = []
+        last_row = max(start_row + len(rows) - 1, self.template_max_row)
+        max_column = 1
+        for number in range(start_row, last_row + 1):
+            attributes, styles = self.template_rows.get(number, ('', {}))
+            cells = {column: (style, None) for column, style in styles.items()}
+            if number - start_row < len(rows):
+                for column, value in rows[number - start_row]:
+                    cells[column] = (styles.get(column), value)
+            xml = ''.join(
+                cell_xml(f'{column_letter(column)}{number}', value, style)
+                for column, (style, value) in sorted(cells.items())
+            )
+            if xml or attributes:
+                parts.append(f'<row r="{number}"{attributes}>{xml}</row>')
+            if cells:
+                max_column = max(max_column, max(cells))
+        return ''.join(parts), last_row, max_column
+
+    def write(self, rows, output_path, start_row=2):
+        body, last_row, max_column = self.render_rows(rows, start_row)
+        head = _DIMENSION.sub(f'<dimension ref="A1:{column_letter(max_column)}{last_row}"/>', self.head, count=1)
+        sheet_xml = f'{head}<sheetData>{self.header_row}{body}</sheetData>{self.tail}'
+        with open(output_path, 'wb') as output:
+            output.write(self.base_archive)
+        with zipfile.ZipFile(output_path, 'a', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(self.sheet_path, sheet_xml.encode('utf-8'))
+        return output_path
+
+
+_template_cache = {}
+_template_lock = threading.Lock()
+
+
+def get_template(path):
+    """Returns the parsed template for path, parsing it once per process (and again if the file changes)."""
+    mtime = os.path.getmtime(path)
+    with _template_lock:
+        cached = _template_cache.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, SjtTemplate(path))
+            _template_cache[path] = cached
+        return cached[1]
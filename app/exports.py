@@ -0,0 +1,175 @@
+# app/exports.py
+"""
+Streaming CSV / XLSX exports of the usage log and the item catalogue.
+
+Rows are read with yield_per (a server-side cursor on MySQL) and written chunk by
+chunk, so neither the query result nor the file is ever held in memory or on disk.
+The XLSX writer emits a minimal workbook through a zip stream that is flushed to
+the response after every chunk; cells are serialized with excel_writer.cell_xml.
+"""
+import csv
+import io
+import zipfile
+from xml.sax.saxutils import escape
+from sqlalchemy import select
+from app import jalali
+from app.catalog import filter_items
+from app.excel_writer import cell_xml, column_letter
+from app.utils import ITEMS_COLUMN_MAPPING
+
+EXPORT_FORMATS = ('csv', 'xlsx')
+EXPORT_MIMETYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+USAGE_EXPORT_HEADER = [
+    'تاریخ خروج', 'شماره فاکتور', 'شناسه کالا', 'شرح کالا', 'فروشنده', 'طبقه کالا',
+    'واحداندازه‌گیری', 'تعداد مصرف', 'مبلغ واحد', 'مبلغ کل',
+]
+# ستون‌های فایل کالاها همان ستون‌های فایل ورودی هستند تا خروجی قابل بارگذاری مجدد باشد
+ITEMS_EXPORT_HEADER = list(ITEMS_COLUMN_MAPPING) + ['موجودی باقی‌مانده']
+
+
+def usage_export_rows(db, Item, ItemUsageLog, filters, chunk_size=1000):
+    """
+    Yields usage log rows joined with their item, oldest first. The date range of
+    filters applies to the exit date, the text filters to the item.
+    """
+    stmt = select(
+        ItemUsageLog.exit_date, ItemUsageLog.invoice_number_used, Item.product_id, Item.product_description,
+        Item.seller, Item.item_category, Item.unit_of_measurement, ItemUsageLog.quantity_used,
+        ItemUsageLog.price_at_usage,
+    ).join(Item, Item.id == ItemUsageLog.item_id)
+    stmt = filter_items(stmt, Item, filters, date_column=ItemUsageLog.exit_date)
+    stmt = stmt.order_by(ItemUsageLog.exit_date, ItemUsageLog.id).execution_options(yield_per=chunk_size)
+    for exit_date, invoice_number, product_id, description, seller, category, unit, quantity, price in db.session.execute(stmt):
+        yield [
+            jalali.to_jalali(exit_date), invoice_number, product_id, description, seller, category, unit,
+            quantity, price, (quantity or 0) * (price or 0),
+        ]
+
+
+def items_export_rows(db, Item, filters, chunk_size=1000):
+    """Yields catalogue rows in the column order of the items upload file."""
+    fields = list(ITEMS_COLUMN_MAPPING.values()) + ['remaining_quantity']
+    date_index = fields.index('document_date')
+    stmt = select(*(getattr(Item, field) for field in fields))
+    stmt = filter_items(stmt, Item, filters).order_by(Item.id).execution_options(yield_per=chunk_size)
+    for row in db.session.execute(stmt):
+        row = list(row)
+        row[date_index] = jalali.to_jalali(row[date_index])
+        yield row
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def stream_csv(header, rows, chunk_size=1000):
+    """Yields the CSV as UTF-8 bytes (with a BOM so Excel detects the encoding), one chunk of rows at a time."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    yield '\ufeff'.encode('utf-8') + buffer.getvalue().encode('utf-8')
+    for batch in _batches(rows, chunk_size):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(['' if value is None else value for value in row] for row in batch)
+        yield buffer.getvalue().encode('utf-8')
+
+
+class _ZipStream:
+    """Write-only file object collecting what ZipFile writes until it is drained."""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+_XLSX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '</Types>'
+)
+_XLSX_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+_XLSX_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+    '</Relationships>'
+)
+_XLSX_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="{name}" sheetId="1" r:id="rId1"/></sheets></workbook>'
+)
+_XLSX_SHEET_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<sheetViews><sheetView workbookViewId="0" rightToLeft="1"/></sheetViews><sheetData>'
+)
+_XLSX_SHEET_TAIL = '</sheetData></worksheet>'
+
+
+def _row_xml(number, values):
+    cells = ''.join(cell_xml(f'{column_letter(column)}{number}', value) for column, value in enumerate(values, 1))
+    return f'<row r="{number}">{cells}</row>'
+
+
+def stream_xlsx(header, rows, sheet_name='Sheet1', chunk_size=1000):
+    """Yields an .xlsx workbook with a single sheet, flushing the zip stream after every chunk of rows."""
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('[Content_Types].xml', _XLSX_CONTENT_TYPES)
+        archive.writestr('_rels/.rels', _XLSX_ROOT_RELS)
+        archive.writestr('xl/_rels/workbook.xml.rels', _XLSX_WORKBOOK_RELS)
+        archive.writestr('xl/workbook.xml', _XLSX_WORKBOOK.format(name=escape(sheet_name, {'"': '&quot;'})))
+        yield stream.drain()
+
+        with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write((_XLSX_SHEET_HEAD + _row_xml(1, header)).encode('utf-8'))
+            number = 1
+            for batch in _batches(rows, chunk_size):
+                parts = []
+                for values in batch:
+                    number += 1
+                    parts.append(_row_xml(number, values))
+                sheet.write(''.join(parts).encode('utf-8'))
+                yield stream.drain()
+            sheet.write(_XLSX_SHEET_TAIL.encode('utf-8'))
+    yield stream.drain()
+
+
+def stream_export(export_format, header, rows, sheet_name='Sheet1', chunk_size=1000):
+    if export_format == 'xlsx':
+        return stream_xlsx(header, rows, sheet_name=sheet_name, chunk_size=chunk_size)
+    return stream_csv(header, rows, chunk_size=chunk_size)
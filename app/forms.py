@@ -32,6 +32,7 @@ class UploadInvoiceForm(FlaskForm):
         FileAllowed(['xlsx', 'xls', 'xlsm'], 'فقط فایل‌های Excel (xlsx, xls, xlsm) مجاز هستند.')
     ])
     submit = SubmitField('پردازش فاکتورها')
+    preview = SubmitField('پیش‌نمایش تخصیص (بدون ثبت)')
 
 # ... بقیه فرم‌ها بدون تغییر هستند و صحیح به نظر می‌رسند ...
 # (کدهای ItemForm, SettingsForm, UploadItemsFileForm را اینجا قرار دهید)
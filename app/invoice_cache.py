@@ -0,0 +1,142 @@
+# app/invoice_cache.py
+"""
+Content-addressed cache of uploaded invoice files.
+
+Files are fingerprinted by the sha256 of their bytes. Under
+UPLOAD_FOLDER/cache the parsed result of read_invoice_file (parsed/<hash>.json)
+and a copy of the generated output (outputs/<hash>.xlsm) are kept, so a preview
+followed by the real upload parses each file once and a re-uploaded file gets
+its earlier output back. The cache is only an accelerator: evict() drops
+entries by age and total size at any time. Whether a file was already
+allocated is decided by the processed_invoice_file registry in the database,
+which is never evicted.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+PARSED = 'parsed'
+OUTPUTS = 'outputs'
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """Hex sha256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _path(kind, content_hash, extension):
+    folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'cache', kind)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f'{content_hash}.{extension}')
+
+
+def _replace(source, target):
+    # ابتدا در فایل موقت نوشته و سپس جابه‌جا می‌شود تا خواننده هم‌زمان فایل نیمه‌کاره نبیند
+    temporary = f'{target}.{os.getpid()}.tmp'
+    shutil.copyfile(source, temporary)
+    os.replace(temporary, target)
+
+
+def get_parsed(content_hash, filename):
+    """
+    Returns the cached (header, required_products, messages) or None. Entries
+    parsed under another file name are ignored: their messages name that file.
+    """
+    path = _path(PARSED, content_hash, 'json')
+    try:
+        with open(path, encoding='utf-8') as handle:
+            data = json.load(handle)
+    except (OSError, ValueError):
+        return None
+    if data.get('filename') != filename:
+        return None
+    os.utime(path)
+    return (
+        data['header'],
+        [tuple(product) for product in data['products']],
+        [tuple(message) for message in data['messages']],
+    )
+
+
+def json_default(value):
+    # مقادیر numpy (مثل int64 تعداد کالا) به نوع معادل پایتون تبدیل می‌شوند
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def put_parsed(content_hash, filename, header, required_products, messages):
+    path = _path(PARSED, content_hash, 'json')
+    temporary = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(temporary, 'w', encoding='utf-8') as handle:
+            json.dump({'filename': filename, 'header': header, 'products': required_products, 'messages': messages},
+                      handle, ensure_ascii=False, default=json_default)
+        os.replace(temporary, path)
+    except (OSError, TypeError, ValueError) as e:
+        logger.warning("Could not cache parsed invoice %s: %s", content_hash, e)
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def put_output(content_hash, output_path):
+    """Keeps a copy of the output generated for a file."""
+    try:
+        _replace(output_path, _path(OUTPUTS, content_hash, 'xlsm'))
+    except OSError as e:
+        logger.warning("Could not cache output %s: %s", output_path, e)
+
+
+def copy_output(content_hash, target_path):
+    """Copies the cached output of a file to target_path; returns False if it is no longer cached."""
+    path = _path(OUTPUTS, content_hash, 'xlsm')
+    try:
+        _replace(path, target_path)
+    except OSError:
+        return False
+    os.utime(path)
+    return True
+
+
+def evict(max_age, max_bytes):
+    """
+    Deletes cache entries not used for max_age seconds, then the least recently
+    used ones until the cache is at most max_bytes. Returns the number of files removed.
+    """
+    root = os.path.join(current_app.config['UPLOAD_FOLDER'], 'cache')
+    entries = []
+    for kind in (PARSED, OUTPUTS):
+        folder = os.path.join(root, kind)
+        if not os.path.isdir(folder):
+            continue
+        for entry in os.scandir(folder):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    now = time.time()
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for mtime, size, path in entries:
+        if now - mtime <= max_age and total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    if removed:
+        logger.info("Evicted %d invoice cache files (%d bytes left)", removed, total)
+    return removed
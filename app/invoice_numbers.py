@@ -0,0 +1,130 @@
+# app/invoice_numbers.py
+"""
+Hi/lo allocation of invoice numbers.
+
+START_INVOICE_NUMBER is the "hi" counter. A batch reserves a block of numbers by
+locking that row once and advancing it by the size of the block, in a short
+transaction of its own, and the block is recorded in invoice_number_block.
+Numbers are then taken from the block ("lo") inside the transaction that commits
+each invoice, by advancing the block's next_number. Only the batch's own row is
+touched there, so parallel jobs never wait on each other and never get the same
+number. A number is used up only if its invoice commits; whatever is left in a
+block when its batch ends stays recorded as a reserved-but-unused range.
+"""
+import logging
+from collections import namedtuple
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import func, select, update
+from app.settings_service import lock_setting, replace_version_token, SETTINGS_VERSION_SETTING
+
+logger = logging.getLogger(__name__)
+
+UnusedRange = namedtuple('UnusedRange', ['first_number', 'last_number', 'job_id', 'reserved_at', 'closed_at'])
+
+
+class InvoiceNumbersExhausted(Exception):
+    pass
+
+
+class InvoiceNumberInUse(Exception):
+    """The requested start number falls inside a block that was already reserved."""
+
+    def __init__(self, highest_reserved):
+        super().__init__(f"invoice numbers up to {highest_reserved} are already reserved")
+        self.highest_reserved = highest_reserved
+
+
+def reserve_block(db, InvoiceNumberBlock, size, job_id=None):
+    """
+    Reserves `size` consecutive numbers by advancing START_INVOICE_NUMBER under a
+    row lock, records the block and commits. Returns the block.
+    """
+    default = current_app.config.get('DEFAULT_START_INVOICE_NUMBER', 1901)
+    setting = lock_setting(db.session, 'START_INVOICE_NUMBER', default)
+    value = setting.setting_value.strip()
+    first_number = int(value) if value.isdigit() else default
+    setting.setting_value = str(first_number + size)
+    replace_version_token(db.session, SETTINGS_VERSION_SETTING)
+    block = InvoiceNumberBlock(
+        first_number=first_number, last_number=first_number + size - 1, next_number=first_number, job_id=job_id
+    )
+    db.session.add(block)
+    db.session.commit()
+    logger.info("Reserved invoice numbers %d-%d (job %s)", block.first_number, block.last_number, job_id)
+    return block
+
+
+def set_start_number(db, InvoiceNumberBlock, value):
+    """
+    Moves START_INVOICE_NUMBER to value under the same row lock reserve_block
+    takes, so a batch can not reserve a block in between. Raises
+    InvoiceNumberInUse if value is not above every reserved block. Does not commit.
+    """
+    default = current_app.config.get('DEFAULT_START_INVOICE_NUMBER', 1901)
+    setting = lock_setting(db.session, 'START_INVOICE_NUMBER', default)
+    highest_reserved = db.session.execute(select(func.max(InvoiceNumberBlock.last_number))).scalar()
+    if highest_reserved is not None and value <= highest_reserved:
+        raise InvoiceNumberInUse(highest_reserved)
+    setting.setting_value = str(value)
+    replace_version_token(db.session, SETTINGS_VERSION_SETTING)
+
+
+class InvoiceNumberAllocator:
+    """
+    Hands out the numbers of one reserved block, for the single thread processing a
+    batch. take() works inside the caller's transaction, so a rolled back invoice
+    gives its number back to the block.
+    """
+
+    def __init__(self, db, InvoiceNumberBlock, size, job_id=None):
+        self.db = db
+        self.InvoiceNumberBlock = InvoiceNumberBlock
+        block = reserve_block(db, InvoiceNumberBlock, max(size, 1), job_id)
+        self.block_id = block.id
+        self.first_number = block.first_number
+        self.last_number = block.last_number
+
+    def take(self):
+        """Returns the next number of the block. Does not commit."""
+        table = self.InvoiceNumberBlock.__table__
+        updated = self.db.session.execute(
+            update(table)
+            .where(table.c.id == self.block_id, table.c.next_number <= table.c.last_number)
+            .values(next_number=table.c.next_number + 1)
+        ).rowcount
+        if not updated:
+            raise InvoiceNumbersExhausted(
+                f"invoice number block {self.first_number}-{self.last_number} is used up"
+            )
+        return self.db.session.execute(
+            select(table.c.next_number).where(table.c.id == self.block_id)
+        ).scalar() - 1
+
+    def close(self):
+        """
+        Marks the block as finished and commits. Returns the unused (first, last)
+        range or None when every number was used.
+        """
+        block = self.db.session.get(self.InvoiceNumberBlock, self.block_id)
+        block.closed_at = datetime.utcnow()
+        self.db.session.commit()
+        if block.unused:
+            logger.info("Invoice numbers %d-%d were reserved but not used", block.next_number, block.last_number)
+            return block.next_number, block.last_number
+        return None
+
+
+def unused_invoice_number_ranges(db, InvoiceNumberBlock, limit=50):
+    """The most recent reserved-but-unused ranges, newest first."""
+    blocks = (
+        InvoiceNumberBlock.query
+        .filter(InvoiceNumberBlock.next_number <= InvoiceNumberBlock.last_number)
+        .order_by(InvoiceNumberBlock.first_number.desc())
+        .limit(limit)
+        .all()
+    )
+    return [
+        UnusedRange(block.next_number, block.last_number, block.job_id, block.reserved_at, block.closed_at)
+        for block in blocks
+    ]
@@ -0,0 +1,132 @@
+# app/jalali.py
+"""
+Jalali <-> Gregorian conversion for the whole application.
+
+Conversions are table lookups instead of a jdatetime call per value. The tables
+cover the Jalali years FIRST_YEAR..LAST_YEAR: the Gregorian ordinal of every
+Jalali new year, and the packed Jalali date (y * 10000 + m * 100 + d) of every
+day in the range. They are built once, from jdatetime itself, so both directions
+agree with jdatetime exactly. Dates outside the range still convert, through
+jdatetime. The series_* functions convert a whole pandas Series, converting
+each distinct value once.
+
+Jalali strings are 'Y/m/d'; '-' and '.' are accepted as separators, and Persian
+or Arabic digits as well as Latin ones.
+"""
+import re
+from datetime import date, datetime
+from functools import lru_cache
+import jdatetime
+import numpy as np
+import pandas as pd
+
+FIRST_YEAR = 1300
+LAST_YEAR = 1500
+FORMAT = '%Y/%m/%d'
+
+_DIGITS = str.maketrans('۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩', '01234567890123456789')
+_DATE_RE = re.compile(r'^\s*(\d{1,4})\s*[/\-.]\s*(\d{1,2})\s*[/\-.]\s*(\d{1,2})\s*$')
+# روز اول هر ماه نسبت به اول سال؛ شش ماه اول ۳۱ روزه و پنج ماه بعد ۳۰ روزه هستند
+_MONTH_OFFSETS = np.array([0, 0, 31, 62, 93, 124, 155, 186, 216, 246, 276, 306, 336], dtype=np.int64)
+
+
+class _Tables:
+    def __init__(self):
+        years = range(FIRST_YEAR, LAST_YEAR + 2)
+        self.year_starts = np.array(
+            [jdatetime.date(year, 1, 1).togregorian().toordinal() for year in years], dtype=np.int64
+        )
+        self.year_lengths = np.diff(self.year_starts)
+        self.first_ordinal = int(self.year_starts[0])
+        self.last_ordinal = int(self.year_starts[-1]) - 1
+
+        packed = np.empty(self.last_ordinal - self.first_ordinal + 1, dtype=np.int64)
+        for index, year in enumerate(range(FIRST_YEAR, LAST_YEAR + 1)):
+            start = int(self.year_starts[index]) - self.first_ordinal
+            for month in range(1, 13):
+                length = month_length(self.year_lengths[index], month)
+                offset = start + int(_MONTH_OFFSETS[month])
+                packed[offset:offset + length] = year * 10000 + month * 100 + np.arange(1, length + 1)
+        self.packed = packed
+
+
+def month_length(year_length, month):
+    if month <= 6:
+        return 31
+    if month <= 11:
+        return 30
+    return 30 if year_length == 366 else 29
+
+
+@lru_cache(maxsize=1)
+def _tables():
+    return _Tables()
+
+
+def _slow_to_gregorian(year, month, day):
+    try:
+        return jdatetime.date(year, month, day).togregorian()
+    except (ValueError, OverflowError):
+        return None
+
+
+def to_gregorian(text):
+    """Parses a Jalali date string to a Gregorian date; returns None if it is not a valid date."""
+    if text is None:
+        return None
+    match = _DATE_RE.match(str(text).translate(_DIGITS))
+    if not match:
+        return None
+    year, month, day = (int(part) for part in match.groups())
+    if not (FIRST_YEAR <= year <= LAST_YEAR):
+        return _slow_to_gregorian(year, month, day)
+    tables = _tables()
+    index = year - FIRST_YEAR
+    if not (1 <= month <= 12 and 1 <= day <= month_length(tables.year_lengths[index], month)):
+        return None
+    return date.fromordinal(int(tables.year_starts[index] + _MONTH_OFFSETS[month]) + day - 1)
+
+
+def _format_packed(packed):
+    return f'{packed // 10000:04d}/{packed // 100 % 100:02d}/{packed % 100:02d}'
+
+
+def to_jalali(value, fmt=FORMAT):
+    """
+    Formats a Gregorian date (or datetime) as a Jalali string; '' for None. Strings
+    are returned unchanged, so the template filter can be applied to any value.
+    """
+    if value is None or value is pd.NaT:
+        return ''
+    if isinstance(value, str):
+        return value
+    if isinstance(value, datetime):
+        value = value.date()
+    if fmt == FORMAT:
+        tables = _tables()
+        ordinal = value.toordinal()
+        if tables.first_ordinal <= ordinal <= tables.last_ordinal:
+            return _format_packed(int(tables.packed[ordinal - tables.first_ordinal]))
+    return jdatetime.date.fromgregorian(date=value).strftime(fmt)
+
+
+def today():
+    """Today's date as a Jalali string."""
+    return to_jalali(date.today())
+
+
+def series_to_gregorian(values):
+    """
+    Converts a Series of Jalali strings to a Series of Gregorian dates (object
+    dtype, same index); missing or invalid values become None. Each distinct
+    string is converted once, so the cost follows the number of distinct dates.
+    """
+    unique = pd.unique(values.dropna())
+    converted = values.map({value: to_gregorian(value) for value in unique})
+    return converted.astype(object).where(converted.notna(), None)
+
+
+def series_to_jalali(values):
+    """Formats a Series of Gregorian dates as Jalali strings ('' for missing values)."""
+    unique = pd.unique(values.dropna())
+    return values.map({value: to_jalali(value) for value in unique}).fillna('')
@@ -0,0 +1,409 @@
+# app/jobs.py
+import json
+import os
+import shutil
+import threading
+import uuid
+import zipfile
+import logging
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import and_, func, or_, select, update
+from werkzeug.utils import secure_filename
+from app.extensions import db
+from app.models import Item, ItemUsageLog, InvoiceJob, InvoiceNumberBlock, ProcessedInvoiceFile
+from app.utils import process_excel_invoices, already_processed_message
+from app import invoice_cache
+from app.settings_service import settings_service
+from app.invoice_numbers import InvoiceNumberAllocator, InvoiceNumbersExhausted
+from app.workers import submit_output, output_result
+from app.metrics import stage_timer, INVOICE_FILES
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+class JobLeaseLost(Exception):
+    """Another runner took the job over after its lease expired."""
+
+
+def job_folder(job_id):
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], 'jobs', job_id)
+
+
+def save_uploaded_invoices(uploaded_files, folder):
+    """
+    Saves the valid uploaded invoice files into folder, keeping their upload order.
+    Returns (files, messages, rejected) where files is a list of (stored_name, filename).
+    """
+    files = []
+    messages = []
+    rejected = 0
+    for index, file in enumerate(uploaded_files):
+        if not (file and '.' in file.filename and file.filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']):
+            messages.append(('warning', f"فایل '{file.filename}' نامعتبر است یا پسوند مجاز ندارد."))
+            rejected += 1
+            continue
+        filename = secure_filename(file.filename)
+        stored_name = f"{index:04d}_{filename}"
+        try:
+            file.save(os.path.join(folder, stored_name))
+        except Exception as e:
+            messages.append(('danger', f"خطا در ذخیره فایل {filename}: {str(e)}"))
+            rejected += 1
+            continue
+        files.append((stored_name, filename))
+    return files, messages, rejected
+
+
+def create_invoice_job(uploaded_files, user_id=None):
+    """
+    Saves the uploaded invoice files under the job folder and queues an InvoiceJob.
+    Returns the committed job.
+    """
+    job_id = uuid.uuid4().hex
+    folder = job_folder(job_id)
+    os.makedirs(folder, exist_ok=True)
+    files, messages, rejected = save_uploaded_invoices(uploaded_files, folder)
+
+    job = InvoiceJob(
+        id=job_id,
+        status=JOB_QUEUED,
+        total_files=len(files),
+        rejected_files=rejected,
+        files_json=json.dumps(files, ensure_ascii=False),
+        created_by=user_id,
+    )
+    job.add_messages(messages)
+    db.session.add(job)
+    db.session.commit()
+
+    job_runner.start(current_app._get_current_object())
+    job_runner.wake()
+    return job
+
+
+def run_invoice_batch(job, lease_owner=None):
+    """
+    Processes the files of a job: allocates stock file by file, renders the
+    outputs on the output pool and packs them for download. Allocation is
+    concurrency-safe (see process_excel_invoices) and the job numbers its invoices
+    from a block reserved up front (see app.invoice_numbers), so several jobs, in
+    this or other processes, can run at the same time.
+    Files are identified by their content hash: a file that was already allocated
+    (see ProcessedInvoiceFile) is not parsed or allocated again, and its earlier
+    output is returned from app.invoice_cache or rendered again from the rows
+    stored with the registry entry. A file whose content can not be hashed is
+    reported as failed without being allocated. The number block is sized from
+    the files that will be allocated; running out of it anyway fails the job
+    (InvoiceNumbersExhausted) rather than one file.
+    Progress and messages are committed on the job after every file, together
+    with a renewal of the job's lease (see claim_next_job). A job taken over
+    after its runner died starts again from the first file: the files the dead
+    run already committed are registered under this job, so they are counted as
+    processed by it and only their outputs are produced again.
+    """
+    config = current_app.config
+    folder = job_folder(job.id)
+    template_path = os.path.join(current_app.root_path, 'sjt.xlsm')
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    if job.processed_files:
+        job.add_messages([('warning', "پردازش این دسته متوقف شده بود و از ابتدا ادامه داده می‌شود؛ فایل‌های ثبت‌شده دوباره کسر نمی‌شوند.")])
+        job.processed_files = 0
+        renew_lease(job, lease_owner)
+        db.session.commit()
+
+    digests = {}
+    unreadable = {}
+    for stored_name, _ in job.files:
+        try:
+            digests[stored_name] = invoice_cache.file_digest(os.path.join(folder, stored_name))
+        except OSError as e:
+            # بدون هش، فایل قابل ثبت نیست و در اجرای جایگزین دوباره کسر می‌شد؛ پس اصلاً پردازش نمی‌شود
+            logger.error("Could not read %s: %s", stored_name, e)
+            unreadable[stored_name] = e
+    registered = {
+        entry.content_hash: entry
+        for entry in ProcessedInvoiceFile.query.filter(ProcessedInvoiceFile.content_hash.in_(set(digests.values())))
+    } if digests else {}
+
+    pending_outputs = []
+    output_files = []
+    invoice_numbers = []
+    seen = {}
+    # فقط فایل‌هایی که واقعاً تخصیص داده می‌شوند (هش‌دار، ثبت‌نشده، بدون تکرار) شماره مصرف می‌کنند؛
+    # هر کدام حداکثر یکی، پس یک بلوک به اندازه تعداد آن‌ها کافی است
+    to_allocate = {
+        digests[stored_name] for stored_name, _ in job.files
+        if stored_name not in unreadable and digests[stored_name] not in registered
+    }
+    numbers = InvoiceNumberAllocator(db, InvoiceNumberBlock, len(to_allocate), job_id=job.id) if to_allocate else None
+
+    for stored_name, filename in job.files:
+        filepath = os.path.join(folder, stored_name)
+        content_hash = digests.get(stored_name)
+        messages = []
+        try:
+            if stored_name in unreadable:
+                INVOICE_FILES.inc(result='failed')
+                messages.append(('danger', f"فایل '{filename}' خوانده نشد و پردازش نشد: {unreadable[stored_name]}"))
+            elif content_hash in seen:
+                messages.append(('warning', f"فایل '{filename}' تکرار فایل '{seen[content_hash]}' در همین دسته است و نادیده گرفته شد."))
+            elif content_hash in registered:
+                entry = registered[content_hash]
+                if entry.job_id == job.id:
+                    # در اجرای قبلی همین دسته ثبت شده است؛ فقط خروجی آن باید تولید شود
+                    messages.append(('success', f"فایل '{filename}' در اجرای قبلی همین دسته با شماره فاکتور {entry.invoice_number} ثبت شده بود."))
+                    invoice_numbers.append(entry.invoice_number)
+                else:
+                    messages.append(already_processed_message(entry, filename))
+                output_path = os.path.join(config['UPLOAD_FOLDER'], f'sjt_output_{entry.invoice_number}_{timestamp}.xlsm')
+                if invoice_cache.copy_output(content_hash, output_path):
+                    messages.append(('info', f"خروجی قبلی فاکتور {entry.invoice_number} برای فایل '{filename}' دوباره ارائه شد."))
+                    output_files.append(output_path)
+                elif entry.output_rows:
+                    # خروجی ساخته یا نگه داشته نشده است؛ از سطرهای ثبت‌شده دوباره ساخته می‌شود
+                    messages.append(('info', f"خروجی فاکتور {entry.invoice_number} برای فایل '{filename}' از اطلاعات ثبت‌شده دوباره ساخته شد."))
+                    pending_outputs.append((filename, content_hash, submit_output(
+                        pd.DataFrame(entry.output_rows), template_path, output_path, config['OUTPUT_WORKERS']
+                    )))
+                else:
+                    messages.append(('warning', f"خروجی قبلی فاکتور {entry.invoice_number} دیگر در حافظه نگهداری نمی‌شود."))
+            else:
+                if numbers is None or content_hash not in to_allocate:
+                    raise InvoiceNumbersExhausted(f"no invoice number was reserved for '{filename}'")
+                output_df, log_entries, invoice_number, file_messages = process_excel_invoices(
+                    filepath, db, Item, ItemUsageLog, numbers, retries=config['ALLOCATION_RETRIES'],
+                    content_hash=content_hash, job_id=job.id, filename=filename,
+                )
+                messages.extend(file_messages)
+
+                if not output_df.empty:
+                    # موجودی، لاگ‌های مصرف و شماره فاکتور در process_excel_invoices در یک تراکنش ثبت شده‌اند
+                    messages.append(('success', f"فایل '{filename}' با موفقیت پردازش و موجودی کالاها به‌روز‌رسانی شد."))
+                    invoice_numbers.append(invoice_number)
+
+                    # تولید فایل خروجی به process pool سپرده می‌شود؛ فقط تخصیص موجودی ترتیبی است
+                    output_filename = f'sjt_output_{invoice_number}_{timestamp}.xlsm'
+                    output_sjt_path = os.path.join(config['UPLOAD_FOLDER'], output_filename)
+                    pending_outputs.append((filename, content_hash, submit_output(
+                        output_df, template_path, output_sjt_path, config['OUTPUT_WORKERS']
+                    )))
+            if content_hash is not None:
+                seen.setdefault(content_hash, filename)
+        except InvoiceNumbersExhausted:
+            # بلوک کوچک‌تر از نیاز رزرو شده است؛ کار متوقف می‌شود تا هیچ فاکتوری بدون شماره ثبت نشود
+            db.session.rollback()
+            raise
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Unexpected error processing %s: %s", filename, e)
+            messages.append(('danger', f"خطای غیرمنتظره در پردازش فایل '{filename}': {str(e)}"))
+
+        # فایل‌های ورودی تا پایان کار نگه داشته می‌شوند تا اجرای جایگزین بتواند آن‌ها را بخواند
+        job.processed_files += 1
+        job.add_messages(messages)
+        renew_lease(job, lease_owner)
+        db.session.commit()
+
+    messages = []
+    unused = numbers.close() if numbers is not None else None
+    if unused:
+        messages.append(('warning', f"شماره‌های فاکتور {unused[0]} تا {unused[1]} برای این دسته رزرو شدند اما استفاده نشدند."))
+    if invoice_numbers:
+        # مقادیر ارز هنگام تخصیص هر فایل به‌روز شده‌اند
+        initial_value, remaining_value, used_value = settings_service.inventory_values(fresh=True)
+        messages.append(('info', f"شماره‌های فاکتور استفاده‌شده: {', '.join(str(number) for number in invoice_numbers)}. ارز اولیه: {initial_value:,.2f}, ارز باقیمانده: {remaining_value:,.2f}, ارز مصرف‌شده: {used_value:,.2f}"))
+
+    for filename, content_hash, future in pending_outputs:
+        output_file_path, error = output_result(future)
+        if error:
+            messages.append(('warning', f"خطا در تولید فایل خروجی برای '{filename}': {error}"))
+        else:
+            invoice_cache.put_output(content_hash, output_file_path)
+            output_files.append(output_file_path)
+        renew_lease(job, lease_owner)
+        db.session.commit()
+    invoice_cache.evict(config['INVOICE_CACHE_MAX_AGE_SECONDS'], config['INVOICE_CACHE_MAX_BYTES'])
+
+    if len(output_files) > 1:
+        zip_filename = f"invoices_{timestamp}_{job.id[:8]}.zip"
+        zip_path = os.path.join(config['UPLOAD_FOLDER'], zip_filename)
+        with stage_timer('invoice', 'zip'), zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for output_file in output_files:
+                zipf.write(output_file, os.path.basename(output_file))
+                try:
+                    os.remove(output_file)
+                except OSError:
+                    logger.warning("Failed to remove temporary output file %s", output_file)
+        job.result_filename = zip_filename
+    elif output_files:
+        job.result_filename = os.path.basename(output_files[0])
+    else:
+        messages.append(('warning', "هیچ فایل خروجی تولید نشد."))
+
+    job.add_messages(messages)
+    db.session.commit()
+
+
+def run_invoice_job(job_id, lease_owner=None):
+    """Runs a claimed job to completion; lease_owner is the token returned by claim_next_job."""
+    job = db.session.get(InvoiceJob, job_id)
+    if job is None or (lease_owner is not None and job.lease_owner != lease_owner):
+        return
+    lease_owner = job.lease_owner
+    try:
+        run_invoice_batch(job, lease_owner)
+        job.status = JOB_DONE
+    except JobLeaseLost:
+        # اجراکننده دیگری کار را در دست گرفته است و وضعیت و پوشه آن را مدیریت می‌کند
+        db.session.rollback()
+        logger.warning("Invoice job %s was taken over by another runner", job_id)
+        return
+    except Exception as e:
+        logger.error("Invoice job %s failed: %s", job_id, e)
+        db.session.rollback()
+        job = db.session.get(InvoiceJob, job_id)
+        job.add_messages([('danger', f"خطای غیرمنتظره در پردازش دسته فاکتورها: {str(e)}")])
+        job.status = JOB_FAILED
+    try:
+        renew_lease(job, lease_owner)
+    except JobLeaseLost:
+        db.session.rollback()
+        logger.warning("Invoice job %s was taken over by another runner", job_id)
+        return
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+    shutil.rmtree(job_folder(job_id), ignore_errors=True)
+
+
+def _claimable(lease_seconds):
+    expired = datetime.utcnow() - timedelta(seconds=lease_seconds)
+    return or_(
+        InvoiceJob.status == JOB_QUEUED,
+        and_(InvoiceJob.status == JOB_RUNNING,
+             func.coalesce(InvoiceJob.heartbeat_at, InvoiceJob.started_at) < expired),
+    )
+
+
+def lease_expired(job, lease_seconds):
+    """True for a running job whose runner has not renewed its lease in lease_seconds (it has died)."""
+    heartbeat = job.heartbeat_at or job.started_at
+    return (job.status == JOB_RUNNING and heartbeat is not None
+            and heartbeat < datetime.utcnow() - timedelta(seconds=lease_seconds))
+
+
+def claim_next_job(lease_seconds):
+    """
+    Atomically moves the oldest queued job to running and returns (job_id,
+    lease_owner), or None. A running job whose lease has expired (its process
+    exited mid-job, e.g. a recycled gunicorn worker) is claimed the same way.
+    The conditional UPDATE makes sure only one worker (in any process) claims a
+    job; the runner then renews the lease with renew_lease while it works.
+    """
+    while True:
+        job_id = db.session.execute(
+            select(InvoiceJob.id).where(_claimable(lease_seconds)).order_by(InvoiceJob.created_at).limit(1)
+        ).scalar()
+        if job_id is None:
+            db.session.commit()
+            return None
+        now = datetime.utcnow()
+        lease_owner = uuid.uuid4().hex
+        result = db.session.execute(
+            update(InvoiceJob)
+            .where(InvoiceJob.id == job_id, _claimable(lease_seconds))
+            .values(status=JOB_RUNNING, started_at=func.coalesce(InvoiceJob.started_at, now),
+                    heartbeat_at=now, lease_owner=lease_owner)
+        )
+        db.session.commit()
+        if result.rowcount == 1:
+            return job_id, lease_owner
+
+
+def renew_lease(job, lease_owner):
+    """
+    Extends the job's lease in the current transaction. Raises JobLeaseLost if
+    another runner has claimed the job since. lease_owner is the token this
+    runner claimed the job with (job.lease_owner is reloaded after every commit
+    and would be the new owner's). Does not commit.
+    """
+    renewed = db.session.execute(
+        update(InvoiceJob)
+        .where(InvoiceJob.id == job.id, InvoiceJob.lease_owner == lease_owner)
+        .values(heartbeat_at=datetime.utcnow())
+    ).rowcount
+    if not renewed:
+        raise JobLeaseLost(f"invoice job {job.id} is no longer owned by this runner")
+
+
+class InvoiceJobRunner:
+    """
+    Local worker pool for invoice jobs. The queue lives in the invoice_job table,
+    so no external broker is needed: a dispatcher thread claims queued jobs when it
+    is woken up (or every INVOICE_JOB_POLL_SECONDS) and runs them on a thread pool
+    of INVOICE_JOB_WORKERS threads. Started lazily, so forked workers start their own.
+    Jobs of a process that exits are taken over by any runner once their lease
+    (INVOICE_JOB_LEASE_SECONDS) expires.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._active = 0
+
+    def start(self, app):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._app = app
+            self._workers = max(1, app.config['INVOICE_JOB_WORKERS'])
+            self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='invoice-job')
+            self._active = 0
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._dispatch, name='invoice-job-dispatcher', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _dispatch(self):
+        poll_seconds = self._app.config['INVOICE_JOB_POLL_SECONDS']
+        while True:
+            self._wakeup.wait(poll_seconds)
+            self._wakeup.clear()
+            try:
+                with self._app.app_context():
+                    while True:
+                        with self._lock:
+                            if self._active >= self._workers:
+                                break
+                        claimed = claim_next_job(self._app.config['INVOICE_JOB_LEASE_SECONDS'])
+                        if claimed is None:
+                            break
+                        with self._lock:
+                            self._active += 1
+                        self._executor.submit(self._run, *claimed)
+            except Exception as e:
+                logger.error("Invoice job dispatcher error: %s", e)
+
+    def _run(self, job_id, lease_owner):
+        try:
+            with self._app.app_context():
+                run_invoice_job(job_id, lease_owner)
+        except Exception as e:
+            logger.error("Invoice job %s crashed: %s", job_id, e)
+        finally:
+            with self._lock:
+                self._active -= 1
+            self._wakeup.set()
+
+
+job_runner = InvoiceJobRunner()
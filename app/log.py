@@ -0,0 +1,55 @@
+# app/log.py
+import logging
+
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s'
+
+
+class LogSampler:
+    """
+    Bounded debug logging for per-row hot paths.
+
+    Logs the first `first` messages and then every `every`-th one, counting the
+    rest; summary() reports how many were skipped. When DEBUG is disabled for the
+    logger, every call returns after a single level check, without formatting.
+    """
+
+    first = 10
+    every = 100
+
+    def __init__(self, logger, first=None, every=None):
+        self.logger = logger
+        self.enabled = logger.isEnabledFor(logging.DEBUG)
+        self.first = self.first if first is None else first
+        self.every = self.every if every is None else every
+        self.count = 0
+        self.skipped = 0
+
+    def debug(self, msg, *args):
+        if not self.enabled:
+            return
+        self.count += 1
+        if self.count <= self.first or (self.every and self.count % self.every == 0):
+            self.logger.debug(msg, *args)
+        else:
+            self.skipped += 1
+
+    def summary(self, what):
+        if self.enabled and self.skipped:
+            self.logger.debug("%d of %d %s messages were sampled out", self.skipped, self.count, what)
+
+
+def configure_logging(app):
+    """
+    Applies LOG_LEVEL (and the sampling limits) from the config. A handler is only
+    installed when the hosting server has not configured logging already.
+    """
+    level = logging.getLevelName(str(app.config['LOG_LEVEL']).upper())
+    if not isinstance(level, int):
+        level = logging.INFO
+    root = logging.getLogger()
+    if not root.handlers:
+        logging.basicConfig(format=LOG_FORMAT)
+    logging.getLogger('app').setLevel(level)
+    app.logger.setLevel(level)
+    LogSampler.first = app.config['LOG_SAMPLE_FIRST']
+    LogSampler.every = app.config['LOG_SAMPLE_EVERY']
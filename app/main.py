@@ -1,19 +1,28 @@
 # app/main.py
 import os
-from datetime import datetime
-from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app, send_from_directory
-from flask_login import login_required
+import tempfile
+from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app, send_from_directory, jsonify, Response, stream_with_context, abort
+from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
 from sqlalchemy import func
-import pandas as pd
-import zipfile
 from app.extensions import db
-from app.models import Item, ItemUsageLog, Settings
+from app.models import Item, ItemUsageLog, Settings, InvoiceJob, InvoiceNumberBlock
 from app.forms import UploadInvoiceForm, UploadItemsFileForm, ItemForm, SettingsForm
-from app.utils import process_items_excel, process_excel_invoices, generate_sjt_output_excel, generate_usage_log_excel, calculate_inventory_values
+from app.utils import (process_items_excel, generate_usage_log_excel,
+                       apply_inventory_delta, item_inventory_values, inventory_values_delta,
+                       bulk_upsert_items, iter_items_excel_chunks, ItemsFileError)
+from app.jobs import create_invoice_job, save_uploaded_invoices, job_runner, lease_expired, JOB_QUEUED
+from app.preview import preview_invoice_batch
+from app.invoice_numbers import set_start_number, unused_invoice_number_ranges, InvoiceNumberInUse
+from app.dashboard import get_dashboard_data
+from app.settings_service import settings_service
+from app.metrics import stage_timer, timed_iter, ITEM_ROWS
+from app.catalog import (parse_item_filters, items_page, ITEM_SORT_FIELDS, ITEM_DEFAULT_SORT,
+                         ITEM_TEXT_FILTERS, ITEM_DATE_FILTERS)
+from app.exports import (EXPORT_FORMATS, EXPORT_MIMETYPES, USAGE_EXPORT_HEADER, ITEMS_EXPORT_HEADER,
+                         usage_export_rows, items_export_rows, stream_export)
 import logging
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 bp = Blueprint('main', __name__)
@@ -27,50 +36,21 @@ def index():
 @bp.route('/dashboard')
 @login_required
 def dashboard():
-    start_invoice = Settings.query.filter_by(setting_name='START_INVOICE_NUMBER').first()
-    start_invoice_number = (
-        int(start_invoice.setting_value)
-        if start_invoice and start_invoice.setting_value.isdigit()
-        else current_app.config.get('DEFAULT_START_INVOICE_NUMBER', 1901)
-    )
-    
-    db.session.expire_all()
-    
-    items = Item.query.all()
-    items_in_stock = []
-    for item in items:
-        items_in_stock.append({
-            'product_id': item.product_id,
-            'product_description': item.product_description,
-            'quantity': item.quantity,
-            'remaining_quantity': item.remaining_quantity
-        })
-    
-    # دریافت مقادیر ارز از جدول Settings
-    initial_value = float(Settings.query.filter_by(setting_name='INITIAL_INVENTORY_VALUE').first().setting_value or 0)
-    remaining_value = float(Settings.query.filter_by(setting_name='REMAINING_INVENTORY_VALUE').first().setting_value or 0)
-    used_value = float(Settings.query.filter_by(setting_name='USED_INVENTORY_VALUE').first().setting_value or 0)
-    
-    recent_usages = ItemUsageLog.query.order_by(ItemUsageLog.exit_date.desc()).limit(10).all()
-    return render_template(
-        'dashboard.html',
-        title="داشبورد",
-        start_invoice_number=start_invoice_number,
-        items_in_stock=items_in_stock,
-        recent_usages=recent_usages,
-        initial_value=initial_value,
-        remaining_value=remaining_value,
-        used_value=used_value
+    config = current_app.config
+    data = get_dashboard_data(
+        db, Item, ItemUsageLog, settings_service,
+        top_n=config['DASHBOARD_TOP_N'],
+        max_age=config['DASHBOARD_CACHE_SECONDS'],
     )
+    return render_template('dashboard.html', title="داشبورد", **data)
 
 @bp.route('/upload_invoices', methods=['GET', 'POST'])
 @login_required
 def upload_invoices():
     """
-    Handles uploading, processing, and committing invoice data.
-    Updates remaining_quantity in the Item table for inventory control.
-    Updates inventory values (initial, remaining, used) after processing.
-    Returns a zip file if multiple output files are generated, otherwise returns a single Excel file.
+    Accepts invoice files as a background job and redirects to its progress page.
+    The job (see app.jobs) processes the files, updates remaining_quantity and the
+    inventory values, and packs the generated outputs for download.
     """
     form = UploadInvoiceForm()
     if form.validate_on_submit():
@@ -79,137 +59,52 @@ def upload_invoices():
             flash('فایلی انتخاب نشده است.', 'warning')
             return redirect(request.url)
 
-        start_invoice_setting = Settings.query.filter_by(setting_name='START_INVOICE_NUMBER').first()
-        current_invoice_number = (
-            int(start_invoice_setting.setting_value)
-            if start_invoice_setting and start_invoice_setting.setting_value.isdigit()
-            else current_app.config.get('DEFAULT_START_INVOICE_NUMBER', 1901)
-        )
-        
-        output_files = []
-        successfully_processed_files = []
-        all_files_processed_successfully = True
-        all_log_entries = []
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-
-        for file in uploaded_files:
-            if not (file and '.' in file.filename and file.filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']):
-                flash(f"فایل '{file.filename}' نامعتبر است یا پسوند مجاز ندارد.", 'warning')
-                all_files_processed_successfully = False
-                continue
-
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-            
-            try:
-                file.save(filepath)
-                flash(f"فایل '{filename}' دریافت شد. در حال پردازش...", 'info')
-            except Exception as e:
-                flash(f"خطا در ذخیره فایل {filename}: {str(e)}", 'danger')
-                all_files_processed_successfully = False
-                continue
-
-            try:
-                db.session.expire_all()
-                output_df, log_entries, next_invoice_num, messages = process_excel_invoices(
-                    filepath, db, Item, ItemUsageLog, current_invoice_number
-                )
-
-                for msg_type, msg_content in messages:
-                    flash(msg_content, msg_type)
-
-                if output_df.empty:
-                    all_files_processed_successfully = False
-                    if os.path.exists(filepath):
-                        try:
-                            os.remove(filepath)
-                        except OSError:
-                            pass
-                    continue
-
-                try:
-                    for entry in log_entries:
-                        db.session.add(entry)
-                    db.session.commit()
-                    flash(f"فایل '{filename}' با موفقیت پردازش و موجودی کالاها به‌روز‌رسانی شد.", 'success')
-                    successfully_processed_files.append(filename)
-                    all_log_entries.extend(log_entries)
+        if form.preview.data:
+            return _preview_invoices(uploaded_files)
 
-                    # Generate output Excel file
-                    output_filename = f'sjt_output_{current_invoice_number}_{timestamp}.xlsm'
-                    output_sjt_path = os.path.join(current_app.config['UPLOAD_FOLDER'], output_filename)
-                    template_path = os.path.join(current_app.root_path, 'sjt.xlsm')
-                    output_file_path, error = generate_sjt_output_excel(output_df, template_path, output_sjt_path)
-                    if error:
-                        flash(f"خطا در تولید فایل خروجی برای '{filename}': {error}", 'warning')
-                    else:
-                        output_files.append(output_sjt_path)
+        job = create_invoice_job(uploaded_files, current_user.id)
+        flash(f"{job.total_files} فایل دریافت شد و در صف پردازش قرار گرفت.", 'info')
+        return redirect(url_for('main.invoice_job', job_id=job.id))
 
-                    current_invoice_number = next_invoice_num
-
-                except Exception as e:
-                    db.session.rollback()
-                    logger.error(f"Database error processing {filename}: {str(e)}")
-                    flash(f"خطا در به‌روزرسانی دیتابیس برای فایل '{filename}': {str(e)}", 'danger')
-                    all_files_processed_successfully = False
-                    if os.path.exists(filepath):
-                        try:
-                            os.remove(filepath)
-                        except OSError:
-                            pass
-                    continue
-
-            except Exception as e:
-                db.session.rollback()
-                logger.error(f"Unexpected error processing {filename}: {str(e)}")
-                flash(f"خطای غیرمنتظره در پردازش فایل '{filename}': {str(e)}", 'danger')
-                all_files_processed_successfully = False
-            finally:
-                if os.path.exists(filepath):
-                    try:
-                        os.remove(filepath)
-                    except OSError:
-                        logger.warning(f"Failed to remove temporary file {filepath}")
+    return render_template('upload_invoices.html', form=form, title="آپلود فاکتورها")
 
-        if successfully_processed_files and all_files_processed_successfully:
-            try:
-                if start_invoice_setting:
-                    start_invoice_setting.setting_value = str(current_invoice_number)
-                else:
-                    start_invoice_setting = Settings(setting_name='START_INVOICE_NUMBER', setting_value=str(current_invoice_number))
-                    db.session.add(start_invoice_setting)
-                db.session.commit()
-                # محاسبه و به‌روزرسانی مقادیر ارز
-                initial_value, remaining_value, used_value = calculate_inventory_values(db, Item, Settings)
-                flash(f"شماره فاکتور شروع به‌روز‌رسانی شد به: {current_invoice_number}. ارز اولیه: {initial_value:,.2f}, ارز باقیمانده: {remaining_value:,.2f}, ارز مصرف‌شده: {used_value:,.2f}", 'info')
-            except Exception as e:
-                db.session.rollback()
-                flash(f"خطا در به‌روز‌رسانی شماره فاکتور شروع: {e}", 'danger')
-        elif successfully_processed_files:
-            flash("برخی فایل‌ها با موفقیت پردازش شدند، اما برخی خطا داشتند. شماره فاکتور شروع به‌روز نشد.", 'warning')
+def _preview_invoices(uploaded_files):
+    """Dry run of the uploaded batch on an in-memory stock snapshot; nothing is stored."""
+    with tempfile.TemporaryDirectory(dir=current_app.config['UPLOAD_FOLDER']) as folder:
+        files, messages, _ = save_uploaded_invoices(uploaded_files, folder)
+        preview = preview_invoice_batch(
+            [(os.path.join(folder, stored_name), filename) for stored_name, filename in files],
+            db, Item, settings_service,
+        )
+    for category, text in messages:
+        flash(text, category)
+    return render_template('preview_invoices.html', title='پیش‌نمایش تخصیص فاکتورها', preview=preview)
 
-        if output_files:
-            if len(output_files) > 1:
-                zip_filename = f"invoices_{timestamp}.zip"
-                zip_path = os.path.join(current_app.config['UPLOAD_FOLDER'], zip_filename)
-                with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                    for output_file in output_files:
-                        zipf.write(output_file, os.path.basename(output_file))
-                        try:
-                            os.remove(output_file)
-                        except OSError:
-                            logger.warning(f"Failed to remove temporary output file {output_file}")
-                flash(f"فایل‌های خروجی در یک فایل زیپ آماده دانلود هستند. <a href='{url_for('main.download_file', filename=zip_filename)}' class='alert-link'>دانلود فایل زیپ</a>", 'info')
-                return redirect(url_for('main.dashboard'))
-            else:
-                download_url = url_for('main.download_file', filename=os.path.basename(output_files[0]))
-                flash(f"فایل خروجی آماده است. <a href='{download_url}' class='alert-link'>دانلود کنید</a>", 'info')
-                return redirect(url_for('main.dashboard'))
-        else:
-            flash("هیچ فایل خروجی تولید نشد.", 'warning')
-            return redirect(url_for('main.dashboard'))
+@bp.route('/jobs/<job_id>')
+@login_required
+def invoice_job(job_id):
+    """Progress page of an invoice job; polls invoice_job_status."""
+    job = db.get_or_404(InvoiceJob, job_id)
+    return render_template('invoice_job.html', title='وضعیت پردازش فاکتورها', job=job)
 
-    return render_template('upload_invoices.html', form=form, title="آپلود فاکتورها")
+@bp.route('/jobs/<job_id>/status')
+@login_required
+def invoice_job_status(job_id):
+    """JSON progress of an invoice job."""
+    job = db.get_or_404(InvoiceJob, job_id)
+    if job.status == JOB_QUEUED or lease_expired(job, current_app.config['INVOICE_JOB_LEASE_SECONDS']):
+        # اگر این پروسس هنوز اجراکننده‌ای ندارد (مثلاً پس از راه‌اندازی مجدد)، آن را راه می‌اندازیم؛
+        # کاری که پروسس اجراکننده‌اش از بین رفته نیز پس از انقضای lease ادامه داده می‌شود
+        job_runner.start(current_app._get_current_object())
+        job_runner.wake()
+    return jsonify(
+        id=job.id,
+        status=job.status,
+        total_files=job.total_files,
+        processed_files=job.processed_files,
+        messages=[{'category': category, 'text': text} for category, text in job.messages],
+        download_url=url_for('main.download_file', filename=job.result_filename) if job.result_filename else None,
+    )
 
 @bp.route('/upload_items', methods=['GET', 'POST'])
 @login_required
@@ -217,6 +112,8 @@ def upload_items_file():
     """
     Handles uploading, processing, and committing item data to the database.
     Updates existing items if product_id exists, adding quantity to both quantity and remaining_quantity.
+    Rows are written in bulk (see bulk_upsert_items) instead of one query per row; large
+    .xlsx/.xlsm files are read and written in fixed-size chunks to keep memory flat.
     Updates inventory values after processing.
     """
     form = UploadItemsFileForm()
@@ -235,80 +132,62 @@ def upload_items_file():
             flash(f"خطا در ذخیره فایل: {str(e)}", 'danger')
             return redirect(url_for('main.upload_items_file'))
             
-        items_to_process, messages = process_items_excel(filepath)
-        for msg_type, msg_content in messages:
-            flash(msg_content, msg_type)
-        
+        extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+        if extension in ('xlsx', 'xlsm') and os.path.getsize(filepath) >= current_app.config['ITEMS_STREAMING_MIN_BYTES']:
+            # فایل‌های بزرگ به صورت جریانی و در دسته‌های با اندازه ثابت پردازش می‌شوند
+            chunks = iter_items_excel_chunks(filepath, chunk_size=current_app.config['ITEMS_STREAMING_CHUNK_SIZE'])
+        else:
+            chunks = [process_items_excel(filepath)]
+
         new_item_count = 0
         updated_item_count = 0
-        if items_to_process:
-            try:
-                for item_data in items_to_process:
-                    product_id = item_data.get('product_id')
-                    if not product_id:
-                        flash(f"شناسه کالا در ردیف نامعتبر است: {item_data}", 'warning')
-                        continue
-                    
-                    quantity_val = pd.to_numeric(item_data.get('quantity'), errors='coerce')
-                    new_quantity = int(quantity_val) if pd.notna(quantity_val) and quantity_val > 0 else 0
-                    if new_quantity <= 0:
-                        flash(f"مقدار نامعتبر برای کالا با شناسه {product_id}", 'warning')
-                        continue
-                    
-                    existing_item = Item.query.filter_by(product_id=product_id).first()
-                    if existing_item:
-                        existing_item.document_number = item_data.get('document_number', existing_item.document_number)
-                        existing_item.invoice_number_ref = item_data.get('invoice_number_ref', existing_item.invoice_number_ref)
-                        existing_item.document_date = item_data.get('document_date', existing_item.document_date)
-                        existing_item.seller = item_data.get('seller', existing_item.seller)
-                        existing_item.seller_province = item_data.get('seller_province', existing_item.seller_province)
-                        existing_item.activity_type = item_data.get('activity_type', existing_item.activity_type)
-                        existing_item.origin = item_data.get('origin', existing_item.origin)
-                        existing_item.item_category = item_data.get('item_category', existing_item.item_category)
-                        existing_item.product_description = item_data.get('product_description', existing_item.product_description)
-                        existing_item.unit_of_measurement = item_data.get('unit_of_measurement', existing_item.unit_of_measurement)
-                        existing_item.quantity += new_quantity
-                        existing_item.unit_price = item_data.get('unit_price', existing_item.unit_price)
-                        existing_item.final_amount = existing_item.quantity * existing_item.unit_price
-                        existing_item.remarks = item_data.get('remarks', existing_item.remarks)
-                        existing_item.remaining_quantity += new_quantity
-                        updated_item_count += 1
-                        logger.debug(f"Updated item {product_id}: quantity={existing_item.quantity}, remaining_quantity={existing_item.remaining_quantity}")
-                    else:
-                        new_item = Item(
-                            product_id=product_id,
-                            document_number=item_data.get('document_number'),
-                            invoice_number_ref=item_data.get('invoice_number_ref'),
-                            document_date=item_data.get('document_date'),
-                            seller=item_data.get('seller'),
-                            seller_province=item_data.get('seller_province'),
-                            activity_type=item_data.get('activity_type'),
-                            origin=item_data.get('origin'),
-                            item_category=item_data.get('item_category'),
-                            product_description=item_data.get('product_description'),
-                            unit_of_measurement=item_data.get('unit_of_measurement'),
-                            quantity=new_quantity,
-                            unit_price=item_data.get('unit_price', 0.0),
-                            final_amount=item_data.get('final_amount'),
-                            remarks=item_data.get('remarks'),
-                            remaining_quantity=new_quantity
-                        )
-                        db.session.add(new_item)
-                        new_item_count += 1
-                        logger.debug(f"Added new item {product_id} with quantity: {new_quantity}")
-                
-                db.session.commit()
-                # محاسبه و به‌روزرسانی مقادیر ارز
-                initial_value, remaining_value, used_value = calculate_inventory_values(db, Item, Settings)
+        value_delta = (0.0, 0.0, 0.0)
+        has_items = False
+        flashed_row_messages = 0
+        max_row_messages = current_app.config['ITEMS_MAX_ROW_MESSAGES']
+        try:
+            for items_df, messages in timed_iter(chunks, 'items', 'parse'):
+                for msg_type, msg_content in messages:
+                    if flashed_row_messages < max_row_messages:
+                        flash(msg_content, msg_type)
+                    flashed_row_messages += 1
+                if items_df.empty:
+                    continue
+                has_items = True
+                with stage_timer('items', 'upsert'):
+                    chunk_new, chunk_updated, chunk_delta, upsert_messages = bulk_upsert_items(
+                        db, Item, items_df, chunk_size=current_app.config['ITEMS_UPSERT_CHUNK_SIZE']
+                    )
+                ITEM_ROWS.inc(chunk_new, result='new')
+                ITEM_ROWS.inc(chunk_updated, result='updated')
+                new_item_count += chunk_new
+                updated_item_count += chunk_updated
+                value_delta = tuple(map(sum, zip(value_delta, chunk_delta)))
+                for msg_type, msg_content in upsert_messages:
+                    if flashed_row_messages < max_row_messages:
+                        flash(msg_content, msg_type)
+                    flashed_row_messages += 1
+
+            if flashed_row_messages > max_row_messages:
+                flash(f"{flashed_row_messages - max_row_messages} پیام دیگر برای ردیف‌های فایل نمایش داده نشد.", 'warning')
+            if has_items:
+                # به‌روزرسانی مقادیر ارز به صورت افزایشی در همان تراکنش
+                with stage_timer('items', 'valuation'):
+                    initial_value, remaining_value, used_value = apply_inventory_delta(db, Item, Settings, value_delta)
+                with stage_timer('items', 'commit'):
+                    db.session.commit()
                 flash(f"عملیات با موفقیت انجام شد. {new_item_count} کالای جدید اضافه و {updated_item_count} کالای موجود آپدیت شد. ارز اولیه: {initial_value:,.2f}, ارز باقیمانده: {remaining_value:,.2f}, ارز مصرف‌شده: {used_value:,.2f}", "success")
-            except Exception as e:
-                db.session.rollback()
-                flash(f"خطا در هنگام ذخیره‌سازی در دیتابیس: {str(e)}", "danger")
+        except ItemsFileError as e:
+            db.session.rollback()
+            flash(str(e), 'danger')
+        except Exception as e:
+            db.session.rollback()
+            flash(f"خطا در هنگام ذخیره‌سازی در دیتابیس: {str(e)}", "danger")
         if os.path.exists(filepath):
             try:
                 os.remove(filepath)
             except OSError:
-                logger.warning(f"Failed to remove temporary file {filepath}")
+                logger.warning("Failed to remove temporary file %s", filepath)
                 
         return redirect(url_for('main.manage_items'))
     elif request.method == 'POST':
@@ -319,31 +198,28 @@ def upload_items_file():
 @bp.route('/manage_items')
 @login_required
 def manage_items():
-    """Route to display, search, and manage all items."""
-    db.session.expire_all()
-    items = Item.query.order_by(Item.document_date.desc()).all()
-    items_with_stock = []
-    for item in items:
-        items_with_stock.append({
-            'id': item.id,
-            'document_number': item.document_number,
-            'invoice_number_ref': item.invoice_number_ref,
-            'document_date': item.document_date,
-            'seller': item.seller,
-            'seller_province': item.seller_province,
-            'activity_type': item.activity_type,
-            'origin': item.origin,
-            'item_category': item.item_category,
-            'product_description': item.product_description,
-            'unit_of_measurement': item.unit_of_measurement,
-            'quantity': item.quantity,
-            'unit_price': item.unit_price,
-            'final_amount': item.final_amount,
-            'product_id': item.product_id,
-            'remarks': item.remarks,
-            'remaining_quantity': item.remaining_quantity
-        })
-    return render_template('manage_items.html', title='مدیریت کالاها', items=items_with_stock)
+    """Route to display, search, and manage items, one keyset page at a time."""
+    filters, messages = parse_item_filters(request.args)
+    for category, message in messages:
+        flash(message, category)
+
+    sort = request.args.get('sort', ITEM_DEFAULT_SORT)
+    if sort not in ITEM_SORT_FIELDS:
+        sort = ITEM_DEFAULT_SORT
+    direction = 'asc' if request.args.get('dir') == 'asc' else 'desc'
+    per_page = min(max(request.args.get('per_page', current_app.config['ITEMS_PER_PAGE'], type=int), 1), 500)
+
+    items, next_cursor, prev_cursor = items_page(
+        Item, filters, sort=sort, direction=direction,
+        after=request.args.get('after'), before=request.args.get('before'), per_page=per_page
+    )
+    # پارامترهای فعلی جستجو برای ساخت لینک‌های صفحه‌بندی و مرتب‌سازی
+    query_args = {name: request.args[name] for name in (*ITEM_TEXT_FILTERS, *ITEM_DATE_FILTERS) if request.args.get(name)}
+    if per_page != current_app.config['ITEMS_PER_PAGE']:
+        query_args['per_page'] = per_page
+    return render_template('manage_items.html', title='مدیریت کالاها', items=items,
+                           sort=sort, direction=direction, query_args=query_args,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor)
 
 @bp.route('/item/add', methods=['GET', 'POST'])
 @login_required
@@ -375,9 +251,11 @@ def add_item():
             remaining_quantity=form.quantity.data
         )
         db.session.add(new_item)
+        # به‌روزرسانی مقادیر ارز به صورت افزایشی در همان تراکنش
+        initial_value, remaining_value, used_value = apply_inventory_delta(
+            db, Item, Settings, item_inventory_values(new_item.unit_price, new_item.quantity, new_item.remaining_quantity)
+        )
         db.session.commit()
-        # محاسبه و به‌روزرسانی مقادیر ارز
-        initial_value, remaining_value, used_value = calculate_inventory_values(db, Item, Settings)
         flash(f"کالای جدید با موفقیت اضافه شد. ارز اولیه: {initial_value:,.2f}, ارز باقیمانده: {remaining_value:,.2f}, ارز مصرف‌شده: {used_value:,.2f}", 'success')
         return redirect(url_for('main.manage_items'))
     return render_template('item_form.html', title='افزودن کالا', form=form, action='add')
@@ -389,12 +267,19 @@ def edit_item(item_id):
     item = Item.query.get_or_404(item_id)
     form = ItemForm(obj=item, original_product_id=item.product_id)
     if form.validate_on_submit():
+        # ردیف کالا پیش از ردیف‌های ارز قفل و دوباره خوانده می‌شود (همان ترتیب مسیر تخصیص)،
+        # تا تخصیصی که پس از بارگذاری فرم ثبت شده در مقدار پیشین حساب شود
+        item = Item.query.filter_by(id=item_id).with_for_update().populate_existing().first_or_404()
+        values_before = item_inventory_values(item.unit_price, item.quantity, item.remaining_quantity)
         form.populate_obj(item)
         item.final_amount = item.quantity * item.unit_price
         item.remaining_quantity = item.quantity  # Reset remaining_quantity to quantity
+        values_after = item_inventory_values(item.unit_price, item.quantity, item.remaining_quantity)
+        # به‌روزرسانی مقادیر ارز به صورت افزایشی در همان تراکنش
+        initial_value, remaining_value, used_value = apply_inventory_delta(
+            db, Item, Settings, inventory_values_delta(values_before, values_after)
+        )
         db.session.commit()
-        # محاسبه و به‌روزرسانی مقادیر ارز
-        initial_value, remaining_value, used_value = calculate_inventory_values(db, Item, Settings)
         flash(f"کالا با موفقیت ویرایش شد. ارز اولیه: {initial_value:,.2f}, ارز باقیمانده: {remaining_value:,.2f}, ارز مصرف‌شده: {used_value:,.2f}", 'success')
         return redirect(url_for('main.manage_items'))
     return render_template('item_form.html', title='ویرایش کالا', form=form, action='edit')
@@ -403,11 +288,15 @@ def edit_item(item_id):
 @login_required
 def delete_item(item_id):
     """Route to delete an item."""
-    item = Item.query.get_or_404(item_id)
+    # ردیف کالا پیش از ردیف‌های ارز قفل می‌شود تا مقدار باقیمانده آن تا commit تغییر نکند
+    item = Item.query.filter_by(id=item_id).with_for_update().populate_existing().first_or_404()
+    values_before = item_inventory_values(item.unit_price, item.quantity, item.remaining_quantity)
     db.session.delete(item)
+    # به‌روزرسانی مقادیر ارز به صورت افزایشی در همان تراکنش
+    initial_value, remaining_value, used_value = apply_inventory_delta(
+        db, Item, Settings, inventory_values_delta(values_before, (0.0, 0.0, 0.0))
+    )
     db.session.commit()
-    # محاسبه و به‌روزرسانی مقادیر ارز
-    initial_value, remaining_value, used_value = calculate_inventory_values(db, Item, Settings)
     flash(f"کالا و لاگ‌های مصرف مربوط به آن با موفقیت حذف شدند. ارز اولیه: {initial_value:,.2f}, ارز باقیمانده: {remaining_value:,.2f}, ارز مصرف‌شده: {used_value:,.2f}", 'success')
     return redirect(url_for('main.manage_items'))
 
@@ -416,22 +305,48 @@ def delete_item(item_id):
 def app_settings():
     """Route to manage application settings like start invoice number."""
     form = SettingsForm()
-    setting = Settings.query.filter_by(setting_name='START_INVOICE_NUMBER').first()
     if form.validate_on_submit():
-        if setting:
-            setting.setting_value = str(form.start_invoice_number.data)
-        else:
-            setting = Settings(setting_name='START_INVOICE_NUMBER', setting_value=str(form.start_invoice_number.data))
-            db.session.add(setting)
-        db.session.commit()
-        flash('تنظیمات با موفقیت ذخیره شد.', 'success')
-        return redirect(url_for('main.dashboard'))
+        try:
+            set_start_number(db, InvoiceNumberBlock, form.start_invoice_number.data)
+            db.session.commit()
+            flash('تنظیمات با موفقیت ذخیره شد.', 'success')
+            return redirect(url_for('main.dashboard'))
+        except InvoiceNumberInUse as e:
+            db.session.rollback()
+            flash(f"شماره‌های فاکتور تا {e.highest_reserved} قبلاً رزرو شده‌اند؛ شماره شروع باید بزرگ‌تر از آن باشد.", 'danger')
     elif request.method == 'GET':
-        if setting and setting.setting_value:
-            form.start_invoice_number.data = int(setting.setting_value)
-        else:
-            form.start_invoice_number.data = current_app.config.get('DEFAULT_START_INVOICE_NUMBER')
-    return render_template('settings.html', title='تنظیمات', form=form)
+        form.start_invoice_number.data = settings_service.start_invoice_number()
+    unused_ranges = unused_invoice_number_ranges(db, InvoiceNumberBlock)
+    return render_template('settings.html', title='تنظیمات', form=form, unused_ranges=unused_ranges)
+
+def _export_response(export_format, name, header, rows, sheet_name):
+    chunk_size = current_app.config['EXPORT_CHUNK_SIZE']
+    body = stream_export(export_format, header, rows, sheet_name=sheet_name, chunk_size=chunk_size)
+    return Response(
+        stream_with_context(body),
+        mimetype=EXPORT_MIMETYPES[export_format],
+        headers={'Content-Disposition': f'attachment; filename={name}.{export_format}'},
+    )
+
+@bp.route('/export/usage.<export_format>')
+@login_required
+def export_usage_log(export_format):
+    """Streams the usage log joined with the items; the date range applies to the exit date."""
+    if export_format not in EXPORT_FORMATS:
+        abort(404)
+    filters, _ = parse_item_filters(request.args)
+    rows = usage_export_rows(db, Item, ItemUsageLog, filters, chunk_size=current_app.config['EXPORT_CHUNK_SIZE'])
+    return _export_response(export_format, 'usage_log', USAGE_EXPORT_HEADER, rows, 'Usage Log')
+
+@bp.route('/export/items.<export_format>')
+@login_required
+def export_items(export_format):
+    """Streams the item catalogue with the same filters as the manage items page."""
+    if export_format not in EXPORT_FORMATS:
+        abort(404)
+    filters, _ = parse_item_filters(request.args)
+    rows = items_export_rows(db, Item, filters, chunk_size=current_app.config['EXPORT_CHUNK_SIZE'])
+    return _export_response(export_format, 'items', ITEMS_EXPORT_HEADER, rows, 'Items')
 
 @bp.route('/download/<path:filename>')
 @login_required
@@ -0,0 +1,209 @@
+# app/metrics.py
+"""
+Minimal in-process metrics with Prometheus text exposition.
+
+Values live in the memory of each process: with several gunicorn workers every
+worker exposes its own series, so scrape each worker (or sum them) accordingly.
+Metrics recorded inside the output process pool are measured there and reported
+back to the parent (see app.workers).
+"""
+import bisect
+import ipaddress
+import threading
+import time
+from contextlib import contextmanager
+from flask import Response, current_app, g, request
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _label_text(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + '}'
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            series = sorted(self._series.items())
+            lines.extend(self._render_series(key, value) for key, value in series)
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._series.get(self._key(labels), 0)
+
+    def _render_series(self, key, value):
+        return f'{self.name}{_label_text(self.labelnames, key)} {_format_value(value)}'
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # [bucket counts..., count, sum]
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            series = self._series.get(self._key(labels))
+            return series[-2] if series else 0
+
+    def _render_series(self, key, series):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, series):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{_label_text(self.labelnames, key, [("le", _format_value(bound))])} {cumulative}')
+        lines.append(f'{self.name}_bucket{_label_text(self.labelnames, key, [("le", "+Inf")])} {series[-2]}')
+        lines.append(f'{self.name}_count{_label_text(self.labelnames, key)} {series[-2]}')
+        lines.append(f'{self.name}_sum{_label_text(self.labelnames, key)} {_format_value(series[-1])}')
+        return '\n'.join(lines)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+
+registry = Registry()
+
+REQUEST_LATENCY = registry.register(Histogram(
+    'sjt_http_request_duration_seconds', 'Request latency per route.', ('endpoint', 'method')
+))
+REQUESTS = registry.register(Counter(
+    'sjt_http_requests_total', 'Requests per route and status code.', ('endpoint', 'method', 'status')
+))
+STAGE_LATENCY = registry.register(Histogram(
+    'sjt_stage_duration_seconds', 'Time spent per pipeline stage.', ('pipeline', 'stage')
+))
+INVOICE_FILES = registry.register(Counter(
+    'sjt_invoice_files_total', 'Invoice files processed, by result.', ('result',)
+))
+INVOICE_ROWS = registry.register(Counter(
+    'sjt_invoice_rows_total', 'Invoice product rows allocated.', ()
+))
+ITEM_ROWS = registry.register(Counter(
+    'sjt_item_rows_total', 'Item rows written by uploads, by result.', ('result',)
+))
+
+
+def stage_timer(pipeline, stage):
+    """Context manager observing the duration of one pipeline stage."""
+    return STAGE_LATENCY.time(pipeline=pipeline, stage=stage)
+
+
+def observe_stage(pipeline, stage, seconds):
+    STAGE_LATENCY.observe(seconds, pipeline=pipeline, stage=stage)
+
+
+def timed_iter(iterable, pipeline, stage):
+    """Yields from iterable, charging the time spent producing each element to the stage."""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            element = next(iterator)
+        except StopIteration:
+            return
+        observe_stage(pipeline, stage, time.perf_counter() - start)
+        yield element
+
+
+def _remote_allowed(remote_addr, allowed_networks):
+    try:
+        address = ipaddress.ip_address(remote_addr or '')
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network, strict=False) for network in allowed_networks)
+
+
+def metrics_view():
+    if not _remote_allowed(request.remote_addr, current_app.config['METRICS_ALLOWED_NETWORKS']):
+        return Response('Forbidden\n', status=403, mimetype='text/plain')
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_metrics(app):
+    """Registers the request timing hooks and the local-only /metrics endpoint."""
+
+    @app.before_request
+    def _start_request_timer():
+        g._request_started = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        started = g.pop('_request_started', None)
+        endpoint = request.endpoint or 'unmatched'
+        if started is not None and endpoint != 'metrics':
+            REQUEST_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method)
+            REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        return response
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,229 @@
+# app/migrations.py
+"""
+Versioned, in-place schema migrations.
+
+Applied versions are recorded in the schema_version table. Every migration
+only adds what is missing (it inspects the live schema first), so it is safe
+on databases created by recreate_table.py, by db.create_all() or by an older
+version of the models, and safe to re-run after a partial failure. Migrations
+never drop tables or data.
+
+Migrations do not read app.models: the tables and indexes they create are
+frozen here as they were when the migration was written, so a migration does
+the same thing whatever version of the code runs it. Changes to the models
+need a new migration.
+"""
+import logging
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import (Column, Date, DateTime, Float, ForeignKey, Integer, MetaData, String, Table, Text, inspect,
+                        select, text)
+
+logger = logging.getLogger(__name__)
+
+Migration = namedtuple('Migration', ['version', 'name', 'apply'])
+
+_version_metadata = MetaData()
+schema_version = Table(
+    'schema_version', _version_metadata,
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('name', String(128), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+# ساختار جداول در زمان نوشتن هر مایگریشن؛ نباید بعداً تغییر کند
+_frozen_metadata = MetaData()
+
+_baseline_tables = [
+    Table(
+        'user', _frozen_metadata,
+        Column('id', Integer, primary_key=True),
+        Column('username', String(64), index=True, unique=True, nullable=False),
+        Column('password_hash', String(256)),
+    ),
+    Table(
+        'item', _frozen_metadata,
+        Column('id', Integer, primary_key=True),
+        Column('document_number', String(64)),
+        Column('invoice_number_ref', String(64)),
+        Column('document_date', Date, nullable=False),
+        Column('seller', String(128)),
+        Column('seller_province', String(64)),
+        Column('activity_type', String(64)),
+        Column('origin', String(64)),
+        Column('item_category', String(64)),
+        Column('product_description', String(256)),
+        Column('unit_of_measurement', String(32)),
+        Column('quantity', Integer, nullable=False),
+        Column('unit_price', Float, nullable=False),
+        Column('final_amount', Float),
+        Column('product_id', String(128), unique=True, nullable=False),
+        Column('remarks', Text, nullable=True),
+        Column('remaining_quantity', Integer, nullable=False),
+    ),
+    Table(
+        'item_usage_log', _frozen_metadata,
+        Column('id', Integer, primary_key=True),
+        Column('item_id', Integer, ForeignKey('item.id'), nullable=False),
+        Column('exit_date', Date),
+        Column('invoice_number_used', String(64), nullable=False),
+        Column('quantity_used', Integer, nullable=False),
+        Column('price_at_usage', Float),
+    ),
+    Table(
+        'settings', _frozen_metadata,
+        Column('id', Integer, primary_key=True),
+        Column('setting_name', String(64), unique=True, nullable=False),
+        Column('setting_value', String(256), nullable=False),
+    ),
+    Table(
+        'invoice_job', _frozen_metadata,
+        Column('id', String(32), primary_key=True),
+        Column('status', String(16), nullable=False, index=True),
+        Column('total_files', Integer, nullable=False),
+        Column('processed_files', Integer, nullable=False),
+        Column('rejected_files', Integer, nullable=False),
+        Column('files_json', Text, nullable=False),
+        Column('messages_json', Text, nullable=False),
+        Column('result_filename', String(256)),
+        Column('created_by', Integer, ForeignKey('user.id')),
+        Column('created_at', DateTime, index=True),
+        Column('started_at', DateTime),
+        Column('finished_at', DateTime),
+    ),
+]
+
+_invoice_number_block = Table(
+    'invoice_number_block', _frozen_metadata,
+    Column('id', Integer, primary_key=True),
+    Column('first_number', Integer, nullable=False),
+    Column('last_number', Integer, nullable=False),
+    Column('next_number', Integer, nullable=False),
+    Column('job_id', String(32), index=True),
+    Column('reserved_at', DateTime, nullable=False),
+    Column('closed_at', DateTime),
+)
+
+_processed_invoice_file = Table(
+    'processed_invoice_file', _frozen_metadata,
+    Column('content_hash', String(64), primary_key=True),
+    Column('filename', String(256)),
+    Column('invoice_number', Integer, nullable=False),
+    Column('job_id', String(32)),
+    Column('processed_at', DateTime, nullable=False),
+)
+
+
+def _column_names(conn, table_name):
+    return {column['name'] for column in inspect(conn).get_columns(table_name)}
+
+
+def _create_missing_indexes(conn, table_name, indexes):
+    """Creates the {name: columns} indexes that table_name does not have yet."""
+    existing = {index['name'] for index in inspect(conn).get_indexes(table_name)}
+    for name, columns in indexes.items():
+        if name not in existing:
+            logger.info("Creating index %s on %s", name, table_name)
+            conn.execute(text(f"CREATE INDEX {name} ON {table_name} ({', '.join(columns)})"))
+
+
+def _create_baseline_tables(conn):
+    """Creates the tables of the schema the migrations start from, where they do not exist yet."""
+    _frozen_metadata.create_all(conn, tables=_baseline_tables, checkfirst=True)
+
+
+def _add_item_remaining_quantity(conn):
+    """
+    Older schemas (see the DDL that recreate_table.py used to carry) have no
+    remaining_quantity column. It is added and backfilled from the usage log:
+    remaining = quantity - everything already used from the item.
+    """
+    if 'remaining_quantity' in _column_names(conn, 'item'):
+        return
+    conn.execute(text("ALTER TABLE item ADD COLUMN remaining_quantity INTEGER NOT NULL DEFAULT 0"))
+    conn.execute(text(
+        "UPDATE item SET remaining_quantity = quantity - COALESCE("
+        "(SELECT SUM(item_usage_log.quantity_used) FROM item_usage_log WHERE item_usage_log.item_id = item.id), 0)"
+    ))
+
+
+def _add_item_indexes(conn):
+    _create_missing_indexes(conn, 'item', {
+        'ix_item_remaining_quantity_unit_price': ('remaining_quantity', 'unit_price'),
+        'ix_item_document_date_id': ('document_date', 'id'),
+        'ix_item_unit_price_id': ('unit_price', 'id'),
+        'ix_item_quantity_id': ('quantity', 'id'),
+        'ix_item_remaining_quantity_id': ('remaining_quantity', 'id'),
+        'ix_item_seller': ('seller',),
+        'ix_item_item_category': ('item_category',),
+    })
+
+
+def _add_item_usage_log_indexes(conn):
+    _create_missing_indexes(conn, 'item_usage_log', {
+        'ix_item_usage_log_exit_date': ('exit_date',),
+        'ix_item_usage_log_invoice_number_used': ('invoice_number_used',),
+        'ix_item_usage_log_item_id_exit_date': ('item_id', 'exit_date'),
+    })
+
+
+def _create_invoice_number_block(conn):
+    _invoice_number_block.create(conn, checkfirst=True)
+
+
+def _create_processed_invoice_file(conn):
+    _processed_invoice_file.create(conn, checkfirst=True)
+
+
+def _add_processed_invoice_file_output(conn):
+    if 'output_json' not in _column_names(conn, 'processed_invoice_file'):
+        conn.execute(text("ALTER TABLE processed_invoice_file ADD COLUMN output_json TEXT"))
+
+
+def _add_invoice_job_lease(conn):
+    columns = _column_names(conn, 'invoice_job')
+    if 'heartbeat_at' not in columns:
+        conn.execute(text("ALTER TABLE invoice_job ADD COLUMN heartbeat_at DATETIME"))
+    if 'lease_owner' not in columns:
+        conn.execute(text("ALTER TABLE invoice_job ADD COLUMN lease_owner VARCHAR(32)"))
+
+
+MIGRATIONS = [
+    Migration(1, 'baseline tables', _create_baseline_tables),
+    Migration(2, 'item.remaining_quantity', _add_item_remaining_quantity),
+    Migration(3, 'item allocation and listing indexes', _add_item_indexes),
+    Migration(4, 'item_usage_log reporting indexes', _add_item_usage_log_indexes),
+    Migration(5, 'invoice_number_block', _create_invoice_number_block),
+    Migration(6, 'processed_invoice_file', _create_processed_invoice_file),
+    Migration(7, 'processed_invoice_file.output_json', _add_processed_invoice_file_output),
+    Migration(8, 'invoice_job lease', _add_invoice_job_lease),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def applied_versions(engine):
+    _version_metadata.create_all(engine, checkfirst=True)
+    with engine.connect() as conn:
+        return set(conn.execute(select(schema_version.c.version)).scalars())
+
+
+def upgrade(engine, target=None):
+    """
+    Applies every pending migration up to target (default: the latest), each in its
+    own transaction, and returns the list of applied migrations.
+    """
+    target = LATEST_VERSION if target is None else target
+    done = applied_versions(engine)
+    applied = []
+    for migration in MIGRATIONS:
+        if migration.version in done or migration.version > target:
+            continue
+        logger.info("Applying migration %s: %s", migration.version, migration.name)
+        with engine.begin() as conn:
+            migration.apply(conn)
+            conn.execute(schema_version.insert().values(
+                version=migration.version, name=migration.name, applied_at=datetime.utcnow()
+            ))
+        applied.append(migration)
+    return applied
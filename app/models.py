@@ -2,6 +2,7 @@ from app.extensions import db, login  # اضافه کردن login به imports
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
+import json
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -38,6 +39,18 @@ class Item(db.Model):
     
     usages = db.relationship('ItemUsageLog', backref='item', lazy='dynamic', cascade="all, delete-orphan")
 
+    # ایندکس تخصیص موجودی و ایندکس‌های مرتب‌سازی و فیلتر صفحه مدیریت کالاها (keyset روی ستون + id)
+    # هر ستون یا ایندکس جدید به یک مایگریشن جدید در app/migrations.py نیاز دارد
+    __table_args__ = (
+        db.Index('ix_item_remaining_quantity_unit_price', 'remaining_quantity', 'unit_price'),
+        db.Index('ix_item_document_date_id', 'document_date', 'id'),
+        db.Index('ix_item_unit_price_id', 'unit_price', 'id'),
+        db.Index('ix_item_quantity_id', 'quantity', 'id'),
+        db.Index('ix_item_remaining_quantity_id', 'remaining_quantity', 'id'),
+        db.Index('ix_item_seller', 'seller'),
+        db.Index('ix_item_item_category', 'item_category'),
+    )
+
     def __repr__(self):
         return f'<Item {self.product_id}>'
 
@@ -49,6 +62,13 @@ class ItemUsageLog(db.Model):
     quantity_used = db.Column(db.Integer, nullable=False)
     price_at_usage = db.Column(db.Float)
 
+    # ایندکس‌های گزارش‌گیری
+    __table_args__ = (
+        db.Index('ix_item_usage_log_exit_date', 'exit_date'),
+        db.Index('ix_item_usage_log_invoice_number_used', 'invoice_number_used'),
+        db.Index('ix_item_usage_log_item_id_exit_date', 'item_id', 'exit_date'),
+    )
+
     def __repr__(self):
         return f'<ItemUsageLog Item_ID:{self.item_id} Qty:{self.quantity_used}>'
 
@@ -60,6 +80,83 @@ class Settings(db.Model):
     def __repr__(self):
         return f'<Settings {self.setting_name}: {self.setting_value}>'
 
+class InvoiceJob(db.Model):
+    """A batch of uploaded invoice files processed by the background job runner."""
+    id = db.Column(db.String(32), primary_key=True)
+    status = db.Column(db.String(16), nullable=False, default='queued', index=True)
+    total_files = db.Column(db.Integer, nullable=False, default=0)
+    processed_files = db.Column(db.Integer, nullable=False, default=0)
+    rejected_files = db.Column(db.Integer, nullable=False, default=0)
+    files_json = db.Column(db.Text, nullable=False, default='[]')
+    messages_json = db.Column(db.Text, nullable=False, default='[]')
+    result_filename = db.Column(db.String(256))
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    # lease اجراکننده: با هر فایل تمدید می‌شود؛ کار با lease منقضی را اجراکننده دیگری ادامه می‌دهد
+    heartbeat_at = db.Column(db.DateTime)
+    lease_owner = db.Column(db.String(32))
+
+    @property
+    def files(self):
+        """List of (stored_filename, original_filename) pairs, in upload order."""
+        return [tuple(pair) for pair in json.loads(self.files_json or '[]')]
+
+    @property
+    def messages(self):
+        return [tuple(message) for message in json.loads(self.messages_json or '[]')]
+
+    def add_messages(self, messages):
+        self.messages_json = json.dumps(self.messages + list(messages), ensure_ascii=False)
+
+    def __repr__(self):
+        return f'<InvoiceJob {self.id} {self.status}>'
+
+class InvoiceNumberBlock(db.Model):
+    """
+    A block of invoice numbers reserved by one batch (see app.invoice_numbers).
+    first_number..next_number - 1 have been used; next_number..last_number are
+    reserved but unused.
+    """
+    __tablename__ = 'invoice_number_block'
+    id = db.Column(db.Integer, primary_key=True)
+    first_number = db.Column(db.Integer, nullable=False)
+    last_number = db.Column(db.Integer, nullable=False)
+    next_number = db.Column(db.Integer, nullable=False)
+    job_id = db.Column(db.String(32), index=True)
+    reserved_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    closed_at = db.Column(db.DateTime)
+
+    @property
+    def unused(self):
+        return max(self.last_number - self.next_number + 1, 0)
+
+    def __repr__(self):
+        return f'<InvoiceNumberBlock {self.first_number}-{self.last_number} next={self.next_number}>'
+
+class ProcessedInvoiceFile(db.Model):
+    """
+    Registry of allocated invoice files, keyed by the sha256 of their content.
+    Written in the allocation transaction, so a file is allocated at most once.
+    Keeps the output rows of the invoice, so its output file can be rebuilt.
+    """
+    __tablename__ = 'processed_invoice_file'
+    content_hash = db.Column(db.String(64), primary_key=True)
+    filename = db.Column(db.String(256))
+    invoice_number = db.Column(db.Integer, nullable=False)
+    job_id = db.Column(db.String(32))
+    processed_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    # سطرهای خروجی sjt فاکتور (JSON)، برای ساخت دوباره فایل خروجی
+    output_json = db.Column(db.Text)
+
+    @property
+    def output_rows(self):
+        return json.loads(self.output_json) if self.output_json else None
+
+    def __repr__(self):
+        return f'<ProcessedInvoiceFile {self.content_hash[:12]} #{self.invoice_number}>'
+
 @login.user_loader
 def load_user(id):
     return User.query.get(int(id))
\ No newline at end of file
@@ -0,0 +1,122 @@
+# app/preview.py
+"""
+Dry-run of an invoice batch.
+
+The files are parsed and allocated exactly as process_excel_invoices does, but
+against a single in-memory StockAllocator snapshot shared by the whole batch:
+each file sees the stock left by the files before it, as in the real job, and
+nothing is written to the database. Loading the snapshot and one registry
+lookup for the whole batch are the only queries, so a preview of hundreds of
+files costs little more than parsing them. Parsed
+results go through app.invoice_cache, so uploading the previewed files for real
+does not parse them again, and files that were already allocated are reported
+as such instead of being allocated a second time.
+"""
+import os
+import logging
+from collections import namedtuple
+from app.allocation import StockAllocator
+from app.models import ProcessedInvoiceFile
+from app.utils import read_invoice_file_cached, allocate_invoice, already_processed_message, _sum_inventory_values
+from app import invoice_cache
+from app.settings_service import INVENTORY_VALUE_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+PreviewRow = namedtuple('PreviewRow', ['product_description', 'quantity_needed', 'product_id', 'unit_price', 'value'])
+FilePreview = namedtuple('FilePreview', ['filename', 'invoice_number', 'rows', 'shortfalls', 'allocated_value', 'messages'])
+BatchPreview = namedtuple('BatchPreview', [
+    'files', 'processed_files', 'total_rows', 'total_shortfalls', 'allocated_value',
+    'values_before', 'values_after', 'next_invoice_number',
+])
+
+
+def preview_invoice_file(filepath, allocator, invoice_number, filename=None, content_hash=None):
+    """
+    Allocates one invoice file on the allocator snapshot (which is decremented in
+    memory). Returns a FilePreview; invoice_number is None when the real run would
+    reject the file.
+    """
+    filename = filename or os.path.basename(filepath)
+    try:
+        header, required_products, messages = read_invoice_file_cached(filepath, content_hash, filename)
+    except Exception as e:
+        logger.error("Error reading %s for preview: %s", filepath, e)
+        return FilePreview(filename, None, [], 0, 0.0, [('danger', f"خطا در خواندن فایل {filename}: {str(e)}")])
+    if header is None:
+        return FilePreview(filename, None, [], 0, 0.0, messages)
+    if not required_products:
+        messages.append(('danger', f"هیچ محصول معتبری در فایل {filename} یافت نشد."))
+        return FilePreview(filename, None, [], 0, 0.0, messages)
+
+    output_data, usages, allocation_messages = allocate_invoice(
+        header, required_products, allocator, invoice_number, filename
+    )
+    messages.extend(allocation_messages)
+
+    # allocate_invoice یک سطر خروجی به ازای هر محصول فاکتور می‌سازد، به همان ترتیب
+    rows = []
+    shortfalls = 0
+    for (description, quantity_needed, _, _), output_row in zip(required_products, output_data):
+        if output_row['N']:
+            rows.append(PreviewRow(description, quantity_needed, output_row['K'], output_row['Q'],
+                                   output_row['N'] * output_row['Q']))
+        else:
+            shortfalls += 1
+            rows.append(PreviewRow(description, quantity_needed, None, None, 0.0))
+
+    if not usages:
+        messages.append(('danger', f"هیچ محصولی در فایل {filename} قابل پردازش نبود."))
+        return FilePreview(filename, None, rows, shortfalls, 0.0, messages)
+    allocated_value = sum(quantity_used * price_at_usage for _, quantity_used, price_at_usage in usages)
+    return FilePreview(filename, invoice_number, rows, shortfalls, allocated_value, messages)
+
+
+def preview_invoice_batch(files, db, Item, settings, start_invoice_number=None):
+    """
+    Previews a batch of invoice files given as (filepath, filename) pairs, in the
+    order the job would process them. Invoice numbers advance only for files that
+    would be processed. Returns a BatchPreview with the per-file results and the
+    inventory values the batch would leave behind.
+    """
+    allocator = StockAllocator.from_db(db, Item)
+    invoice_number = settings.start_invoice_number() if start_invoice_number is None else start_invoice_number
+    values_before = settings.inventory_values()
+    if any(settings.get(name) is None for name in INVENTORY_VALUE_SETTINGS):
+        # مانند apply_inventory_delta، اگر ارزها هنوز ذخیره نشده‌اند از جدول کالاها محاسبه می‌شوند
+        values_before = _sum_inventory_values(db, Item)
+
+    # همه فایل‌ها ابتدا هش و با یک پرس‌وجو در فهرست فایل‌های ثبت‌شده جست‌وجو می‌شوند (مانند run_invoice_batch)
+    digests = [invoice_cache.file_digest(filepath) for filepath, _ in files]
+    registered = {
+        entry.content_hash: entry
+        for entry in ProcessedInvoiceFile.query.filter(ProcessedInvoiceFile.content_hash.in_(set(digests)))
+    } if digests else {}
+
+    previews = []
+    seen = set()
+    for (filepath, filename), content_hash in zip(files, digests):
+        entry = registered.get(content_hash)
+        if entry is not None or content_hash in seen:
+            message = (already_processed_message(entry, filename) if entry is not None
+                       else ('warning', f"فایل {filename} تکراری است و فقط یک بار پردازش می‌شود."))
+            previews.append(FilePreview(filename, None, [], 0, 0.0, [message]))
+            continue
+        seen.add(content_hash)
+        preview = preview_invoice_file(filepath, allocator, invoice_number, filename, content_hash)
+        if preview.invoice_number is not None:
+            invoice_number += 1
+        previews.append(preview)
+
+    allocated_value = sum(preview.allocated_value for preview in previews)
+    initial_value, remaining_value, used_value = values_before
+    return BatchPreview(
+        files=previews,
+        processed_files=sum(1 for preview in previews if preview.invoice_number is not None),
+        total_rows=sum(len(preview.rows) for preview in previews),
+        total_shortfalls=sum(preview.shortfalls for preview in previews),
+        allocated_value=allocated_value,
+        values_before=values_before,
+        values_after=(initial_value, remaining_value - allocated_value, used_value + allocated_value),
+        next_invoice_number=invoice_number,
+    )
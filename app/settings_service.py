@@ -0,0 +1,156 @@
+# app/settings_service.py
+import threading
+import time
+import uuid
+from flask import current_app
+from sqlalchemy import event, update
+from sqlalchemy.exc import IntegrityError
+from app.extensions import db
+from app.models import Settings
+
+INVENTORY_VALUE_SETTINGS = ('INITIAL_INVENTORY_VALUE', 'REMAINING_INVENTORY_VALUE', 'USED_INVENTORY_VALUE')
+# توکنی که با هر تغییر موجودی عوض می‌شود؛ کش‌های داشبورد با آن اعتبارسنجی می‌شوند
+INVENTORY_VERSION_SETTING = 'INVENTORY_VERSION'
+# توکنی که با هر تغییر سایر تنظیمات (مثل شماره شروع فاکتور) عوض می‌شود
+SETTINGS_VERSION_SETTING = 'SETTINGS_VERSION'
+VERSION_SETTINGS = (SETTINGS_VERSION_SETTING, INVENTORY_VERSION_SETTING)
+
+_CHANGED_KEY = 'settings_changed'
+
+
+def mark_settings_changed(session):
+    """Flags the session so the local settings cache is dropped once it commits."""
+    session.info[_CHANGED_KEY] = True
+
+
+def replace_version_token(session, setting_name):
+    """
+    Writes a new random token into a version setting inside the current transaction.
+    Does not commit.
+    """
+    token = uuid.uuid4().hex
+    updated = session.execute(
+        update(Settings).where(Settings.setting_name == setting_name).values(setting_value=token)
+    ).rowcount
+    if not updated:
+        session.add(Settings(setting_name=setting_name, setting_value=token))
+    mark_settings_changed(session)
+    return token
+
+
+def lock_setting(session, setting_name, default):
+    """
+    Returns the Settings row locked for update in the current transaction, creating
+    it with the default value first if it does not exist yet.
+    """
+    query = session.query(Settings).filter_by(setting_name=setting_name).with_for_update().populate_existing()
+    setting = query.first()
+    if setting is None:
+        try:
+            with session.begin_nested():
+                session.add(Settings(setting_name=setting_name, setting_value=str(default)))
+        except IntegrityError:
+            # another transaction created it first; its row is locked below
+            pass
+        setting = query.one()
+    return setting
+
+
+class SettingsService:
+    """
+    Read-through, per-process cache of the settings table.
+
+    All settings are loaded with one query. Cached values are served without a
+    query for SETTINGS_REFRESH_SECONDS; after that only the version tokens are
+    read, and everything is reloaded if one of them changed. Writers replace a
+    token in the same transaction as the change (set() and the inventory write
+    paths do this), so other processes see the change within the refresh window
+    and this process sees it right after its own commit.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = None
+        self._versions = None
+        self._checked_at = 0.0
+
+    def _load(self):
+        rows = db.session.query(Settings.setting_name, Settings.setting_value).all()
+        values = dict(rows)
+        with self._lock:
+            self._values = values
+            self._versions = {name: values.get(name) for name in VERSION_SETTINGS}
+            self._checked_at = time.monotonic()
+        return values
+
+    def _snapshot(self, fresh=False):
+        with self._lock:
+            values, versions, checked_at = self._values, self._versions, self._checked_at
+        if values is None or fresh:
+            return self._load()
+        if time.monotonic() - checked_at < current_app.config['SETTINGS_REFRESH_SECONDS']:
+            return values
+        rows = db.session.query(Settings.setting_name, Settings.setting_value).filter(
+            Settings.setting_name.in_(VERSION_SETTINGS)
+        ).all()
+        current = {name: None for name in VERSION_SETTINGS}
+        current.update(rows)
+        if current != versions:
+            return self._load()
+        with self._lock:
+            self._checked_at = time.monotonic()
+        return values
+
+    def invalidate(self):
+        with self._lock:
+            self._values = None
+
+    def get(self, name, default=None, fresh=False):
+        value = self._snapshot(fresh).get(name)
+        return default if value is None else value
+
+    def get_int(self, name, default=0, fresh=False):
+        value = (self.get(name, fresh=fresh) or '').strip()
+        return int(value) if value.isdigit() else default
+
+    def get_float(self, name, default=0.0, fresh=False):
+        try:
+            return float(self.get(name, fresh=fresh) or default)
+        except (TypeError, ValueError):
+            return default
+
+    def start_invoice_number(self, fresh=False):
+        return self.get_int(
+            'START_INVOICE_NUMBER', current_app.config.get('DEFAULT_START_INVOICE_NUMBER', 1901), fresh=fresh
+        )
+
+    def inventory_values(self, fresh=False):
+        """The stored (initial, remaining, used) inventory values."""
+        self._snapshot(fresh)
+        return tuple(self.get_float(name) for name in INVENTORY_VALUE_SETTINGS)
+
+    def inventory_version(self):
+        return self.get(INVENTORY_VERSION_SETTING)
+
+    def set(self, name, value):
+        """Stores a setting in the current transaction and replaces the settings version. Does not commit."""
+        setting = Settings.query.filter_by(setting_name=name).first()
+        if setting:
+            setting.setting_value = str(value)
+        else:
+            db.session.add(Settings(setting_name=name, setting_value=str(value)))
+        replace_version_token(db.session, SETTINGS_VERSION_SETTING)
+
+
+settings_service = SettingsService()
+
+
+@event.listens_for(db.session, 'after_commit')
+def _drop_cache_after_commit(session):
+    if session.info.pop(_CHANGED_KEY, False):
+        settings_service.invalidate()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_changes_after_rollback(session):
+    session.info.pop(_CHANGED_KEY, None)
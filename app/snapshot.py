@@ -0,0 +1,197 @@
+# app/snapshot.py
+"""
+Columnar snapshots of the inventory tables, for backup, restore and seeding.
+
+export_snapshot writes item, item_usage_log and settings to a folder, one
+zstd-compressed Parquet file per table plus manifest.json (schema version and
+row counts). Rows are read and written in batches, so memory stays flat on
+large inventories. import_snapshot empties those tables and loads the files
+back with batched executemany inserts in a single transaction, keeping the
+primary keys so usage log rows still point at their items. The invoice number
+blocks and the processed-file registry are not part of a snapshot, and
+START_INVOICE_NUMBER is restored only through invoice_numbers.set_start_number:
+a snapshot older than the blocks already reserved leaves the current value, so
+no invoice number is issued twice.
+
+pyarrow is pinned in requirements.txt but imported only here, so the rest of the
+application starts without it; SnapshotError explains how to install it when it
+is missing.
+"""
+import json
+import logging
+import os
+from datetime import datetime
+from sqlalchemy import Date, DateTime, Float, Integer, String, Text, delete, func, select
+from sqlalchemy.exc import SQLAlchemyError
+from app.invoice_numbers import set_start_number, InvoiceNumberInUse
+from app.migrations import LATEST_VERSION
+from app.models import InvoiceNumberBlock
+from app.settings_service import replace_version_token, VERSION_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+COMPRESSION = 'zstd'
+# ترتیب درج؛ حذف به ترتیب عکس انجام می‌شود تا کلید خارجی item_usage_log نقض نشود
+SNAPSHOT_TABLES = ('settings', 'item', 'item_usage_log')
+# این تنظیم مستقیماً بازنویسی نمی‌شود؛ فقط از طریق set_start_number و بالاتر از بلوک‌های رزروشده
+START_NUMBER_SETTING = 'START_INVOICE_NUMBER'
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise SnapshotError("Snapshots need pyarrow: pip install -r requirements.txt") from None
+    return pyarrow
+
+
+def _arrow_type(pa, column):
+    column_type = column.type
+    if isinstance(column_type, Integer):
+        return pa.int64()
+    if isinstance(column_type, Float):
+        return pa.float64()
+    if isinstance(column_type, DateTime):
+        return pa.timestamp('us')
+    if isinstance(column_type, Date):
+        return pa.date32()
+    if isinstance(column_type, (String, Text)):
+        return pa.string()
+    raise SnapshotError(f"column {column.table.name}.{column.name} has unsupported type {column_type}")
+
+
+def _arrow_schema(pa, table):
+    return pa.schema([pa.field(column.name, _arrow_type(pa, column), nullable=column.nullable)
+                      for column in table.columns])
+
+
+def _tables(db, names):
+    tables = []
+    for name in names:
+        if name not in SNAPSHOT_TABLES:
+            raise SnapshotError(f"{name} is not a snapshot table ({', '.join(SNAPSHOT_TABLES)})")
+        tables.append(db.metadata.tables[name])
+    return tables
+
+
+def export_snapshot(db, folder, tables=SNAPSHOT_TABLES, batch_size=5000):
+    """
+    Writes the tables to folder/<table>.parquet and the manifest. Returns
+    {table_name: row_count}.
+    """
+    pa = _pyarrow()
+    os.makedirs(folder, exist_ok=True)
+    counts = {}
+    with db.engine.connect() as conn:
+        for table in _tables(db, tables):
+            schema = _arrow_schema(pa, table)
+            path = os.path.join(folder, f'{table.name}.parquet')
+            result = conn.execution_options(yield_per=batch_size).execute(
+                select(table).order_by(*table.primary_key.columns)
+            )
+            count = 0
+            with pa.parquet.ParquetWriter(path, schema, compression=COMPRESSION) as writer:
+                for rows in result.partitions():
+                    columns = list(zip(*rows))
+                    writer.write_batch(pa.RecordBatch.from_arrays(
+                        [pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+                        schema=schema,
+                    ))
+                    count += len(rows)
+            counts[table.name] = count
+            logger.info("Exported %d rows of %s to %s", count, table.name, path)
+
+    with open(os.path.join(folder, MANIFEST), 'w', encoding='utf-8') as handle:
+        json.dump({
+            'schema_version': LATEST_VERSION,
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'compression': COMPRESSION,
+            'tables': counts,
+        }, handle, indent=2)
+    return counts
+
+
+def read_manifest(folder):
+    try:
+        with open(os.path.join(folder, MANIFEST), encoding='utf-8') as handle:
+            return json.load(handle)
+    except (OSError, ValueError) as e:
+        raise SnapshotError(f"{folder} is not a snapshot folder: {e}") from None
+
+
+def import_snapshot(db, folder, batch_size=5000):
+    """
+    Replaces the content of the tables in the snapshot with the snapshot rows, in
+    one transaction. Returns {table_name: row_count}. Raises SnapshotError, with
+    nothing changed, if the files can not be read or the database rejects a row.
+    """
+    pa = _pyarrow()
+    manifest = read_manifest(folder)
+    if manifest.get('schema_version') != LATEST_VERSION:
+        logger.warning("Snapshot schema version %s differs from the database models (%s)",
+                       manifest.get('schema_version'), LATEST_VERSION)
+    names = [name for name in SNAPSHOT_TABLES if name in manifest.get('tables', {})]
+    tables = _tables(db, names)
+
+    files = {}
+    for table in tables:
+        try:
+            parquet_file = pa.parquet.ParquetFile(os.path.join(folder, f'{table.name}.parquet'))
+        except (OSError, pa.ArrowException) as e:
+            raise SnapshotError(f"cannot read {table.name}.parquet: {e}") from None
+        unknown = set(parquet_file.schema_arrow.names) - set(table.columns.keys())
+        if unknown:
+            raise SnapshotError(f"{table.name}.parquet has columns the table does not have: {', '.join(sorted(unknown))}")
+        files[table.name] = parquet_file
+
+    session = db.session
+    counts = {}
+    start_number = None
+    try:
+        for table in reversed(tables):
+            statement = delete(table)
+            if table.name == 'settings':
+                statement = statement.where(table.c.setting_name != START_NUMBER_SETTING)
+            session.execute(statement)
+        for table in tables:
+            count = 0
+            for batch in files[table.name].iter_batches(batch_size=batch_size):
+                rows = batch.to_pylist()
+                count += len(rows)
+                if table.name == 'settings':
+                    start_number = next((row['setting_value'] for row in rows
+                                         if row['setting_name'] == START_NUMBER_SETTING), start_number)
+                    rows = [row for row in rows if row['setting_name'] != START_NUMBER_SETTING]
+                if rows:
+                    session.execute(table.insert(), rows)
+            counts[table.name] = count
+            logger.info("Imported %d rows into %s", count, table.name)
+        if start_number is not None and start_number.strip().isdigit():
+            try:
+                set_start_number(db, InvoiceNumberBlock, int(start_number))
+            except InvoiceNumberInUse as e:
+                logger.warning("Kept the current %s: the snapshot's %s is not above the reserved blocks (%s)",
+                               START_NUMBER_SETTING, start_number.strip(), e)
+        # توکن‌های نسخه بازنویسی می‌شوند تا کش تنظیمات و داشبورد در همه پردازه‌ها باطل شود
+        for setting_name in VERSION_SETTINGS:
+            replace_version_token(session, setting_name)
+        session.commit()
+    except SQLAlchemyError as e:
+        session.rollback()
+        raise SnapshotError(f"import failed and was rolled back: {getattr(e, 'orig', None) or e}") from e
+    except Exception:
+        session.rollback()
+        raise
+    return counts
+
+
+def table_row_counts(db, tables=SNAPSHOT_TABLES):
+    with db.engine.connect() as conn:
+        return {table.name: conn.execute(select(func.count()).select_from(table)).scalar()
+                for table in _tables(db, tables)}
@@ -1,14 +1,26 @@
 # app/utils.py
+import json
 import pandas as pd
 import numpy as np
-import jdatetime
 from datetime import datetime
-from sqlalchemy import func
+from sqlalchemy import func, select, insert, update, bindparam
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import mysql
 import re
 from openpyxl import load_workbook
 import os
+import time
 import logging
-from app.models import Settings
+from itertools import islice
+from app.models import Settings, ProcessedInvoiceFile
+from app import invoice_cache, jalali
+from app.settings_service import (INVENTORY_VALUE_SETTINGS, INVENTORY_VERSION_SETTING,
+                                  replace_version_token, mark_settings_changed)
+from app.allocation import StockAllocator, write_allocations, AllocationConflict
+from app.invoice_numbers import InvoiceNumbersExhausted
+from app.excel_writer import get_template, column_index
+from app.log import LogSampler
+from app.metrics import stage_timer, observe_stage, INVOICE_FILES, INVOICE_ROWS
 
 # دیکشنری مپینگ واحدهای اندازه‌گیری به کدهای عددی
 UNIT_OF_MEASUREMENT_MAPPING = {
@@ -87,7 +99,6 @@ UNIT_OF_MEASUREMENT_MAPPING = {
     'واحد': 1000
 }
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 def extract_number(text):
@@ -104,284 +115,695 @@ def split_name(full_name):
     last_name = parts[1].strip() if len(parts) > 1 else ""
     return first_name, last_name
 
+ITEMS_COLUMN_MAPPING = {
+    'شماره سند': 'document_number',
+    'شماره صورتحساب': 'invoice_number_ref',
+    'تاریخ سند': 'document_date',
+    'فروشنده': 'seller',
+    'استان فروشنده': 'seller_province',
+    'نوع فعالیت': 'activity_type',
+    'مبدا': 'origin',
+    'طبقه کالا': 'item_category',
+    'شرح کالا': 'product_description',
+    'واحداندازه‌گیری': 'unit_of_measurement',
+    'تعداد / مقدار کالا': 'quantity',
+    'مبلغ واحد': 'unit_price',
+    'مبلغ نهایی': 'final_amount',
+    'شناسه کالا': 'product_id',
+    'توضیحات': 'remarks',
+}
+ITEMS_TEXT_FIELDS = [
+    field for field in ITEMS_COLUMN_MAPPING.values()
+    if field not in ('document_date', 'quantity', 'unit_price', 'final_amount')
+]
+ITEMS_FIELDS = list(ITEMS_COLUMN_MAPPING.values())
+ITEMS_EXCEL_COLUMNS = {field: column for column, field in ITEMS_COLUMN_MAPPING.items()}
+
+def _coerce_numeric(values):
+    """
+    Column-wise equivalent of float(value or 0): empty cells become 0 and
+    unparsable cells become NaN so they can be reported.
+    """
+    filled = values.fillna('').astype(str).str.strip()
+    numbers = pd.to_numeric(filled.mask(filled == '', '0'), errors='coerce').astype(float)
+    return numbers.where(np.isfinite(numbers))
+
+def normalize_items_frame(df, first_row_number=2):
+    """
+    Validates and converts a raw items sheet (Excel column names, string cells)
+    with vectorized operations. Returns (items_df, messages); items_df has one row
+    per valid item, model field names as columns and the Excel row number as index.
+    """
+    df = df[list(ITEMS_COLUMN_MAPPING)].rename(columns=ITEMS_COLUMN_MAPPING)
+    df.index = pd.RangeIndex(first_row_number, first_row_number + len(df))
+
+    product_ids = df['product_id']
+    df = df[product_ids.notna() & (product_ids.fillna('') != '')]
+
+    quantity = _coerce_numeric(df['quantity'])
+    unit_price = _coerce_numeric(df['unit_price'])
+    raw_dates = df['document_date'].where(df['document_date'].fillna('') != '')
+    document_date = jalali.series_to_gregorian(raw_dates)
+
+    bad_quantity = quantity.isna()
+    bad_price = unit_price.isna() & ~bad_quantity
+    checked = ~(bad_quantity | bad_price)
+    empty_date = raw_dates.isna() & checked
+    bad_date = raw_dates.notna() & document_date.isna() & checked
+
+    problems = []
+    for field, bad in (('quantity', bad_quantity), ('unit_price', bad_price)):
+        column = ITEMS_EXCEL_COLUMNS[field]
+        for row_number, value in df.loc[bad, field].items():
+            problems.append((row_number, 'danger', f"خطا در پردازش ردیف {row_number} اکسل: مقدار '{str(value).strip()}' در ستون «{column}» عدد معتبر نیست."))
+    for row_number, value in raw_dates[bad_date].items():
+        problems.append((row_number, 'warning', f"ردیف {row_number}: فرمت تاریخ سند '{value}' نامعتبر است و از آن صرف‌نظر شد."))
+    for row_number in raw_dates.index[empty_date]:
+        problems.append((row_number, 'warning', f"ردیف {row_number}: تاریخ سند خالی است و از آن صرف‌نظر شد."))
+    problems.sort(key=lambda problem: problem[0])
+    messages = [(category, message) for _, category, message in problems]
+
+    valid = checked & document_date.notna()
+    items = pd.DataFrame(index=df.index[valid])
+    for field in ITEMS_TEXT_FIELDS:
+        column = df.loc[valid, field].astype(object)
+        items[field] = column.where(column.notna(), None)
+    items['document_date'] = document_date[valid].astype(object)
+    items['quantity'] = np.trunc(quantity[valid]).astype('int64')
+    items['unit_price'] = unit_price[valid]
+    items['final_amount'] = items['quantity'] * items['unit_price']
+    return items[ITEMS_FIELDS], messages
+
+def empty_items_frame():
+    return pd.DataFrame(columns=ITEMS_FIELDS)
+
 def process_items_excel(filepath):
     """
-    Reads an Excel file, processes its rows, and returns a list of item data dictionaries
+    Reads an Excel file and validates it column-wise. Returns a DataFrame with one
+    row per valid item (model field names as columns, Excel row number as index)
     and any validation messages. This function DOES NOT interact with the database.
     """
     messages = []
-    items_to_process = []
-    column_mapping = {
-        'شماره سند': 'document_number',
-        'شماره صورتحساب': 'invoice_number_ref',
-        'تاریخ سند': 'document_date',
-        'فروشنده': 'seller',
-        'استان فروشنده': 'seller_province',
-        'نوع فعالیت': 'activity_type',
-        'مبدا': 'origin',
-        'طبقه کالا': 'item_category',
-        'شرح کالا': 'product_description',
-        'واحداندازه‌گیری': 'unit_of_measurement',
-        'تعداد / مقدار کالا': 'quantity',
-        'مبلغ واحد': 'unit_price',
-        'مبلغ نهایی': 'final_amount',
-        'شناسه کالا': 'product_id',
-        'توضیحات': 'remarks',
-    }
     try:
         df = pd.read_excel(filepath, dtype=str)
         df = df.rename(columns=lambda x: x.strip())
-        df = df.where(pd.notna(df), None)
-        logger.debug(f"Excel columns: {list(df.columns)}")
+        logger.debug("Excel columns: %s", list(df.columns))
 
-        required_excel_columns = set(column_mapping.keys())
+        required_excel_columns = set(ITEMS_COLUMN_MAPPING.keys())
         actual_excel_columns = set(df.columns)
         if not required_excel_columns.issubset(actual_excel_columns):
-            missing = required_excel_columns - actual_excel_columns
+            # به ترتیب ستون‌های الگو، تا پیام در هر دو مسیر خواندن یکسان باشد
+            missing = [column for column in ITEMS_COLUMN_MAPPING if column not in actual_excel_columns]
             messages.append(
                 ('danger', f"فایل اکسل ناقص است. ستون‌های زیر یافت نشدند: {', '.join(missing)}"))
-            return [], messages
+            return empty_items_frame(), messages
 
-        for index, row in df.iterrows():
-            try:
-                product_id = row.get('شناسه کالا')
-                if not product_id:
-                    continue
-                item_data = {}
-                for excel_col, model_field in column_mapping.items():
-                    item_data[model_field] = row.get(excel_col)
-                quantity_str = item_data.get('quantity', '0')
-                item_data['quantity'] = int(float(quantity_str or 0))
-                unit_price_str = item_data.get('unit_price', '0.0')
-                item_data['unit_price'] = float(unit_price_str or 0.0)
-                jalali_date_str = item_data.get('document_date')
-                gregorian_date = None
-                if jalali_date_str:
-                    try:
-                        gregorian_date = jdatetime.datetime.strptime(
-                            str(jalali_date_str), '%Y/%m/%d').togregorian().date()
-                    except (ValueError, TypeError):
-                        messages.append(
-                            ('warning', f"ردیف {index + 2}: فرمت تاریخ سند '{jalali_date_str}' نامعتبر است و از آن صرف‌نظر شد."))
-                        continue
-                if gregorian_date is None:
-                    messages.append(
-                        ('warning', f"ردیف {index + 2}: تاریخ سند خالی است و از آن صرف‌نظر شد."))
-                    continue
-                item_data['document_date'] = gregorian_date
-                item_data['final_amount'] = item_data['quantity'] * item_data['unit_price']
-                items_to_process.append(item_data)
-            except Exception as e:
-                messages.append(
-                    ('danger', f"خطا در پردازش ردیف {index + 2} اکسل: {e}"))
-                continue
+        items_df, row_messages = normalize_items_frame(df)
+        messages.extend(row_messages)
+        return items_df, messages
     except Exception as e:
         messages.append(('danger', f"خطا در خواندن یا پردازش فایل اکسل: {e}"))
-    return items_to_process, messages
+    return empty_items_frame(), messages
+
+class ItemsFileError(Exception):
+    """Raised when a streamed items workbook cannot be read."""
+
+# رشته‌هایی که pd.read_excel به صورت پیش‌فرض (na_values) خالی در نظر می‌گیرد
+EXCEL_NA_STRINGS = frozenset({
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null',
+})
+
+def _excel_value_to_str(value):
+    """Matches what pd.read_excel(dtype=str) produces for a single cell value."""
+    if value is None:
+        return None
+    if isinstance(value, str) and value in EXCEL_NA_STRINGS:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+def iter_items_excel_chunks(filepath, chunk_size=5000):
+    """
+    Streaming counterpart of process_items_excel for .xlsx/.xlsm files. Reads the
+    first sheet row by row in openpyxl read-only mode and yields (items_df, messages)
+    for every chunk_size rows, so memory stays flat regardless of the file size.
+    Raises ItemsFileError if the workbook cannot be read.
+    """
+    try:
+        workbook = load_workbook(filepath, read_only=True, data_only=True)
+    except Exception as e:
+        raise ItemsFileError(f"خطا در خواندن یا پردازش فایل اکسل: {e}") from e
+    try:
+        sheet = workbook.active
+        # ابعاد ثبت‌شده در فایل (<dimension>) ممکن است قدیمی باشد؛ مانند pandas نادیده گرفته می‌شود
+        sheet.reset_dimensions()
+        rows = sheet.iter_rows(values_only=True)
+        header = [str(name).strip() if name is not None else '' for name in next(rows, ())]
+        logger.debug("Excel columns: %s", header)
+
+        missing = [column for column in ITEMS_COLUMN_MAPPING if column not in header]
+        if missing:
+            yield empty_items_frame(), [
+                ('danger', f"فایل اکسل ناقص است. ستون‌های زیر یافت نشدند: {', '.join(missing)}")]
+            return
+
+        excel_columns = list(ITEMS_COLUMN_MAPPING)
+        positions = [header.index(column) for column in excel_columns]
+        first_row_number = 2
+        buffer = []
+        for values in rows:
+            buffer.append([
+                _excel_value_to_str(values[position]) if position < len(values) else None
+                for position in positions
+            ])
+            if len(buffer) >= chunk_size:
+                yield normalize_items_frame(pd.DataFrame(buffer, columns=excel_columns, dtype=object), first_row_number)
+                first_row_number += len(buffer)
+                buffer = []
+        if buffer:
+            yield normalize_items_frame(pd.DataFrame(buffer, columns=excel_columns, dtype=object), first_row_number)
+    except ItemsFileError:
+        raise
+    except Exception as e:
+        raise ItemsFileError(f"خطا در خواندن یا پردازش فایل اکسل: {e}") from e
+    finally:
+        workbook.close()
+
+def merge_duplicate_items(items_df):
+    """
+    Collapses rows that share a product_id, as if they had been applied one after
+    another: quantities are summed and every other field comes from the last row.
+    Adds a 'row_count' column with the number of rows merged into each item.
+    """
+    grouped = items_df.groupby('product_id', sort=False)
+    merged = grouped.nth(-1).set_index('product_id', drop=False)
+    merged['quantity'] = grouped['quantity'].sum()
+    merged['row_count'] = grouped.size()
+    merged['final_amount'] = merged['quantity'] * merged['unit_price']
+    return merged.reset_index(drop=True)
+
+def _chunks(sequence, size):
+    for start in range(0, len(sequence), size):
+        yield sequence[start:start + size]
+
+def bulk_upsert_items(db, Item, items_df, chunk_size=1000):
+    """
+    Writes a validated items DataFrame (see process_items_excel) to the item table.
+    Existing product_ids get their quantity and remaining_quantity increased and
+    their other fields replaced; new ones are inserted. Existing rows are prefetched
+    with chunked IN queries and written with executemany statements (a native
+    INSERT ... ON DUPLICATE KEY UPDATE on MySQL). Does not commit.
+    The prefetch locks the existing rows (SELECT ... FOR UPDATE) until the caller
+    commits, so value_delta is computed from the rows actually overwritten, and
+    they are locked before the caller's apply_inventory_delta takes the value rows.
+    Returns (new_count, updated_count, value_delta, messages).
+    """
+    messages = []
+    invalid = items_df['quantity'] <= 0
+    for product_id in items_df.loc[invalid, 'product_id']:
+        messages.append(('warning', f"مقدار نامعتبر برای کالا با شناسه {product_id}"))
+    valid = items_df[~invalid]
+    if valid.empty:
+        return 0, 0, (0.0, 0.0, 0.0), messages
+
+    merged = merge_duplicate_items(valid)
+    table = Item.__table__
+
+    # ردیف‌های موجود قفل می‌شوند تا تفاضل ارز از همان مقادیری حساب شود که بازنویسی می‌شوند
+    existing = {}
+    for product_ids in _chunks(merged['product_id'].tolist(), chunk_size):
+        rows = db.session.execute(
+            select(table.c.id, table.c.product_id, table.c.quantity, table.c.remaining_quantity, table.c.unit_price)
+            .where(table.c.product_id.in_(product_ids))
+            .with_for_update()
+        ).all()
+        existing.update((row.product_id, row) for row in rows)
+
+    new_rows = []
+    updated_rows = []
+    value_delta = (0.0, 0.0, 0.0)
+    for record in merged.to_dict('records'):
+        added = record.pop('quantity')
+        record.pop('row_count')
+        old = existing.get(record['product_id'])
+        if old is None:
+            record.update(quantity=added, remaining_quantity=added)
+            new_rows.append(record)
+            change = item_inventory_values(record['unit_price'], added, added)
+        else:
+            record.update(b_id=old.id, b_added=added)
+            updated_rows.append(record)
+            change = inventory_values_delta(
+                item_inventory_values(old.unit_price, old.quantity, old.remaining_quantity),
+                item_inventory_values(record['unit_price'], old.quantity + added, old.remaining_quantity + added),
+            )
+        value_delta = tuple(map(sum, zip(value_delta, change)))
+
+    replaced_fields = [field for field in ITEMS_FIELDS if field not in ('product_id', 'quantity', 'final_amount')]
+    dialect_name = db.session.get_bind().dialect.name
+    if dialect_name in ('mysql', 'mariadb'):
+        stmt = mysql.insert(table)
+        # MySQL applies the assignments left to right, so final_amount sees the new quantity
+        stmt = stmt.on_duplicate_key_update([
+            ('quantity', table.c.quantity + stmt.inserted.quantity),
+            ('remaining_quantity', table.c.remaining_quantity + stmt.inserted.remaining_quantity),
+            *[(field, stmt.inserted[field]) for field in replaced_fields],
+            ('final_amount', table.c.quantity * stmt.inserted.unit_price),
+        ])
+        rows = new_rows + [
+            dict({key: value for key, value in record.items() if not key.startswith('b_')},
+                 quantity=record['b_added'], remaining_quantity=record['b_added'])
+            for record in updated_rows
+        ]
+        for chunk in _chunks(rows, chunk_size):
+            db.session.execute(stmt, chunk)
+    else:
+        for chunk in _chunks(new_rows, chunk_size):
+            db.session.execute(insert(table), chunk)
+        stmt = (
+            update(table)
+            .where(table.c.id == bindparam('b_id'))
+            .values(
+                quantity=table.c.quantity + bindparam('b_added'),
+                remaining_quantity=table.c.remaining_quantity + bindparam('b_added'),
+                final_amount=(table.c.quantity + bindparam('b_added')) * bindparam('b_unit_price'),
+                **{field: bindparam(f'b_{field}') for field in replaced_fields},
+            )
+        )
+        for chunk in _chunks(updated_rows, chunk_size):
+            db.session.execute(stmt, [
+                {'b_id': record['b_id'], 'b_added': record['b_added'],
+                 **{f'b_{field}': record[field] for field in replaced_fields}}
+                for record in chunk
+            ])
+
+    new_item_count = len(new_rows)
+    updated_item_count = len(valid) - new_item_count
+    logger.debug("Bulk upsert: %d new items, %d updated rows, value delta %s", new_item_count, updated_item_count, value_delta)
+    return new_item_count, updated_item_count, value_delta, messages
 
 MULTIPLIER_FACTOR = 125000
 
-def process_excel_invoices(filepath, db, Item, ItemUsageLog, current_invoice_number_start):
+INVOICE_CELL_POSITIONS = {
+    "date": (2, 26),
+    "zip_code": (11, 4),
+    "national_id": (9, 16),
+    "buyer_name": (9, 0)
+}
+INVOICE_PRODUCT_COLUMNS = {
+    "quantity": 4,
+    "unit_price": 6,
+    "discount": 12,
+    "product_description": 2
+}
+INVOICE_PRODUCT_START_ROW_INDEX = 15
+
+# ستون‌هایی که خواننده فاکتور لازم دارد؛ ستون‌های بعدی اصلاً خوانده نمی‌شوند
+INVOICE_READ_COLUMNS = max(
+    max(column for _, column in INVOICE_CELL_POSITIONS.values()),
+    max(INVOICE_PRODUCT_COLUMNS.values()),
+) + 1
+
+def _invoice_rows_openpyxl(filepath):
     """
-    Processes an invoice Excel file and assigns exactly one item from Item table
-    with sufficient remaining_quantity to each product, prioritizing highest unit_price.
-    Commits changes to remaining_quantity after each product to ensure up-to-date inventory.
-    Prefers unique items but falls back to previously used items if no new item is available.
-    Uses product description from the invoice in the output.
-    Updates inventory values after processing.
+    Yields the rows of the first sheet as lists of read_excel(dtype=str) style
+    values, limited to the first INVOICE_READ_COLUMNS columns. The workbook is
+    parsed lazily (read-only mode), so nothing after the last row consumed is read.
+    """
+    workbook = load_workbook(filepath, read_only=True, data_only=True)
+    try:
+        sheet = workbook.active
+        # ابعاد ثبت‌شده در فایل (<dimension>) ممکن است قدیمی باشد؛ مانند pandas نادیده گرفته می‌شود
+        sheet.reset_dimensions()
+        for values in sheet.iter_rows(max_col=INVOICE_READ_COLUMNS, values_only=True):
+            yield [_excel_value_to_str(value) for value in values]
+    finally:
+        workbook.close()
+
+def _invoice_rows_pandas(filepath):
+    """Fallback for formats openpyxl cannot read (.xls): the whole sheet through pandas."""
+    df = pd.read_excel(filepath, header=None, dtype=str)
+    for values in df.itertuples(index=False, name=None):
+        yield [None if pd.isna(value) else value for value in values]
+
+def _to_number(value):
+    """
+    pd.to_numeric(value, errors='coerce') as a float, for one cell string of an
+    invoice; the same parser as the column-wise conversions, so every column of a
+    product row accepts the same spellings.
+    """
+    return float(pd.to_numeric(value, errors='coerce'))
+
+def _row_width(values):
+    width = len(values)
+    while width and values[width - 1] is None:
+        width -= 1
+    return width
+
+def read_invoice_file(filepath, filename=None):
+    """
+    Reads the header cells and product rows of an invoice Excel file.
+    Returns (header, required_products, messages); header is None when the file
+    cannot be used at all. Messages name the file as filename (default: the
+    basename of filepath). An invoice without a date is dated today.
+    """
+    header, required_products, messages = _read_invoice_cells(filepath, filename)
+    return _date_undated_invoice(header), required_products, messages
+
+def _date_undated_invoice(header):
+    """Fills today's date into a header read without one (returns a new dict)."""
+    if header is None or header['date_str']:
+        return header
+    return dict(header, date_str=jalali.today())
+
+def _read_invoice_cells(filepath, filename=None):
+    """
+    read_invoice_file without the date fallback: header['date_str'] is '' when
+    the date cell is empty, so the result can be cached and dated when used.
+
+    Only the cells the invoice layout uses are read: .xlsx/.xlsm files are
+    streamed with openpyxl in read-only mode, up to INVOICE_READ_COLUMNS columns
+    and up to the row closing the product block, so the cost follows the number
+    of products rather than the size of the sheet. Other formats are read with
+    pandas. The product block is converted to numbers column-wise.
     """
-    db.session.expire_all()
-    
-    output_data = []
-    log_entries = []
     messages = []
-    next_invoice_number = current_invoice_number_start
     required_products = []
-    used_item_ids = set()
+    filename = filename or os.path.basename(filepath)
+
+    if filepath.lower().endswith(('.xlsx', '.xlsm')):
+        rows = _invoice_rows_openpyxl(filepath)
+    else:
+        rows = _invoice_rows_pandas(filepath)
+
+    CELL_POSITIONS = INVOICE_CELL_POSITIONS
+    PRODUCT_COLUMNS = INVOICE_PRODUCT_COLUMNS
+    PRODUCT_START_ROW_INDEX = INVOICE_PRODUCT_START_ROW_INDEX
 
     try:
-        df = pd.read_excel(filepath, header=None, dtype=str).where(pd.notna, None)
-        logger.debug(f"Excel file {filepath} loaded with shape: {df.shape}")
-
-        CELL_POSITIONS = {
-            "date": (2, 26),
-            "zip_code": (11, 4),
-            "national_id": (9, 16),
-            "buyer_name": (9, 0)
-        }
-        PRODUCT_COLUMNS = {
-            "quantity": 4,
-            "unit_price": 6,
-            "discount": 12,
-            "product_description": 2
-        }
-        PRODUCT_START_ROW_INDEX = 15
-
-        if df.shape[0] < PRODUCT_START_ROW_INDEX or df.shape[1] < max(col for col in CELL_POSITIONS.values())[1] + 1:
-            messages.append(('danger', f"فایل {os.path.basename(filepath)} خیلی کوچک است یا ساختار نادرستی دارد."))
-            return pd.DataFrame(), [], next_invoice_number, messages
+        head = list(islice(rows, PRODUCT_START_ROW_INDEX))
+        width = max((_row_width(values) for values in head), default=0)
+        logger.debug("Excel file %s: %d header rows, %d columns used", filepath, len(head), width)
+        if len(head) < PRODUCT_START_ROW_INDEX or width < max(column for _, column in CELL_POSITIONS.values()) + 1:
+            messages.append(('danger', f"فایل {filename} خیلی کوچک است یا ساختار نادرستی دارد."))
+            return None, [], messages
 
         def get_cell_value(position):
             row, col = position
-            try:
-                return df.iloc[row, col] if row < df.shape[0] and col < df.shape[1] else ""
-            except Exception as e:
-                logger.warning(f"Error accessing cell at {position}: {e}")
-                return ""
+            return head[row][col] if col < len(head[row]) else ""
 
         date_str = get_cell_value(CELL_POSITIONS["date"]) or ""
         zip_code_raw = get_cell_value(CELL_POSITIONS["zip_code"]) or ""
         national_id_raw = get_cell_value(CELL_POSITIONS["national_id"]) or ""
         buyer_name_full = get_cell_value(CELL_POSITIONS["buyer_name"]) or ""
-        
-        zip_code = extract_number(zip_code_raw)
-        national_id = extract_number(national_id_raw)
-        buyer_name, buyer_surname = split_name(buyer_name_full)
-
-        if not date_str:
-            messages.append(('warning', f"تاریخ در فایل {os.path.basename(filepath)} خالی است. از تاریخ فعلی استفاده می‌شود."))
-            date_str = datetime.utcnow().date().strftime('%Y/%m/%d')
-        if not zip_code:
-            messages.append(('warning', f"کد پستی در فایل {os.path.basename(filepath)} خالی است."))
-        if not national_id:
-            messages.append(('warning', f"کد ملی در فایل {os.path.basename(filepath)} خالی است."))
-        if not buyer_name_full:
-            messages.append(('warning', f"نام خریدار در فایل {os.path.basename(filepath)} خالی است."))
-
-        for row_idx in range(PRODUCT_START_ROW_INDEX, df.shape[0]):
-            try:
-                raw_unit_price = df.iloc[row_idx, PRODUCT_COLUMNS["unit_price"]] if PRODUCT_COLUMNS["unit_price"] < df.shape[1] else None
-                unit_price_val = pd.to_numeric(raw_unit_price, errors='coerce')
-                if pd.isna(unit_price_val) or unit_price_val == 0:
-                    break
-
-                raw_quantity = df.iloc[row_idx, PRODUCT_COLUMNS["quantity"]] if PRODUCT_COLUMNS["quantity"] < df.shape[1] else None
-                quantity_val = pd.to_numeric(raw_quantity, errors='coerce')
-                quantity_needed = int(quantity_val) if pd.notna(quantity_val) and quantity_val > 0 else 0
-                if quantity_needed <= 0:
-                    messages.append(('warning', f"مقدار نامعتبر یا صفر برای محصول در ردیف {row_idx + 2}"))
-                    continue
-
-                raw_discount = df.iloc[row_idx, PRODUCT_COLUMNS["discount"]] if PRODUCT_COLUMNS["discount"] < df.shape[1] else None
-                discount_val = pd.to_numeric(raw_discount, errors='coerce')
-                discount = float(discount_val) if pd.notna(discount_val) else 0.0
-
-                product_description_from_invoice = str(df.iloc[row_idx, PRODUCT_COLUMNS["product_description"]] or '').strip() if PRODUCT_COLUMNS["product_description"] < df.shape[1] else ''
-                if not product_description_from_invoice:
-                    messages.append(('warning', f"توضیحات محصول در ردیف {row_idx + 2} خالی است."))
-                    continue
-
-                required_products.append((product_description_from_invoice, quantity_needed, unit_price_val, discount))
-                logger.debug(f"Row {row_idx + 2}: Product Description: {product_description_from_invoice}, Quantity Needed: {quantity_needed}, Unit Price: {unit_price_val}, Discount: {discount}")
-            except Exception as e:
-                logger.warning(f"Error processing row {row_idx + 2} in {filepath}: {e}")
-                continue
 
-        if not required_products:
-            messages.append(('danger', f"هیچ محصول معتبری در فایل {os.path.basename(filepath)} یافت نشد."))
-            return pd.DataFrame(), [], next_invoice_number, messages
-
-        available_items = db.session.query(Item).filter(Item.remaining_quantity > 0).order_by(Item.unit_price.desc()).all()
-        logger.debug(f"تعداد آیتم‌های با موجودی مثبت: {len(available_items)}")
-        for item in available_items:
-            logger.debug(f"Item: {item.product_id}, Remaining Quantity: {item.remaining_quantity}, Unit Price: {item.unit_price}, Description: {item.product_description}")
-
-        at_least_one_product_processed = False
-
-        for product_description_from_invoice, quantity_needed, unit_price_val, discount in required_products:
-            db.session.expire_all()
-            logger.debug(f"Processing product '{product_description_from_invoice}' with quantity_needed={quantity_needed}")
-
-            item_in_db = None
-            for item in db.session.query(Item).filter(
-                Item.remaining_quantity >= quantity_needed,
-                ~Item.id.in_(used_item_ids)
-            ).order_by(Item.unit_price.desc()).all():
-                item_in_db = item
-                break
+        # بلوک محصولات تا اولین ردیفی که مبلغ واحد آن صفر یا نامعتبر است خوانده می‌شود
+        def column(values, name):
+            index = PRODUCT_COLUMNS[name]
+            return values[index] if index < len(values) else None
 
-            if not item_in_db:
-                logger.debug(f"هیچ آیتم جدیدی با موجودی کافی برای '{product_description_from_invoice}' (نیاز: {quantity_needed}) یافت نشد. بررسی آیتم‌های استفاده‌شده...")
-                for item in db.session.query(Item).filter(
-                    Item.remaining_quantity >= quantity_needed
-                ).order_by(Item.unit_price.desc()).all():
-                    item_in_db = item
-                    break
-
-            if not item_in_db:
-                logger.error(f"هیچ آیتمی (جدید یا استفاده‌شده) با موجودی کافی برای '{product_description_from_invoice}' (نیاز: {quantity_needed}) یافت نشد.")
-                logger.debug("همه آیتم‌های موجود در دیتابیس:")
-                for item in db.session.query(Item).all():
-                    logger.debug(f"Item: {item.product_id}, Remaining Quantity: {item.remaining_quantity}, Unit Price: {item.unit_price}, Used: {item.id in used_item_ids}")
-                messages.append(('warning', f"برای '{product_description_from_invoice}' در فایل {os.path.basename(filepath)}، هیچ کالای با موجودی کافی (نیاز: {quantity_needed}) یافت نشد. مقدار صفر تخصیص داده شد."))
-                output_data.append({
-                    'A': date_str, 'B': next_invoice_number, 'C': zip_code, 'D': national_id,
-                    'E': buyer_name, 'F': buyer_surname, 'G': '', 'H': '', 'I': '', 'J': '',
-                    'K': '', 'L': product_description_from_invoice,
-                    'M': '4', 'N': 0, 'O': 'IRR', 'P': 1, 'Q': unit_price_val, 'R': discount, 'S': 0,
-                })
-                continue
-
-            logger.debug(f"برای محصول '{product_description_from_invoice}'، آیتم انتخاب‌شده: {item_in_db.product_id} با موجودی {item_in_db.remaining_quantity} و قیمت واحد {item_in_db.unit_price} (استفاده‌شده: {item_in_db.id in used_item_ids})")
-
-            total_quantity_used = quantity_needed
-            item_in_db.remaining_quantity -= total_quantity_used
-            used_item_ids.add(item_in_db.id)
-
-            item_unit_price = item_in_db.unit_price if item_in_db.unit_price is not None else unit_price_val
-            calculated_vat = (item_unit_price * total_quantity_used) / 10.0
-            unit_of_measurement = item_in_db.unit_of_measurement or 'عدد'
-            unit_code = UNIT_OF_MEASUREMENT_MAPPING.get(unit_of_measurement.strip(), 4)
+        prices, block = [], []
+        for values in rows:
+            unit_price_val = _to_number(column(values, "unit_price"))
+            if np.isnan(unit_price_val) or unit_price_val == 0:
+                break
+            prices.append(unit_price_val)
+            block.append((column(values, "quantity"), column(values, "discount"), column(values, "product_description")))
+    finally:
+        rows.close()
+
+    zip_code = extract_number(zip_code_raw)
+    national_id = extract_number(national_id_raw)
+    buyer_name, buyer_surname = split_name(buyer_name_full)
+
+    if not date_str:
+        messages.append(('warning', f"تاریخ در فایل {filename} خالی است. از تاریخ فعلی استفاده می‌شود."))
+    if not zip_code:
+        messages.append(('warning', f"کد پستی در فایل {filename} خالی است."))
+    if not national_id:
+        messages.append(('warning', f"کد ملی در فایل {filename} خالی است."))
+    if not buyer_name_full:
+        messages.append(('warning', f"نام خریدار در فایل {filename} خالی است."))
+
+    if block:
+        raw_quantities, raw_discounts, descriptions = zip(*block)
+        quantities = pd.to_numeric(pd.Series(raw_quantities, dtype=object), errors='coerce').to_numpy(dtype=float)
+        discounts = pd.to_numeric(pd.Series(raw_discounts, dtype=object), errors='coerce').to_numpy(dtype=float)
+        quantities = np.where(quantities > 0, np.trunc(quantities), 0)
+        discounts = np.nan_to_num(discounts, nan=0.0)
+    else:
+        quantities = discounts = descriptions = ()
+
+    row_log = LogSampler(logger)
+    for offset, (quantity_val, discount, description, unit_price_val) in enumerate(zip(quantities, discounts, descriptions, prices)):
+        row_number = PRODUCT_START_ROW_INDEX + offset + 2
+        quantity_needed = int(quantity_val)
+        if quantity_needed <= 0:
+            messages.append(('warning', f"مقدار نامعتبر یا صفر برای محصول در ردیف {row_number}"))
+            continue
+        product_description_from_invoice = str(description or '').strip()
+        if not product_description_from_invoice:
+            messages.append(('warning', f"توضیحات محصول در ردیف {row_number} خالی است."))
+            continue
+
+        required_products.append((product_description_from_invoice, quantity_needed, unit_price_val, float(discount)))
+        row_log.debug("Row %d: Product Description: %s, Quantity Needed: %d, Unit Price: %s, Discount: %s",
+                      row_number, product_description_from_invoice, quantity_needed, unit_price_val, discount)
+    row_log.summary('invoice row')
+
+    header = {
+        'date_str': date_str,
+        'zip_code': zip_code,
+        'national_id': national_id,
+        'buyer_name': buyer_name,
+        'buyer_surname': buyer_surname,
+    }
+    return header, required_products, messages
 
+def read_invoice_file_cached(filepath, content_hash=None, filename=None):
+    """
+    read_invoice_file through the parsed-result cache of app.invoice_cache when the
+    content hash of the file is known. Only usable results are cached; a result
+    cached under another file name is parsed again, since its messages name the file.
+    The cache keeps the date cell as read, so an undated invoice is dated on the
+    day it is used, not on the day it was first parsed.
+    """
+    filename = filename or os.path.basename(filepath)
+    cached = invoice_cache.get_parsed(content_hash, filename) if content_hash else None
+    if cached is not None:
+        header, required_products, messages = cached
+    else:
+        header, required_products, messages = _read_invoice_cells(filepath, filename)
+        if content_hash and header is not None:
+            invoice_cache.put_parsed(content_hash, filename, header, required_products, messages)
+    return _date_undated_invoice(header), required_products, messages
+
+def already_processed_message(entry, filename):
+    return ('warning', f"فایل {filename} قبلاً با شماره فاکتور {entry.invoice_number} پردازش شده است و موجودی دوباره کسر نشد.")
+
+def allocate_invoice(header, required_products, allocator, invoice_number, filename):
+    """
+    Assigns one item from the allocator snapshot to each product of an invoice.
+    Returns (output_rows, usages, messages) where usages is a list of
+    (item_id, quantity_used, price_at_usage). Nothing is written to the database.
+    """
+    output_data = []
+    usages = []
+    messages = []
+    date_str = header['date_str']
+    allocator.start_invoice()
+    row_log = LogSampler(logger)
+
+    for product_description_from_invoice, quantity_needed, unit_price_val, discount in required_products:
+
+        index = allocator.pick(quantity_needed)
+        if index is None:
+            # به جای چاپ کل جدول، خلاصه‌ای با اندازه ثابت از وضعیت موجودی ثبت می‌شود
+            logger.warning("هیچ آیتمی (جدید یا استفاده‌شده) با موجودی کافی برای '%s' (نیاز: %d) یافت نشد. %s",
+                           product_description_from_invoice, quantity_needed, allocator.describe())
+            messages.append(('warning', f"برای '{product_description_from_invoice}' در فایل {filename}، هیچ کالای با موجودی کافی (نیاز: {quantity_needed}) یافت نشد. مقدار صفر تخصیص داده شد."))
             output_data.append({
-                'A': date_str, 'B': next_invoice_number, 'C': zip_code, 'D': national_id,
-                'E': buyer_name, 'F': buyer_surname, 'G': '', 'H': '', 'I': '', 'J': '',
-                'K': item_in_db.product_id, 'L': product_description_from_invoice,
-                'M': unit_code, 'N': total_quantity_used,
-                'O': 'IRR', 'P': 1, 'Q': item_unit_price, 'R': discount, 'S': calculated_vat,
+                'A': date_str, 'B': invoice_number, 'C': header['zip_code'], 'D': header['national_id'],
+                'E': header['buyer_name'], 'F': header['buyer_surname'], 'G': '', 'H': '', 'I': '', 'J': '',
+                'K': '', 'L': product_description_from_invoice,
+                'M': '4', 'N': 0, 'O': 'IRR', 'P': 1, 'Q': unit_price_val, 'R': discount, 'S': 0,
             })
+            continue
+
+        total_quantity_used = quantity_needed
+        item = allocator.take(index, total_quantity_used)
+        row_log.debug("برای محصول '%s' (نیاز: %d)، آیتم انتخاب‌شده: %s با موجودی %d و قیمت واحد %s",
+                      product_description_from_invoice, quantity_needed, item.product_id, allocator.remaining_of(index), item.unit_price)
+
+        item_unit_price = item.unit_price if item.unit_price is not None else unit_price_val
+        calculated_vat = (item_unit_price * total_quantity_used) / 10.0
+        unit_of_measurement = item.unit_of_measurement or 'عدد'
+        unit_code = UNIT_OF_MEASUREMENT_MAPPING.get(unit_of_measurement.strip(), 4)
+
+        output_data.append({
+            'A': date_str, 'B': invoice_number, 'C': header['zip_code'], 'D': header['national_id'],
+            'E': header['buyer_name'], 'F': header['buyer_surname'], 'G': '', 'H': '', 'I': '', 'J': '',
+            'K': item.product_id, 'L': product_description_from_invoice,
+            'M': unit_code, 'N': total_quantity_used,
+            'O': 'IRR', 'P': 1, 'Q': item_unit_price, 'R': discount, 'S': calculated_vat,
+        })
+        usages.append((item.id, total_quantity_used, item_unit_price))
+
+    row_log.summary('allocation')
+    return output_data, usages, messages
+
+def process_excel_invoices(filepath, db, Item, ItemUsageLog, invoice_numbers, retries=3, content_hash=None, job_id=None,
+                           filename=None):
+    """
+    Processes an invoice Excel file and assigns exactly one item from Item table
+    with sufficient remaining_quantity to each product, prioritizing highest unit_price.
+    Candidate stock is loaded once and allocated in memory; all remaining_quantity
+    decrements and ItemUsageLog rows are written in a single transaction per file.
+    Prefers unique items but falls back to previously used items if no new item is available.
+    Uses product description from the invoice in the output.
+    Inventory values are updated by delta in the same transaction.
+
+    Safe to run concurrently with other uploads: the decrements are guarded against
+    the current stock (see write_allocations) and, if another transaction took the
+    stock first, the snapshot is reloaded and the file allocated again, up to
+    `retries` times. The invoice number is taken from invoice_numbers (an
+    app.invoice_numbers.InvoiceNumberAllocator) in the same transaction; if the
+    block is used up, InvoiceNumbersExhausted is raised after a rollback instead
+    of being reported as a file error.
+
+    With the content_hash of the file, the parsed result is cached and the file is
+    registered in ProcessedInvoiceFile in the same transaction as well, together
+    with its output rows, so the same content is never allocated twice, even by
+    concurrent uploads, and its output can always be rendered again.
+    filename is the name the user uploaded the file under (default: the basename
+    of filepath); it is used in the messages and in the registry.
+    Returns (output_df, log_entries, invoice_number, messages); invoice_number is
+    None when nothing was written.
+    """
+    messages = []
+    filename = filename or os.path.basename(filepath)
 
-            pd_exit_date = pd.to_datetime(date_str, errors='coerce')
-            exit_date_obj = pd_exit_date.date() if pd.notna(pd_exit_date) else datetime.utcnow().date()
-            log_entries.append(ItemUsageLog(
-                item_id=item_in_db.id,
-                exit_date=exit_date_obj,
-                invoice_number_used=str(next_invoice_number),
-                quantity_used=total_quantity_used,
-                price_at_usage=item_unit_price
-            ))
+    try:
+        if content_hash:
+            entry = db.session.get(ProcessedInvoiceFile, content_hash)
+            if entry is not None:
+                messages.append(already_processed_message(entry, filename))
+                return pd.DataFrame(), [], None, messages
+
+        with stage_timer('invoice', 'parse'):
+            header, required_products, read_messages = read_invoice_file_cached(filepath, content_hash, filename)
+        messages.extend(read_messages)
+        if header is None:
+            INVOICE_FILES.inc(result='failed')
+            return pd.DataFrame(), [], None, messages
 
+        if not required_products:
+            messages.append(('danger', f"هیچ محصول معتبری در فایل {filename} یافت نشد."))
+            INVOICE_FILES.inc(result='failed')
+            return pd.DataFrame(), [], None, messages
+
+        # تاریخ فاکتور شمسی است و به تاریخ میلادی خروج تبدیل می‌شود
+        exit_date_obj = jalali.to_gregorian(header['date_str'])
+        if exit_date_obj is None:
+            messages.append(('warning', f"تاریخ '{header['date_str']}' در فایل {filename} نامعتبر است. تاریخ امروز به عنوان تاریخ خروج ثبت شد."))
+            exit_date_obj = datetime.utcnow().date()
+
+        for attempt in range(1, retries + 1):
+            with stage_timer('invoice', 'load_stock'):
+                allocator = StockAllocator.from_db(db, Item)
+            logger.debug("تعداد آیتم‌های با موجودی مثبت: %d", len(allocator))
+
+            # شماره فاکتور پس از ثبت موفق تخصیص رزرو و در سطرها قرار داده می‌شود
+            with stage_timer('invoice', 'allocate'):
+                output_data, usages, allocation_messages = allocate_invoice(
+                    header, required_products, allocator, None, filename
+                )
+
+            if not usages:
+                messages.extend(allocation_messages)
+                messages.append(('danger', f"هیچ محصولی در فایل {filename} قابل پردازش نبود."))
+                INVOICE_FILES.inc(result='failed')
+                return pd.DataFrame(), [], None, messages
+
+            allocated_value = sum(quantity_used * price_at_usage for _, quantity_used, price_at_usage in usages)
             try:
-                db.session.add(item_in_db)
+                # زمان نوشتن و commit بدون زمان محاسبه ارز در مرحله commit ثبت می‌شود
+                write_started = time.perf_counter()
+                write_allocations(db, Item, allocator.allocated)
+                invoice_number = invoice_numbers.take()
+                for row in output_data:
+                    row['B'] = invoice_number
+                log_entries = [
+                    ItemUsageLog(
+                        item_id=item_id,
+                        exit_date=exit_date_obj,
+                        invoice_number_used=str(invoice_number),
+                        quantity_used=quantity_used,
+                        price_at_usage=price_at_usage
+                    )
+                    for item_id, quantity_used, price_at_usage in usages
+                ]
+                db.session.add_all(log_entries)
+                if content_hash:
+                    # سطرهای خروجی هم ثبت می‌شوند تا اگر فایل خروجی ساخته یا نگه داشته نشد، دوباره ساخته شود
+                    db.session.add(ProcessedInvoiceFile(
+                        content_hash=content_hash, filename=filename, invoice_number=invoice_number, job_id=job_id,
+                        output_json=json.dumps(output_data, ensure_ascii=False, default=invoice_cache.json_default),
+                    ))
+                write_seconds = time.perf_counter() - write_started
+                # ردیف‌های ارز بین همه تخصیص‌ها مشترک‌اند و تا commit قفل می‌مانند؛ پس آخرین نوشتن تراکنش هستند
+                with stage_timer('invoice', 'valuation'):
+                    initial_value, remaining_value, used_value = apply_inventory_delta(
+                        db, Item, Settings, (0.0, -allocated_value, allocated_value)
+                    )
+                commit_started = time.perf_counter()
                 db.session.commit()
-                logger.debug(f"Committed changes for item {item_in_db.product_id}: new remaining_quantity={item_in_db.remaining_quantity}")
-                # محاسبه و به‌روزرسانی مقادیر ارز پس از هر تخصیص
-                initial_value, remaining_value, used_value = calculate_inventory_values(db, Item, Settings)
-                logger.debug(f"Updated inventory values after processing '{product_description_from_invoice}': Initial={initial_value}, Remaining={remaining_value}, Used={used_value}")
+                observe_stage('invoice', 'commit', write_seconds + time.perf_counter() - commit_started)
+                logger.debug("Committed %d item decrements and %d usage logs for %s", len(allocator.allocated), len(log_entries), filename)
+                break
+            except AllocationConflict as e:
+                db.session.rollback()
+                logger.info("Allocation conflict for %s (attempt %d of %d): %s", filename, attempt, retries, e)
+            except IntegrityError:
+                db.session.rollback()
+                entry = db.session.get(ProcessedInvoiceFile, content_hash) if content_hash else None
+                if entry is None:
+                    raise
+                # همین فایل هم‌زمان در پردازش دیگری ثبت شد؛ تخصیص این پردازش برگشت خورد
+                messages.append(already_processed_message(entry, filename))
+                return pd.DataFrame(), [], None, messages
+            except InvoiceNumbersExhausted:
+                db.session.rollback()
+                raise
             except Exception as e:
                 db.session.rollback()
-                logger.error(f"Error committing changes for item {item_in_db.product_id}: {str(e)}")
-                messages.append(('danger', f"خطا در به‌روزرسانی موجودی برای '{product_description_from_invoice}': {str(e)}"))
-                continue
-
-            at_least_one_product_processed = True
-
-        if at_least_one_product_processed:
-            next_invoice_number += 1
-            db.session.commit()
-            initial_value, remaining_value, used_value = calculate_inventory_values(db, Item, Settings)
-            messages.append(('success', f"فایل {os.path.basename(filepath)} با موفقیت پردازش شد. ارز اولیه: {initial_value:,.2f}, ارز باقیمانده: {remaining_value:,.2f}, ارز مصرف‌شده: {used_value:,.2f}"))
+                logger.error("Error committing allocations for %s: %s", filename, e)
+                messages.append(('danger', f"خطا در به‌روزرسانی موجودی برای فایل {filename}: {str(e)}"))
+                INVOICE_FILES.inc(result='failed')
+                return pd.DataFrame(), [], None, messages
         else:
-            messages.append(('danger', f"هیچ محصولی در فایل {os.path.basename(filepath)} قابل پردازش نبود."))
-            return pd.DataFrame(), [], next_invoice_number, messages
-
+            messages.append(('danger', f"موجودی کالاهای فایل {filename} هم‌زمان توسط پردازش دیگری تغییر کرد و پس از {retries} تلاش ثبت نشد. لطفاً دوباره تلاش کنید."))
+            INVOICE_FILES.inc(result='failed')
+            return pd.DataFrame(), [], None, messages
+
+        messages.extend(allocation_messages)
+        INVOICE_FILES.inc(result='processed')
+        INVOICE_ROWS.inc(len(usages))
+        messages.append(('success', f"فایل {filename} با شماره فاکتور {invoice_number} با موفقیت پردازش شد. ارز اولیه: {initial_value:,.2f}, ارز باقیمانده: {remaining_value:,.2f}, ارز مصرف‌شده: {used_value:,.2f}"))
+
+    except InvoiceNumbersExhausted:
+        INVOICE_FILES.inc(result='failed')
+        raise
     except Exception as e:
-        logger.error(f"Error processing {filepath}: {str(e)}")
-        messages.append(('danger', f"خطا در پردازش فایل {os.path.basename(filepath)}: {str(e)}"))
+        logger.error("Error processing %s: %s", filepath, e)
+        messages.append(('danger', f"خطا در پردازش فایل {filename}: {str(e)}"))
         db.session.rollback()
-        return pd.DataFrame(), [], next_invoice_number, messages
+        INVOICE_FILES.inc(result='failed')
+        return pd.DataFrame(), [], None, messages
 
-    return pd.DataFrame(output_data), log_entries, next_invoice_number, messages
+    return pd.DataFrame(output_data), log_entries, invoice_number, messages
 
 def generate_sjt_output_excel(data_df, template_path, output_path):
     try:
@@ -389,37 +811,21 @@ def generate_sjt_output_excel(data_df, template_path, output_path):
             raise FileNotFoundError(f"فایل الگو در مسیر زیر یافت نشد: {template_path}")
         df = data_df.copy()
 
-        logger.debug(f"Before multiplier - Q: {df['Q'].values if 'Q' in df else 'Not found'}, S: {df['S'].values if 'S' in df else 'Not found'}")
-
         if 'Q' in df.columns:
             df['Q'] = pd.to_numeric(df['Q'], errors='coerce') * MULTIPLIER_FACTOR
         if 'S' in df.columns:
             df['S'] = pd.to_numeric(df['S'], errors='coerce') * MULTIPLIER_FACTOR
 
-        logger.debug(f"After multiplier - Q: {df['Q'].values if 'Q' in df else 'Not found'}, S: {df['S'].values if 'S' in df else 'Not found'}")
-
-        book = load_workbook(template_path, keep_vba=True)
-        sheet = book.active
-
-        merged_ranges = list(sheet.merged_cells.ranges)
-        for merged_range in merged_ranges:
-            sheet.unmerge_cells(str(merged_range))
-        
-        start_row = 2
-        for row in sheet.iter_rows(min_row=start_row, max_row=sheet.max_row):
-            for cell in row:
-                cell.value = None
-        
-        for index, row_data in df.iterrows():
-            current_write_row = start_row + index
-            for col_name, value in row_data.items():
-                col_index = ord(col_name) - ord('A') + 1
-                cell = sheet.cell(row=current_write_row, column=col_index, value=value)
-        
-        book.save(output_path)
+        logger.debug("Rendering %d rows to %s", len(df), output_path)
+
+        # الگو یک بار در هر پروسس خوانده می‌شود و فقط XML شیت فعال بازنویسی می‌شود
+        template = get_template(template_path)
+        columns = [column_index(col_name) for col_name in df.columns]
+        rows = [list(zip(columns, values)) for values in df.itertuples(index=False, name=None)]
+        template.write(rows, output_path, start_row=2)
         return output_path, None
     except Exception as e:
-        logger.error(f"Error generating Excel: {str(e)}")
+        logger.error("Error generating Excel: %s", e)
         return None, str(e)
 
 def generate_usage_log_excel(data_df, output_path):
@@ -429,44 +835,122 @@ def generate_usage_log_excel(data_df, output_path):
     except Exception as e:
         return None, str(e)
 
+
+def item_inventory_values(unit_price, quantity, remaining_quantity):
+    """Returns the (initial, remaining, used) value one item contributes to the inventory."""
+    unit_price = float(unit_price or 0)
+    quantity = quantity or 0
+    remaining_quantity = remaining_quantity or 0
+    return (
+        unit_price * quantity,
+        unit_price * remaining_quantity,
+        unit_price * (quantity - remaining_quantity),
+    )
+
+def inventory_values_delta(before, after):
+    """Difference between two (initial, remaining, used) tuples."""
+    return tuple(new - old for old, new in zip(before, after))
+
+def bump_inventory_version(db, Settings):
+    """
+    Replaces the inventory version token inside the current transaction, so every
+    process drops its cached inventory views once the write commits. Does not commit.
+    """
+    return replace_version_token(db.session, INVENTORY_VERSION_SETTING)
+
+def _lock_inventory_values(Settings):
+    """The stored value rows, locked (SELECT ... FOR UPDATE, by name) until the transaction ends."""
+    return (Settings.query.filter(Settings.setting_name.in_(INVENTORY_VALUE_SETTINGS))
+            .order_by(Settings.setting_name).with_for_update().populate_existing().all())
+
+def _store_inventory_values(db, Settings, values):
+    # همان ترتیب قفل apply_inventory_delta: ابتدا ردیف‌های ارز و سپس ردیف نسخه، تا بن‌بست رخ ندهد
+    settings = dict(zip(INVENTORY_VALUE_SETTINGS, (str(value) for value in values)))
+    existing = _lock_inventory_values(Settings)
+    for setting in existing:
+        setting.setting_value = settings.pop(setting.setting_name)
+    for setting_name, setting_value in settings.items():
+        db.session.add(Settings(setting_name=setting_name, setting_value=setting_value))
+    db.session.flush()
+    mark_settings_changed(db.session)
+    bump_inventory_version(db, Settings)
+
+def get_inventory_values(Settings):
+    """Reads the stored (initial, remaining, used) values with a single query."""
+    rows = Settings.query.filter(Settings.setting_name.in_(INVENTORY_VALUE_SETTINGS)).all()
+    by_name = {row.setting_name: row.setting_value for row in rows}
+    return tuple(float(by_name.get(name) or 0) for name in INVENTORY_VALUE_SETTINGS)
+
+def apply_inventory_delta(db, Item, Settings, delta):
+    """
+    Adds an (initial, remaining, used) delta to the stored inventory values inside
+    the current transaction and returns the new totals. The value rows are locked
+    (SELECT ... FOR UPDATE) until the transaction ends. Does not commit.
+    If the values have never been stored, they are computed once from the Item table.
+
+    Every writer locks the same three rows, so concurrent allocations (and item
+    edits) serialize here from this call until their commit, even when they touch
+    different items. Callers therefore make it the last statement before commit.
+    The value rows are locked before the inventory version row, here and in the
+    full reconcile (calculate_inventory_values), so the two can not deadlock.
+    """
+    # ردیف‌های ارز تا پایان تراکنش قفل می‌شوند تا به‌روزرسانی‌های هم‌زمان یکدیگر را بازنویسی نکنند
+    rows = _lock_inventory_values(Settings)
+    if len(rows) < len(INVENTORY_VALUE_SETTINGS):
+        db.session.flush()
+        values = _sum_inventory_values(db, Item)
+        _store_inventory_values(db, Settings, values)
+        return values
+
+    by_name = {row.setting_name: row for row in rows}
+    values = []
+    for setting_name, change in zip(INVENTORY_VALUE_SETTINGS, delta):
+        setting = by_name[setting_name]
+        value = float(setting.setting_value or 0) + change
+        setting.setting_value = str(value)
+        values.append(value)
+    db.session.flush()
+    bump_inventory_version(db, Settings)
+    logger.debug("Applied inventory delta %s: Initial=%s, Remaining=%s, Used=%s", delta, *values)
+    return tuple(values)
+
+def _sum_inventory_values(db, Item):
+    results = db.session.query(
+        func.sum(Item.unit_price * Item.quantity).label('initial_value'),
+        func.sum(Item.unit_price * Item.remaining_quantity).label('remaining_value'),
+        func.sum(Item.unit_price * (Item.quantity - Item.remaining_quantity)).label('used_value')
+    ).one()
+    return (
+        float(results.initial_value or 0),
+        float(results.remaining_value or 0),
+        float(results.used_value or 0),
+    )
+
 def calculate_inventory_values(db, Item, Settings):
     """
-    Calculates initial, used, and remaining inventory values based on Item table.
-    Updates these values in the Settings table.
+    Full reconcile: calculates initial, used, and remaining inventory values from
+    the whole Item table and stores them in the Settings table. Write paths keep the
+    values up to date with apply_inventory_delta; this is only needed to repair drift.
+    A database error is raised after a rollback, so nothing is stored.
+
+    The value rows are locked before the SUM runs, so an allocation either commits
+    before it (and is counted) or waits and applies its delta to the new values.
+    Call it at the start of a transaction: on MySQL the SUM must not read from a
+    snapshot taken by an earlier query.
     """
     try:
-        results = db.session.query(
-            func.sum(Item.unit_price * Item.quantity).label('initial_value'),
-            func.sum(Item.unit_price * Item.remaining_quantity).label('remaining_value'),
-            func.sum(Item.unit_price * (Item.quantity - Item.remaining_quantity)).label('used_value')
-        ).one()
-
-        initial_value = float(results.initial_value or 0)
-        remaining_value = float(results.remaining_value or 0)
-        used_value = float(results.used_value or 0)
-
-        logger.debug(f"Calculated inventory values: Initial={initial_value}, Remaining={remaining_value}, Used={used_value}")
-
-        settings = {
-            'INITIAL_INVENTORY_VALUE': str(initial_value),
-            'REMAINING_INVENTORY_VALUE': str(remaining_value),
-            'USED_INVENTORY_VALUE': str(used_value)
-        }
-
-        for setting_name, setting_value in settings.items():
-            setting = Settings.query.filter_by(setting_name=setting_name).first()
-            if setting:
-                setting.setting_value = setting_value
-            else:
-                setting = Settings(setting_name=setting_name, setting_value=setting_value)
-                db.session.add(setting)
+        # قفل پیش از SUM گرفته می‌شود؛ وگرنه تخصیصی که در این فاصله ثبت شود با مقدار کهنه بازنویسی می‌شد
+        _lock_inventory_values(Settings)
+        initial_value, remaining_value, used_value = _sum_inventory_values(db, Item)
+        logger.debug("Calculated inventory values: Initial=%s, Remaining=%s, Used=%s", initial_value, remaining_value, used_value)
 
+        _store_inventory_values(db, Settings, (initial_value, remaining_value, used_value))
         db.session.commit()
         logger.debug("Inventory values updated in Settings table.")
 
         return initial_value, remaining_value, used_value
 
     except Exception as e:
-        logger.error(f"Error calculating inventory values: {str(e)}")
+        logger.error("Error calculating inventory values: %s", e)
         db.session.rollback()
-        return 0, 0, 0
\ No newline at end of file
+        raise
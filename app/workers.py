@@ -0,0 +1,83 @@
+# app/workers.py
+import atexit
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from app.utils import generate_sjt_output_excel
+from app.metrics import observe_stage
+
+logger = logging.getLogger(__name__)
+
+_output_pool = None
+_output_pool_size = 0
+_output_pool_lock = threading.Lock()
+
+
+def _get_output_pool(max_workers):
+    global _output_pool, _output_pool_size
+    with _output_pool_lock:
+        if _output_pool is None or _output_pool_size != max_workers:
+            if _output_pool is not None:
+                _output_pool.shutdown(wait=False)
+            # spawn: the workers must not inherit DB connections or threads of the web process
+            _output_pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+            _output_pool_size = max_workers
+        return _output_pool
+
+
+def _discard_output_pool():
+    global _output_pool
+    with _output_pool_lock:
+        if _output_pool is not None:
+            _output_pool.shutdown(wait=False)
+            _output_pool = None
+
+
+def _render_timed(data_df, template_path, output_path):
+    """Runs in the pool process; the duration is sent back so the parent can record it."""
+    start = time.perf_counter()
+    result = generate_sjt_output_excel(data_df, template_path, output_path)
+    return result, time.perf_counter() - start
+
+
+def _render_inline(data_df, template_path, output_path):
+    future = Future()
+    future.set_result(_render_timed(data_df, template_path, output_path))
+    return future
+
+
+def submit_output(data_df, template_path, output_path, max_workers):
+    """
+    Queues generate_sjt_output_excel on the shared process pool and returns a Future
+    resolving to (output_path, error). With max_workers <= 1 the file is rendered
+    in the calling process.
+    """
+    if max_workers <= 1:
+        return _render_inline(data_df, template_path, output_path)
+    try:
+        return _get_output_pool(max_workers).submit(_render_timed, data_df, template_path, output_path)
+    except (BrokenProcessPool, RuntimeError) as e:
+        logger.warning("Output pool unavailable (%s); rendering %s in process", e, output_path)
+        _discard_output_pool()
+        return _render_inline(data_df, template_path, output_path)
+
+
+def output_result(future):
+    """Waits for a Future from submit_output and returns (output_path, error)."""
+    try:
+        result, seconds = future.result()
+    except BrokenProcessPool as e:
+        _discard_output_pool()
+        return None, str(e)
+    except Exception as e:
+        # مانند generate_sjt_output_excel، خطای هر فایل فقط به همان فایل برگردانده می‌شود
+        logger.error("Output rendering failed: %s", e)
+        return None, str(e) or type(e).__name__
+    observe_stage('invoice', 'render', seconds)
+    return result
+
+
+atexit.register(_discard_output_pool)
@@ -0,0 +1,113 @@
+# benchmarks/generate.py
+"""
+Synthetic workbooks for the benchmarks, in the layouts the application reads:
+items files as expected by process_items_excel / iter_items_excel_chunks and
+invoice files with the fixed cell layout of read_invoice_file.
+Everything is generated from a seed, so the same arguments give the same files.
+"""
+import random
+from openpyxl import Workbook
+from app.utils import (ITEMS_COLUMN_MAPPING, INVOICE_CELL_POSITIONS, INVOICE_PRODUCT_COLUMNS,
+                       INVOICE_PRODUCT_START_ROW_INDEX)
+
+SELLERS = ['بازرگانی آریا', 'شرکت پارس تجارت', 'فروشگاه نوین', 'صنایع البرز', 'تجارت گستر شرق', 'پخش سپهر']
+PROVINCES = ['تهران', 'اصفهان', 'خراسان رضوی', 'فارس', 'آذربایجان شرقی', 'خوزستان']
+ACTIVITY_TYPES = ['بازرگانی', 'تولیدی', 'خدماتی']
+ORIGINS = ['داخلی', 'وارداتی']
+CATEGORIES = ['لوازم الکترونیکی', 'مواد غذایی', 'پوشاک', 'لوازم خانگی', 'قطعات یدکی', 'لوازم اداری']
+PRODUCTS = ['کابل شبکه', 'برنج ایرانی', 'پیراهن مردانه', 'یخچال', 'لنت ترمز', 'کاغذ A4', 'لامپ LED',
+            'روغن مایع', 'کفش ورزشی', 'جاروبرقی', 'فیلتر روغن', 'خودکار آبی']
+UNITS = ['عدد', 'کیلوگرم', 'متر', 'بسته', 'جفت', 'کارتن']
+FIRST_NAMES = ['علی', 'محمد', 'زهرا', 'فاطمه', 'حسین', 'مریم']
+LAST_NAMES = ['رضایی', 'محمدی', 'حسینی', 'کریمی', 'احمدی', 'موسوی']
+
+
+def items_rows(count, seed=1):
+    """Yields items rows (lists of cell strings in ITEMS_COLUMN_MAPPING order)."""
+    rng = random.Random(seed)
+    for index in range(count):
+        quantity = rng.randint(1, 500)
+        unit_price = rng.randint(10, 50000) * 100
+        values = {
+            'document_number': str(10000 + index),
+            'invoice_number_ref': f'INV-{rng.randint(100000, 999999)}',
+            'document_date': f'14{rng.randint(1, 3):02d}/{rng.randint(1, 12):02d}/{rng.randint(1, 29):02d}',
+            'seller': rng.choice(SELLERS),
+            'seller_province': rng.choice(PROVINCES),
+            'activity_type': rng.choice(ACTIVITY_TYPES),
+            'origin': rng.choice(ORIGINS),
+            'item_category': rng.choice(CATEGORIES),
+            'product_description': f'{rng.choice(PRODUCTS)} مدل {rng.randint(1, 999)}',
+            'unit_of_measurement': rng.choice(UNITS),
+            'quantity': str(quantity),
+            'unit_price': str(unit_price),
+            'final_amount': str(quantity * unit_price),
+            'product_id': f'2{index:012d}',
+            'remarks': '' if rng.random() < 0.8 else 'ارسال فوری',
+        }
+        yield [values[field] for field in ITEMS_COLUMN_MAPPING.values()]
+
+
+def make_items_workbook(path, count, seed=1):
+    """Writes an items workbook with the Persian header row and count data rows."""
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(list(ITEMS_COLUMN_MAPPING))
+    for row in items_rows(count, seed):
+        sheet.append(row)
+    workbook.save(path)
+    return path
+
+
+def invoice_products(count, seed=1, max_quantity=5):
+    """Returns count (description, quantity, unit_price, discount) tuples."""
+    rng = random.Random(seed)
+    return [
+        (f'{rng.choice(PRODUCTS)} سری {rng.randint(1, 99)}', rng.randint(1, max_quantity),
+         rng.randint(10, 5000) * 1000, rng.choice([0, 0, 0, 5000]))
+        for _ in range(count)
+    ]
+
+
+def make_invoice_workbook(path, products, date='1403/05/10', seed=1):
+    """
+    Writes one invoice in the layout read_invoice_file expects: header cells at
+    INVOICE_CELL_POSITIONS, product rows from INVOICE_PRODUCT_START_ROW_INDEX and a
+    zero unit price closing the product block.
+    """
+    rng = random.Random(seed)
+    width = max(column for _, column in INVOICE_CELL_POSITIONS.values()) + 1
+    header_cells = {
+        INVOICE_CELL_POSITIONS['date']: date,
+        INVOICE_CELL_POSITIONS['buyer_name']: f'خریدار: {rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+        INVOICE_CELL_POSITIONS['national_id']: f'کد ملی: {rng.randint(10 ** 9, 10 ** 10 - 1):010d}',
+        INVOICE_CELL_POSITIONS['zip_code']: f'کد پستی {rng.randint(10 ** 9, 10 ** 10 - 1)}',
+    }
+    # read_invoice_file reads with header=None, so sheet row r is DataFrame row r - 1
+    grid = [[None] * width for _ in range(INVOICE_PRODUCT_START_ROW_INDEX + len(products) + 1)]
+    for (row, column), value in header_cells.items():
+        grid[row][column] = value
+    for offset, (description, quantity, unit_price, discount) in enumerate(products):
+        row = grid[INVOICE_PRODUCT_START_ROW_INDEX + offset]
+        row[INVOICE_PRODUCT_COLUMNS['product_description']] = description
+        row[INVOICE_PRODUCT_COLUMNS['quantity']] = quantity
+        row[INVOICE_PRODUCT_COLUMNS['unit_price']] = unit_price
+        row[INVOICE_PRODUCT_COLUMNS['discount']] = discount
+    grid[-1][INVOICE_PRODUCT_COLUMNS['unit_price']] = 0
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    for row in grid:
+        sheet.append(row)
+    workbook.save(path)
+    return path
+
+
+def make_output_template(path):
+    """A stand-in for app/sjt.xlsm: one header row over columns A..S."""
+    workbook = Workbook()
+    sheet = workbook.active
+    for column in range(1, 20):
+        sheet.cell(row=1, column=column, value=f'ستون {column}')
+    workbook.save(path)
+    return path
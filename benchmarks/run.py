@@ -0,0 +1,209 @@
+# benchmarks/run.py
+"""
+Micro-benchmarks of the processing pipeline against an SQLite stand-in.
+
+    python -m benchmarks.run                         # 1k/10k/100k items, compare with baselines.json
+    python -m benchmarks.run --sizes 1000,10000      # a subset of the sizes
+    python -m benchmarks.run --save                  # store the results as the new baseline
+
+Each stage is run --repeat times and the median is reported. A stage is flagged
+as a regression when it is more than --tolerance slower than its baseline (and
+by more than a few milliseconds); the exit status is then 1. Baselines depend on
+the machine, so refresh them with --save when the hardware changes.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import pandas as pd
+
+from app import create_app
+from app.config import Config
+from app.extensions import db
+from app.models import Item, ItemUsageLog, Settings, InvoiceNumberBlock
+from app.invoice_numbers import InvoiceNumberAllocator
+from app.allocation import StockAllocator
+from app.utils import (process_items_excel, iter_items_excel_chunks, bulk_upsert_items, read_invoice_file,
+                       allocate_invoice, process_excel_invoices, generate_sjt_output_excel,
+                       calculate_inventory_values, apply_inventory_delta)
+from benchmarks.generate import make_items_workbook, make_invoice_workbook, invoice_products, make_output_template
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+DEFAULT_SIZES = (1000, 10000, 100000)
+MIN_REGRESSION_SECONDS = 0.005
+
+
+def _median_time(function, repeat, setup=None):
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def _benchmark_config(workdir):
+    class BenchmarkConfig(Config):
+        SECRET_KEY = 'benchmark'
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(workdir, 'benchmark.db')
+        SQLALCHEMY_ENGINE_OPTIONS = {}
+        UPLOAD_FOLDER = workdir
+        LOG_LEVEL = 'WARNING'
+    return BenchmarkConfig
+
+
+def _reset_tables():
+    db.session.query(ItemUsageLog).delete()
+    db.session.query(Item).delete()
+    db.session.query(Settings).delete()
+    db.session.commit()
+
+
+def run_size(size, args, workdir):
+    """Runs every stage for one catalogue size and returns {stage: median_seconds}."""
+    results = {}
+    items_path = make_items_workbook(os.path.join(workdir, f'items_{size}.xlsx'), size, seed=size)
+    invoice_paths = [
+        make_invoice_workbook(os.path.join(workdir, f'invoice_{size}_{number}.xlsx'),
+                              invoice_products(args.invoice_rows, seed=number), seed=number)
+        for number in range(args.invoices)
+    ]
+    app = create_app(_benchmark_config(workdir))
+    template_path = os.path.join(app.root_path, 'sjt.xlsm')
+    if not os.path.exists(template_path):
+        template_path = make_output_template(os.path.join(workdir, 'template.xlsx'))
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        results['items_parse'] = _median_time(lambda: process_items_excel(items_path), args.repeat)
+        results['items_parse_streaming'] = _median_time(
+            lambda: [chunk for chunk in iter_items_excel_chunks(items_path, app.config['ITEMS_STREAMING_CHUNK_SIZE'])],
+            args.repeat,
+        )
+
+        items_df, _ = process_items_excel(items_path)
+
+        def upsert():
+            bulk_upsert_items(db, Item, items_df, chunk_size=app.config['ITEMS_UPSERT_CHUNK_SIZE'])
+            db.session.commit()
+        results['items_upsert'] = _median_time(upsert, args.repeat, setup=_reset_tables)
+
+        results['valuation_reconcile'] = _median_time(lambda: calculate_inventory_values(db, Item, Settings), args.repeat)
+
+        def apply_delta():
+            apply_inventory_delta(db, Item, Settings, (0.0, -1.0, 1.0))
+            db.session.commit()
+        results['valuation_delta'] = _median_time(apply_delta, args.repeat)
+
+        parsed = []
+        results['invoice_parse'] = _median_time(
+            lambda: parsed.__setitem__(slice(None), [read_invoice_file(path) for path in invoice_paths]),
+            args.repeat,
+        )
+
+        results['allocation_snapshot'] = _median_time(lambda: StockAllocator.from_db(db, Item), args.repeat)
+
+        snapshot = []
+
+        def load_snapshot():
+            snapshot[:] = [StockAllocator.from_db(db, Item)]
+
+        def allocate():
+            for number, (header, products, _) in enumerate(parsed):
+                allocate_invoice(header, products, snapshot[0], 1901 + number, 'benchmark.xlsx')
+        results['allocation'] = _median_time(allocate, args.repeat, setup=load_snapshot)
+
+        output_frames = []
+
+        def process_invoices():
+            output_frames.clear()
+            numbers = InvoiceNumberAllocator(db, InvoiceNumberBlock, len(invoice_paths))
+            for path in invoice_paths:
+                output_df, _, _, _ = process_excel_invoices(path, db, Item, ItemUsageLog, numbers)
+                output_frames.append(output_df)
+        results['invoice_end_to_end'] = _median_time(process_invoices, args.repeat)
+
+        output_df = pd.concat(output_frames, ignore_index=True) if output_frames else pd.DataFrame()
+        output_path = os.path.join(workdir, 'output.xlsx')
+        results['output_render'] = _median_time(
+            lambda: generate_sjt_output_excel(output_df, template_path, output_path), args.repeat
+        )
+        db.session.remove()
+        db.engine.dispose()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of (size, stage, baseline_seconds, seconds) regressions."""
+    regressions = []
+    for size, stages in results.items():
+        for stage, seconds in stages.items():
+            reference = baseline.get(size, {}).get(stage)
+            if reference is None:
+                continue
+            if seconds > reference * (1 + tolerance) and seconds - reference > MIN_REGRESSION_SECONDS:
+                regressions.append((size, stage, reference, seconds))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help='comma separated catalogue sizes (number of items)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage; the median is reported')
+    parser.add_argument('--invoices', type=int, default=20, help='invoice files per size')
+    parser.add_argument('--invoice-rows', type=int, default=20, help='product rows per invoice')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown before a stage is flagged')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save', action='store_true', help='write the results as the new baseline')
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='sjt-benchmark-')
+    try:
+        for size in sizes:
+            print(f"== {size} items", flush=True)
+            stages = run_size(size, args, workdir)
+            for stage, seconds in stages.items():
+                print(f"  {stage:<24} {seconds * 1000:10.1f} ms", flush=True)
+            results[str(size)] = stages
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as handle:
+            baseline = json.load(handle).get('results', {})
+
+    regressions = compare(results, baseline, args.tolerance)
+    for size, stage, reference, seconds in regressions:
+        print(f"REGRESSION {size} items / {stage}: {reference * 1000:.1f} ms -> {seconds * 1000:.1f} ms")
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w', encoding='utf-8') as handle:
+            json.dump({
+                'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                            'cpus': os.cpu_count()},
+                'saved_at': datetime.now().isoformat(timespec='seconds'),
+                'repeat': args.repeat, 'invoices': args.invoices, 'invoice_rows': args.invoice_rows,
+                'results': baseline,
+            }, handle, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+    return 1 if regressions and not args.save else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
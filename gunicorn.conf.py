@@ -0,0 +1,31 @@
+# gunicorn.conf.py
+# اجرا: gunicorn -c gunicorn.conf.py wsgi:app
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+# هر worker pool اتصال خودش را دارد (DB_POOL_SIZE + DB_MAX_OVERFLOW)؛ با max_connections مای‌اس‌کیو‌ال هماهنگ شود
+workers = int(os.environ.get('GUNICORN_WORKERS', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+# thread های هر worker درخواست‌های سبک (داشبورد، وضعیت کارها) را هم‌زمان پاسخ می‌دهند
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+# پردازش فاکتورها در پس‌زمینه انجام می‌شود، اما بارگذاری فایل بزرگ کالاها در خود درخواست است
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 300))
+graceful_timeout = 30
+keepalive = 5
+# بازنشستگی دوره‌ای worker ها تا حافظه pandas به مرور انباشته نشود
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = 100
+
+# برنامه یک بار در master ساخته و گرم می‌شود (wsgi.warm_up) و worker ها آن را به ارث می‌برند
+preload_app = True
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    # اتصال‌های دیتابیس master نباید در worker ها مشترک استفاده شوند؛ هر worker pool خودش را می‌سازد
+    from app.extensions import db
+    app = worker.app.wsgi()
+    with app.app_context():
+        db.engine.dispose(close=False)
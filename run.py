@@ -1,3 +1,4 @@
+# سرور توسعه؛ در محیط عملیاتی: gunicorn -c gunicorn.conf.py wsgi:app
 from app import create_app
 
 app = create_app()
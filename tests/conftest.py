@@ -0,0 +1,72 @@
+# tests/conftest.py
+import os
+import random
+import re
+import zipfile
+from datetime import date
+import pytest
+from app import create_app
+from app.config import Config
+from app.extensions import db as _db
+from app.models import Item
+
+
+@pytest.fixture
+def app(tmp_path):
+    class TestConfig(Config):
+        SECRET_KEY = 'test'
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + str(tmp_path / 'test.db')
+        SQLALCHEMY_ENGINE_OPTIONS = {}
+        UPLOAD_FOLDER = str(tmp_path / 'uploads')
+        LOG_LEVEL = 'WARNING'
+        WTF_CSRF_ENABLED = False
+        OUTPUT_WORKERS = 1
+
+    os.makedirs(TestConfig.UPLOAD_FOLDER)
+    app = create_app(TestConfig)
+    with app.app_context():
+        _db.create_all()
+        yield app
+        _db.session.remove()
+        _db.engine.dispose()
+
+
+@pytest.fixture
+def db(app):
+    return _db
+
+
+@pytest.fixture
+def make_items(db):
+    """Inserts count random items (seeded) and returns them."""
+    def make(count, seed=1, max_quantity=20):
+        rng = random.Random(seed)
+        items = []
+        for index in range(count):
+            quantity = rng.randint(1, max_quantity)
+            items.append(Item(
+                product_id=f'P{seed}-{index}', document_date=date(2024, 1, 1), quantity=quantity,
+                remaining_quantity=quantity, unit_price=float(rng.randint(1, 30) * 1000),
+                unit_of_measurement='عدد', product_description=f'کالا {index}',
+            ))
+        db.session.add_all(items)
+        db.session.commit()
+        return items
+    return make
+
+
+@pytest.fixture
+def stale_dimension():
+    """Rewrites a workbook's sheets with a <dimension ref="A1"/> tag, as some writers leave behind."""
+    def rewrite(path):
+        stale_path = path + '.stale.xlsx'
+        with zipfile.ZipFile(path) as source, zipfile.ZipFile(stale_path, 'w', zipfile.ZIP_DEFLATED) as target:
+            for info in source.infolist():
+                data = source.read(info.filename)
+                if info.filename.startswith('xl/worksheets/'):
+                    xml = re.sub(r'<dimension[^>]*/>', '', data.decode())
+                    data = xml.replace('<sheetData', '<dimension ref="A1"/><sheetData', 1).encode()
+                target.writestr(info, data)
+        os.replace(stale_path, path)
+        return path
+    return rewrite
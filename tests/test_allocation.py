@@ -0,0 +1,81 @@
+# tests/test_allocation.py
+import random
+import pytest
+from sqlalchemy import update
+from app.allocation import StockAllocator, StockRow, AllocationConflict, write_allocations
+from app.models import Item
+
+
+def reference_allocation(rows, invoices):
+    """The original per-product query: highest price with enough stock, unused items of the invoice first."""
+    remaining = {row.id: row.remaining_quantity for row in rows}
+    by_price = sorted(rows, key=lambda row: (-row.unit_price, row.id))
+    picks = []
+    for quantities in invoices:
+        used_ids = set()
+        for quantity in quantities:
+            candidates = [row for row in by_price if remaining[row.id] >= quantity]
+            fresh = [row for row in candidates if row.id not in used_ids]
+            chosen = (fresh or candidates or [None])[0]
+            if chosen is None:
+                picks.append(None)
+                continue
+            remaining[chosen.id] -= quantity
+            used_ids.add(chosen.id)
+            picks.append(chosen.id)
+    return picks, remaining
+
+
+def segment_tree_allocation(rows, invoices):
+    allocator = StockAllocator(rows)
+    picks = []
+    for quantities in invoices:
+        allocator.start_invoice()
+        for quantity in quantities:
+            index = allocator.pick(quantity)
+            picks.append(None if index is None else allocator.take(index, quantity).id)
+    remaining = {row.id: row.remaining_quantity - allocator.allocated.get(row.id, 0) for row in rows}
+    return picks, remaining
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_picks_match_reference_algorithm(seed):
+    rng = random.Random(seed)
+    rows = [
+        StockRow(id=index + 1, product_id=f'P{index}', unit_price=float(rng.randint(1, 8)),
+                 remaining_quantity=rng.randint(1, 12), unit_of_measurement='عدد')
+        for index in range(rng.randint(1, 40))
+    ]
+    invoices = [[rng.randint(1, 10) for _ in range(rng.randint(1, 15))] for _ in range(rng.randint(1, 6))]
+    assert segment_tree_allocation(rows, invoices) == reference_allocation(rows, invoices)
+
+
+def test_write_allocations_decrements_stock(db, make_items):
+    items = make_items(5)
+    allocator = StockAllocator.from_db(db, Item)
+    allocator.start_invoice()
+    index = allocator.pick(1)
+    item = allocator.take(index, 1)
+    write_allocations(db, Item, allocator.allocated)
+    db.session.commit()
+    assert db.session.get(Item, item.id).remaining_quantity == next(
+        i.quantity for i in items if i.id == item.id) - 1
+
+
+def test_write_allocations_conflict_leaves_stock_untouched(db, make_items):
+    make_items(5)
+    allocator = StockAllocator.from_db(db, Item)
+    allocator.start_invoice()
+    picked = [allocator.take(allocator.pick(1), 1).id, allocator.take(allocator.pick(1), 1).id]
+    before = {item.id: item.remaining_quantity for item in Item.query}
+
+    # another transaction empties one of the picked items after the snapshot was taken
+    db.session.execute(update(Item).where(Item.id == picked[1]).values(remaining_quantity=0))
+    db.session.commit()
+
+    with pytest.raises(AllocationConflict):
+        write_allocations(db, Item, allocator.allocated)
+    db.session.rollback()
+    after = {item.id: item.remaining_quantity for item in Item.query.populate_existing()}
+    before[picked[1]] = 0
+    assert after == before
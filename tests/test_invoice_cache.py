@@ -0,0 +1,38 @@
+# tests/test_invoice_cache.py
+from openpyxl import load_workbook
+from app import invoice_cache, jalali
+from app.utils import read_invoice_file_cached
+from benchmarks.generate import make_invoice_workbook, invoice_products
+
+
+def undated_invoice(path):
+    make_invoice_workbook(path, invoice_products(3), date=None)
+    # the date cell is the rightmost one the reader needs; a title keeps the layout wide enough without it
+    workbook = load_workbook(path)
+    workbook.active.cell(row=1, column=27, value='صورتحساب')
+    workbook.save(path)
+    return path
+
+
+def test_undated_invoice_is_dated_when_used(app, tmp_path, monkeypatch):
+    path = undated_invoice(str(tmp_path / 'a.xlsx'))
+    content_hash = invoice_cache.file_digest(path)
+
+    monkeypatch.setattr(jalali, 'today', lambda: '1403/05/10')
+    header, products, messages = read_invoice_file_cached(path, content_hash, 'a.xlsx')
+    assert header['date_str'] == '1403/05/10' and messages[0][0] == 'warning'
+
+    monkeypatch.setattr(jalali, 'today', lambda: '1403/05/11')
+    cached_header, cached_products, cached_messages = read_invoice_file_cached(path, content_hash, 'a.xlsx')
+    assert cached_header['date_str'] == '1403/05/11'
+    assert (cached_products, cached_messages) == (products, messages)
+    assert invoice_cache.get_parsed(content_hash, 'a.xlsx')[0]['date_str'] == ''
+
+
+def test_cache_entry_is_per_file_name(app, tmp_path):
+    path = undated_invoice(str(tmp_path / 'a.xlsx'))
+    content_hash = invoice_cache.file_digest(path)
+    read_invoice_file_cached(path, content_hash, 'a.xlsx')
+    assert invoice_cache.get_parsed(content_hash, 'b.xlsx') is None
+    _, _, messages = read_invoice_file_cached(path, content_hash, 'b.xlsx')
+    assert 'b.xlsx' in messages[0][1]
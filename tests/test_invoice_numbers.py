@@ -0,0 +1,40 @@
+# tests/test_invoice_numbers.py
+import pytest
+from app.invoice_numbers import InvoiceNumberAllocator, InvoiceNumberInUse, InvoiceNumbersExhausted, set_start_number
+from app.models import InvoiceNumberBlock, Item, ItemUsageLog
+from app.settings_service import settings_service
+from app.utils import process_excel_invoices
+from benchmarks.generate import make_invoice_workbook, invoice_products
+
+
+def test_start_number_can_not_move_into_a_reserved_block(db):
+    set_start_number(db, InvoiceNumberBlock, 100)
+    db.session.commit()
+    numbers = InvoiceNumberAllocator(db, InvoiceNumberBlock, 5)
+    assert (numbers.first_number, numbers.last_number) == (100, 104)
+
+    with pytest.raises(InvoiceNumberInUse) as error:
+        set_start_number(db, InvoiceNumberBlock, 104)
+    assert error.value.highest_reserved == 104
+    db.session.rollback()
+    assert settings_service.start_invoice_number() == 105
+
+    set_start_number(db, InvoiceNumberBlock, 500)
+    db.session.commit()
+    assert settings_service.start_invoice_number() == 500
+    assert InvoiceNumberAllocator(db, InvoiceNumberBlock, 1).first_number == 500
+
+
+def test_used_up_block_fails_loudly_and_writes_nothing(db, make_items, tmp_path):
+    make_items(50)
+    numbers = InvoiceNumberAllocator(db, InvoiceNumberBlock, 1)
+    first = make_invoice_workbook(str(tmp_path / 'a.xlsx'), invoice_products(2))
+    second = make_invoice_workbook(str(tmp_path / 'b.xlsx'), invoice_products(2, seed=2), seed=2)
+    assert process_excel_invoices(first, db, Item, ItemUsageLog, numbers)[2] == numbers.first_number
+    usage_rows = ItemUsageLog.query.count()
+    stock = {item.id: item.remaining_quantity for item in Item.query.populate_existing()}
+
+    with pytest.raises(InvoiceNumbersExhausted):
+        process_excel_invoices(second, db, Item, ItemUsageLog, numbers)
+    assert ItemUsageLog.query.count() == usage_rows
+    assert {item.id: item.remaining_quantity for item in Item.query.populate_existing()} == stock
@@ -0,0 +1,26 @@
+# tests/test_invoice_reader.py
+import pytest
+from openpyxl import load_workbook
+from app.utils import INVOICE_PRODUCT_COLUMNS, INVOICE_PRODUCT_START_ROW_INDEX, read_invoice_file
+from benchmarks.generate import make_invoice_workbook, invoice_products
+
+
+def test_stale_dimension_tag_is_ignored(tmp_path, stale_dimension):
+    path = make_invoice_workbook(str(tmp_path / 'a.xlsx'), invoice_products(6))
+    expected = read_invoice_file(path)
+    stale_dimension(path)
+    assert load_workbook(path, read_only=True).active.max_row == 1
+    assert read_invoice_file(path) == expected
+    assert len(expected[1]) == 6
+
+
+@pytest.mark.parametrize('price', ['1_000', '۱۲۰۰', '1,000', '0x10', '12\xa0'])
+def test_unit_price_spellings_match_pd_to_numeric(tmp_path, price):
+    path = make_invoice_workbook(str(tmp_path / 'a.xlsx'), invoice_products(2))
+    workbook = load_workbook(path)
+    workbook.active.cell(row=INVOICE_PRODUCT_START_ROW_INDEX + 2,
+                         column=INVOICE_PRODUCT_COLUMNS['unit_price'] + 1, value=price)
+    workbook.save(path)
+    _, products, _ = read_invoice_file(path)
+    # pd.to_numeric rejects the price, which closes the product block after the first row
+    assert len(products) == 1
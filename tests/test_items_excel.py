@@ -0,0 +1,96 @@
+# tests/test_items_excel.py
+import pandas as pd
+import pytest
+from openpyxl import Workbook
+from app.utils import ITEMS_COLUMN_MAPPING, iter_items_excel_chunks, process_items_excel
+from benchmarks.generate import items_rows, make_items_workbook
+
+
+def write_items(path, rows):
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(list(ITEMS_COLUMN_MAPPING))
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+    return path
+
+
+def row(**values):
+    defaults = dict(zip(ITEMS_COLUMN_MAPPING.values(), next(items_rows(1))))
+    defaults.update(values)
+    return [defaults[field] for field in ITEMS_COLUMN_MAPPING.values()]
+
+
+def streamed(path, chunk_size):
+    frames, messages = [], []
+    for items_df, chunk_messages in iter_items_excel_chunks(path, chunk_size):
+        frames.append(items_df)
+        messages.extend(chunk_messages)
+    return pd.concat(frames), messages
+
+
+def assert_same_result(path, chunk_size=4):
+    full_df, full_messages = process_items_excel(path)
+    streamed_df, streamed_messages = streamed(path, chunk_size)
+    pd.testing.assert_frame_equal(full_df, streamed_df, check_dtype=False)
+    assert full_messages == streamed_messages
+    return full_df, full_messages
+
+
+def test_generated_workbook(tmp_path):
+    items_df, messages = assert_same_result(make_items_workbook(str(tmp_path / 'items.xlsx'), 50), chunk_size=7)
+    assert len(items_df) == 50 and messages == []
+
+
+def test_stale_dimension_tag_is_ignored(tmp_path, stale_dimension):
+    path = stale_dimension(make_items_workbook(str(tmp_path / 'items.xlsx'), 50))
+    items_df, messages = assert_same_result(path, chunk_size=7)
+    assert len(items_df) == 50 and messages == []
+
+
+def test_invalid_rows(tmp_path):
+    path = write_items(str(tmp_path / 'items.xlsx'), [
+        row(product_id='A1'),
+        row(product_id='A2', quantity='abc'),
+        row(product_id='A3', unit_price='x'),
+        row(product_id='A4', document_date='1403/13/40'),
+        row(product_id='A5', document_date=None),
+        row(product_id=None),
+        row(product_id='A7', quantity=None, remarks=None),
+        row(product_id='A8', quantity=3.0, unit_price=1500.5),
+    ])
+    items_df, messages = assert_same_result(path)
+    assert list(items_df['product_id']) == ['A1', 'A7', 'A8']
+    assert [category for category, _ in messages] == ['danger', 'danger', 'warning', 'warning']
+
+
+def test_missing_columns(tmp_path):
+    workbook = Workbook()
+    workbook.active.append(['شناسه کالا'])
+    workbook.save(tmp_path / 'items.xlsx')
+    items_df, messages = process_items_excel(str(tmp_path / 'items.xlsx'))
+    assert items_df.empty and messages[0][0] == 'danger'
+    streamed_df, streamed_messages = streamed(str(tmp_path / 'items.xlsx'), 4)
+    assert streamed_df.empty and streamed_messages == messages
+
+
+def test_invalid_number_message_names_column_and_value(tmp_path):
+    path = write_items(str(tmp_path / 'items.xlsx'), [row(product_id='A1', unit_price='12a')])
+    _, messages = process_items_excel(path)
+    assert messages == [('danger', "خطا در پردازش ردیف 2 اکسل: مقدار '12a' در ستون «مبلغ واحد» عدد معتبر نیست.")]
+
+
+@pytest.mark.parametrize('sentinel', ['nan', 'NA', 'N/A', 'NULL', 'None', '#N/A', 'null'])
+def test_na_strings_are_empty_cells_in_both_readers(tmp_path, sentinel):
+    path = write_items(str(tmp_path / 'items.xlsx'), [
+        row(product_id='A1'),
+        row(product_id='A2', quantity=sentinel, remarks=sentinel),
+        row(product_id='A3', unit_price=sentinel),
+        row(product_id='A4', final_amount=sentinel, seller=sentinel),
+        row(product_id=sentinel),
+        row(product_id='A6'),
+    ])
+    items_df, messages = assert_same_result(path, chunk_size=2)
+    assert list(items_df['product_id']) == ['A1', 'A2', 'A3', 'A4', 'A6']
+    assert messages == []
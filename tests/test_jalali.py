@@ -0,0 +1,44 @@
+# tests/test_jalali.py
+from datetime import date, timedelta
+import jdatetime
+import pandas as pd
+from app import jalali
+
+
+def test_round_trip_matches_jdatetime():
+    day = jdatetime.date(1398, 1, 1).togregorian()
+    end = jdatetime.date(1410, 12, 29).togregorian()
+    while day <= end:
+        expected = jdatetime.date.fromgregorian(date=day).strftime('%Y/%m/%d')
+        assert jalali.to_jalali(day) == expected
+        assert jalali.to_gregorian(expected) == day
+        day += timedelta(days=1)
+
+
+def test_leap_year_end():
+    assert jalali.to_gregorian('1403/12/30') == jdatetime.date(1403, 12, 30).togregorian()
+    assert jalali.to_gregorian('1402/12/30') is None
+
+
+def test_accepted_spellings():
+    expected = date(2024, 7, 31)
+    for text in ('1403/05/10', '1403-5-10', '1403.05.10', ' 1403 / 05 / 10 ', '۱۴۰۳/۰۵/۱۰', '١٤٠٣/٠٥/١٠'):
+        assert jalali.to_gregorian(text) == expected
+
+
+def test_invalid_dates():
+    for text in (None, '', 'تاریخ', '1403/13/01', '1403/07/31', '1403/00/10', '1403/05'):
+        assert jalali.to_gregorian(text) is None
+
+
+def test_outside_table_range_uses_jdatetime():
+    assert jalali.to_gregorian('1250/01/01') == jdatetime.date(1250, 1, 1).togregorian()
+    assert jalali.to_jalali(date(2200, 1, 1)) == jdatetime.date.fromgregorian(date=date(2200, 1, 1)).strftime('%Y/%m/%d')
+
+
+def test_series_conversion():
+    values = pd.Series(['1403/05/10', None, 'bad', '1403/05/10'], index=[5, 6, 7, 8])
+    converted = jalali.series_to_gregorian(values)
+    assert list(converted.index) == [5, 6, 7, 8]
+    assert converted.tolist() == [date(2024, 7, 31), None, None, date(2024, 7, 31)]
+    assert jalali.series_to_jalali(pd.Series([date(2024, 7, 31), None])).tolist() == ['1403/05/10', '']
@@ -0,0 +1,159 @@
+# tests/test_jobs.py
+import json
+import os
+import shutil
+from datetime import datetime, timedelta
+import pytest
+from app.jobs import (JOB_DONE, JOB_QUEUED, JOB_RUNNING, JobLeaseLost, claim_next_job, job_folder, renew_lease,
+                      run_invoice_job)
+from app import invoice_cache
+from app.models import InvoiceJob, InvoiceNumberBlock, Item, ItemUsageLog, ProcessedInvoiceFile
+from benchmarks.generate import make_invoice_workbook, make_output_template, invoice_products
+
+
+@pytest.fixture
+def template(app, tmp_path, monkeypatch):
+    """Points the output template (root_path/sjt.xlsm) at a generated stand-in."""
+    root = tmp_path / 'root'
+    root.mkdir()
+    make_output_template(str(root / 'sjt.xlsm'))
+    monkeypatch.setattr(app, 'root_path', str(root))
+    return str(root / 'sjt.xlsm')
+
+
+@pytest.fixture
+def invoice(tmp_path):
+    def make(name, seed=1, count=5):
+        return make_invoice_workbook(str(tmp_path / name), invoice_products(count, seed=seed), seed=seed)
+    return make
+
+
+def queue_job(db, uploads, job_id='job1'):
+    """Queues a job for (path, filename) pairs the way create_invoice_job stores them."""
+    folder = job_folder(job_id)
+    os.makedirs(folder)
+    files = []
+    for index, (path, filename) in enumerate(uploads):
+        stored_name = f'{index:04d}_{filename}'
+        shutil.copyfile(path, os.path.join(folder, stored_name))
+        files.append((stored_name, filename))
+    db.session.add(InvoiceJob(id=job_id, status=JOB_QUEUED, total_files=len(files),
+                              files_json=json.dumps(files, ensure_ascii=False)))
+    db.session.commit()
+    return db.session.get(InvoiceJob, job_id)
+
+
+def run_job(db, uploads, job_id='job1'):
+    queue_job(db, uploads, job_id)
+    run_invoice_job(job_id)
+    return db.session.get(InvoiceJob, job_id)
+
+
+def test_messages_and_registry_use_the_uploaded_name(db, make_items, template, invoice):
+    make_items(50)
+    job = run_job(db, [(invoice('a.xlsx'), 'inv.xlsx')])
+    assert job.status == JOB_DONE and job.result_filename
+    texts = ' '.join(text for _, text in job.messages)
+    assert 'inv.xlsx' in texts and '0000_' not in texts
+    assert ProcessedInvoiceFile.query.one().filename == 'inv.xlsx'
+
+
+def test_registered_file_without_cached_output_is_rendered_again(db, make_items, template, invoice):
+    make_items(50)
+    path = invoice('a.xlsx')
+    os.rename(template, template + '.away')
+    first = run_job(db, [(path, 'a.xlsx')], job_id='job1')
+    assert first.result_filename is None
+    assert any(category == 'warning' and 'خروجی' in text for category, text in first.messages)
+    stock = {item.id: item.remaining_quantity for item in Item.query}
+
+    os.rename(template + '.away', template)
+    second = run_job(db, [(path, 'a.xlsx')], job_id='job2')
+    entry = ProcessedInvoiceFile.query.one()
+    assert second.result_filename and str(entry.invoice_number) in second.result_filename
+    assert {item.id: item.remaining_quantity for item in Item.query.populate_existing()} == stock
+
+
+def test_running_job_is_claimed_only_after_its_lease_expires(db):
+    job = InvoiceJob(id='job1', status=JOB_RUNNING, total_files=0, files_json='[]',
+                     started_at=datetime.utcnow(), heartbeat_at=datetime.utcnow(), lease_owner='dead')
+    db.session.add(job)
+    db.session.commit()
+    assert claim_next_job(60) is None
+
+    job.heartbeat_at = datetime.utcnow() - timedelta(seconds=120)
+    db.session.commit()
+    job_id, lease_owner = claim_next_job(60)
+    assert job_id == 'job1' and lease_owner != 'dead'
+    assert db.session.get(InvoiceJob, 'job1').lease_owner == lease_owner
+    assert claim_next_job(60) is None
+
+
+def test_lost_lease_stops_the_runner(db):
+    queue_job(db, [])
+    job_id, lease_owner = claim_next_job(60)
+    job = db.session.get(InvoiceJob, job_id)
+    db.session.execute(InvoiceJob.__table__.update().values(lease_owner='other'))
+    db.session.commit()
+    with pytest.raises(JobLeaseLost):
+        renew_lease(job, lease_owner)
+    db.session.rollback()
+
+    run_invoice_job(job_id, lease_owner)
+    job = db.session.get(InvoiceJob, job_id)
+    assert job.status == JOB_RUNNING and job.finished_at is None
+    assert os.path.isdir(job_folder(job_id))
+
+
+def test_resumed_job_does_not_allocate_its_files_again(db, make_items, template, invoice):
+    make_items(50)
+    path = invoice('a.xlsx')
+    run_job(db, [(path, 'a.xlsx')])
+    entry = ProcessedInvoiceFile.query.one()
+    usage_rows = ItemUsageLog.query.count()
+
+    # اجراکننده پس از ثبت فایل اول و پیش از پایان کار از بین رفته است
+    job = queue_job(db, [(path, 'a.xlsx'), (invoice('b.xlsx', seed=2), 'b.xlsx')], job_id='job2')
+    entry.job_id = job.id
+    job.status = JOB_RUNNING
+    job.processed_files = 1
+    job.started_at = job.heartbeat_at = datetime.utcnow() - timedelta(seconds=120)
+    db.session.commit()
+
+    run_invoice_job(*claim_next_job(60))
+    job = db.session.get(InvoiceJob, 'job2')
+    assert job.status == JOB_DONE and job.processed_files == 2 and job.result_filename.endswith('.zip')
+    assert ProcessedInvoiceFile.query.count() == 2
+    numbers = {entry.invoice_number for entry in ProcessedInvoiceFile.query}
+    assert ItemUsageLog.query.filter_by(invoice_number_used=str(entry.invoice_number)).count() == usage_rows
+    assert ItemUsageLog.query.count() > usage_rows and len(numbers) == 2
+    texts = ' '.join(text for _, text in job.messages)
+    assert f"شماره فاکتور {entry.invoice_number} ثبت شده بود" in texts
+    assert not os.path.isdir(job_folder('job2'))
+
+
+def test_unreadable_file_is_failed_and_not_allocated_after_takeover(db, make_items, template, invoice, monkeypatch):
+    make_items(50)
+    file_digest = invoice_cache.file_digest
+
+    def digest(path, *args):
+        if path.endswith('_b.xlsx'):
+            raise OSError('unreadable')
+        return file_digest(path, *args)
+
+    monkeypatch.setattr(invoice_cache, 'file_digest', digest)
+    job = queue_job(db, [(invoice('a.xlsx'), 'a.xlsx'), (invoice('b.xlsx', seed=2), 'b.xlsx')])
+    # اجراکننده قبلی پیش از ثبت هیچ فایلی از بین رفته است
+    job.status = JOB_RUNNING
+    job.started_at = job.heartbeat_at = datetime.utcnow() - timedelta(seconds=120)
+    db.session.commit()
+
+    run_invoice_job(*claim_next_job(60))
+    job = db.session.get(InvoiceJob, 'job1')
+    assert job.status == JOB_DONE and job.processed_files == 2
+    assert ('danger', "فایل 'b.xlsx' خوانده نشد و پردازش نشد: unreadable") in job.messages
+    entry = ProcessedInvoiceFile.query.one()
+    assert entry.filename == 'a.xlsx'
+    assert {log.invoice_number_used for log in ItemUsageLog.query} == {str(entry.invoice_number)}
+    block = InvoiceNumberBlock.query.one()
+    assert block.first_number == block.last_number == entry.invoice_number
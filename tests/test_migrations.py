@@ -0,0 +1,70 @@
+# tests/test_migrations.py
+from datetime import date
+from sqlalchemy import create_engine, inspect, text
+from app.extensions import db
+from app.migrations import LATEST_VERSION, applied_versions, upgrade
+import app.models  # noqa: F401  (registers the model tables on db.metadata)
+
+
+def schema(engine):
+    inspector = inspect(engine)
+    result = {}
+    for table_name in inspector.get_table_names():
+        if table_name == 'schema_version':
+            continue
+        result[table_name] = (
+            sorted((column['name'], column['nullable']) for column in inspector.get_columns(table_name)),
+            sorted((index['name'], tuple(index['column_names']), bool(index['unique']))
+                   for index in inspector.get_indexes(table_name)),
+            sorted(tuple(constraint['column_names']) for constraint in inspector.get_unique_constraints(table_name)),
+        )
+    return result
+
+
+def test_migrations_build_the_model_schema(tmp_path):
+    migrated = create_engine('sqlite:///' + str(tmp_path / 'migrated.db'))
+    applied = upgrade(migrated)
+    assert [migration.version for migration in applied] == list(range(1, LATEST_VERSION + 1))
+
+    models = create_engine('sqlite:///' + str(tmp_path / 'models.db'))
+    db.metadata.create_all(models)
+    assert schema(migrated) == schema(models)
+
+
+def test_migrations_on_a_create_all_database_are_no_ops(tmp_path):
+    engine = create_engine('sqlite:///' + str(tmp_path / 'models.db'))
+    db.metadata.create_all(engine)
+    before = schema(engine)
+    upgrade(engine)
+    assert applied_versions(engine) == set(range(1, LATEST_VERSION + 1))
+    assert schema(engine) == before
+    assert upgrade(engine) == []
+
+
+def test_legacy_item_table_gets_remaining_quantity_backfilled(tmp_path):
+    engine = create_engine('sqlite:///' + str(tmp_path / 'legacy.db'))
+    with engine.begin() as conn:
+        # the item table of the old recreate_table.py DDL: no remaining_quantity
+        conn.execute(text(
+            "CREATE TABLE item (id INTEGER PRIMARY KEY, document_number VARCHAR(64), invoice_number_ref VARCHAR(64), "
+            "document_date DATE NOT NULL, seller VARCHAR(128), seller_province VARCHAR(64), activity_type VARCHAR(64), "
+            "origin VARCHAR(64), item_category VARCHAR(64), product_description VARCHAR(256), "
+            "unit_of_measurement VARCHAR(32), quantity INTEGER NOT NULL, unit_price FLOAT NOT NULL, "
+            "final_amount FLOAT, product_id VARCHAR(128) NOT NULL UNIQUE, remarks TEXT)"
+        ))
+        conn.execute(text(
+            "CREATE TABLE item_usage_log (id INTEGER PRIMARY KEY, item_id INTEGER NOT NULL REFERENCES item(id), "
+            "exit_date DATE, invoice_number_used VARCHAR(64) NOT NULL, quantity_used INTEGER NOT NULL, "
+            "price_at_usage FLOAT)"
+        ))
+        conn.execute(text("INSERT INTO item (id, document_date, quantity, unit_price, product_id) "
+                          "VALUES (1, :day, 10, 5.0, 'A'), (2, :day, 4, 2.0, 'B')"),
+                     {'day': date(2024, 1, 1)})
+        conn.execute(text("INSERT INTO item_usage_log VALUES (1, 1, :day, '1901', 3, 5.0), (2, 1, :day, '1902', 2, 5.0)"),
+                     {'day': date(2024, 1, 2)})
+
+    upgrade(engine)
+    with engine.connect() as conn:
+        remaining = dict(conn.execute(text("SELECT product_id, remaining_quantity FROM item")).all())
+    assert remaining == {'A': 5, 'B': 4}
+    assert 'ix_item_remaining_quantity_unit_price' in {index['name'] for index in inspect(engine).get_indexes('item')}
@@ -0,0 +1,27 @@
+# tests/test_preview.py
+from sqlalchemy import event
+from app.models import Item, ProcessedInvoiceFile
+from app.preview import preview_invoice_batch
+from app.settings_service import settings_service
+from benchmarks.generate import make_invoice_workbook, invoice_products
+
+
+def test_registry_is_looked_up_once_per_batch(db, make_items, tmp_path):
+    make_items(50)
+    paths = [make_invoice_workbook(str(tmp_path / f'{index}.xlsx'), invoice_products(3, seed=index), seed=index)
+             for index in range(4)]
+    files = [(path, f'{index}.xlsx') for index, path in enumerate(paths)] + [(paths[0], 'copy.xlsx')]
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if 'FROM processed_invoice_file' in statement:
+            statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        preview = preview_invoice_batch(files, db, Item, settings_service, start_invoice_number=100)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    assert len(statements) == 1
+    assert preview.processed_files == 4 and preview.next_invoice_number == 104
+    assert preview.files[-1].invoice_number is None and ProcessedInvoiceFile.query.count() == 0
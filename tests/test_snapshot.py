@@ -0,0 +1,48 @@
+# tests/test_snapshot.py
+import pyarrow as pa
+import pyarrow.parquet
+import pytest
+from app.invoice_numbers import reserve_block
+from app.models import InvoiceNumberBlock, Item, Settings
+from app.settings_service import settings_service
+from app.snapshot import export_snapshot, import_snapshot, SnapshotError
+
+
+def start_number():
+    return int(Settings.query.filter_by(setting_name='START_INVOICE_NUMBER').one().setting_value)
+
+
+def test_older_snapshot_does_not_move_the_start_number_back(db, make_items, tmp_path):
+    make_items(3)
+    reserve_block(db, InvoiceNumberBlock, 10)
+    export_snapshot(db, str(tmp_path / 'snapshot'))
+    reserve_block(db, InvoiceNumberBlock, 10)
+    current = start_number()
+
+    import_snapshot(db, str(tmp_path / 'snapshot'))
+    assert start_number() == current
+    assert Item.query.count() == 3
+
+
+def test_start_number_above_the_reserved_blocks_is_restored(db, tmp_path):
+    settings_service.set('START_INVOICE_NUMBER', '5000')
+    db.session.commit()
+    export_snapshot(db, str(tmp_path / 'later'))
+    settings_service.set('START_INVOICE_NUMBER', '4000')
+    db.session.commit()
+
+    import_snapshot(db, str(tmp_path / 'later'))
+    assert start_number() == 5000
+
+
+def test_rejected_rows_roll_back_and_raise_snapshot_error(db, make_items, tmp_path):
+    make_items(3)
+    folder = str(tmp_path / 'snapshot')
+    export_snapshot(db, folder, ['item'])
+    path = f'{folder}/item.parquet'
+    items = pa.parquet.read_table(path)
+    pa.parquet.write_table(pa.concat_tables([items, items]), path)
+
+    with pytest.raises(SnapshotError):
+        import_snapshot(db, folder)
+    assert Item.query.count() == 3
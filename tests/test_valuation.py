@@ -0,0 +1,155 @@
+# tests/test_valuation.py
+import pytest
+from sqlalchemy import event, select
+from sqlalchemy.exc import OperationalError
+from app import utils
+from app.invoice_numbers import InvoiceNumberAllocator
+from app.models import Item, ItemUsageLog, Settings, InvoiceNumberBlock
+from app.settings_service import INVENTORY_VALUE_SETTINGS, INVENTORY_VERSION_SETTING
+from app.utils import (apply_inventory_delta, bulk_upsert_items, calculate_inventory_values, get_inventory_values,
+                       process_excel_invoices, process_items_excel, _sum_inventory_values)
+from benchmarks.generate import make_items_workbook, make_invoice_workbook, invoice_products
+
+
+def assert_stored_values_match_table(db):
+    stored = get_inventory_values(Settings)
+    assert stored == pytest.approx(_sum_inventory_values(db, Item))
+
+
+def upload_items(db, path):
+    items_df, _ = process_items_excel(path)
+    _, _, value_delta, _ = bulk_upsert_items(db, Item, items_df)
+    apply_inventory_delta(db, Item, Settings, value_delta)
+    db.session.commit()
+
+
+def test_first_delta_computes_values_from_items(db, make_items):
+    make_items(10)
+    values = apply_inventory_delta(db, Item, Settings, (1.0, 1.0, 1.0))
+    db.session.commit()
+    assert values == pytest.approx(_sum_inventory_values(db, Item))
+    assert_stored_values_match_table(db)
+
+
+def test_deltas_follow_uploads_and_allocations(db, tmp_path):
+    calculate_inventory_values(db, Item, Settings)
+    upload_items(db, make_items_workbook(str(tmp_path / 'items1.xlsx'), 200, seed=1))
+    assert_stored_values_match_table(db)
+
+    # the same product ids again: quantities are added to existing items
+    upload_items(db, make_items_workbook(str(tmp_path / 'items2.xlsx'), 100, seed=1))
+    assert_stored_values_match_table(db)
+
+    numbers = InvoiceNumberAllocator(db, InvoiceNumberBlock, 3)
+    for number in range(3):
+        path = make_invoice_workbook(str(tmp_path / f'invoice{number}.xlsx'), invoice_products(10, seed=number),
+                                     seed=number)
+        output_df, _, invoice_number, _ = process_excel_invoices(path, db, Item, ItemUsageLog, numbers)
+        assert invoice_number is not None and not output_df.empty
+    numbers.close()
+    assert_stored_values_match_table(db)
+
+    stored = get_inventory_values(Settings)
+    assert calculate_inventory_values(db, Item, Settings) == pytest.approx(stored)
+
+
+@pytest.mark.parametrize('write', [
+    lambda db: calculate_inventory_values(db, Item, Settings),
+    lambda db: apply_inventory_delta(db, Item, Settings, (1.0, 1.0, 1.0)) and db.session.commit(),
+], ids=['reconcile', 'delta'])
+def test_value_rows_are_written_before_the_version_row(db, make_items, write):
+    make_items(5)
+    calculate_inventory_values(db, Item, Settings)
+    # مقدار ذخیره‌شده تغییر داده می‌شود تا بازمحاسبه هم ردیف‌های ارز را بنویسد
+    Settings.query.filter_by(setting_name=INVENTORY_VALUE_SETTINGS[0]).one().setting_value = '0'
+    db.session.commit()
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('UPDATE settings'):
+            statements.append('version' if INVENTORY_VERSION_SETTING in str(parameters) else 'value')
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        write(db)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    assert statements and statements[-1] == 'version' and statements.count('version') == 1
+
+
+def test_reconcile_aborts_on_a_database_error(app, db, make_items, monkeypatch):
+    make_items(5)
+    calculate_inventory_values(db, Item, Settings)
+    stored = get_inventory_values(Settings)
+
+    def fail(db, Item):
+        raise OperationalError('SELECT sum(...)', {}, Exception('database is locked'))
+
+    monkeypatch.setattr(utils, '_sum_inventory_values', fail)
+    result = app.test_cli_runner().invoke(args=['reconcile-inventory'])
+    assert result.exit_code != 0 and 'Reconcile aborted' in result.output
+    assert get_inventory_values(Settings) == stored
+
+
+def allocate_elsewhere(db, item_id, unit_price, quantity=1):
+    """Commits an allocation of quantity units of an item on another connection, as a concurrent upload would."""
+    table = Item.__table__
+    allocated_value = unit_price * quantity
+    with db.engine.begin() as other:
+        other.execute(table.update().where(table.c.id == item_id)
+                      .values(remaining_quantity=table.c.remaining_quantity - quantity))
+        for name, change in zip(INVENTORY_VALUE_SETTINGS, (0.0, -allocated_value, allocated_value)):
+            value = other.execute(select(Settings.setting_value).where(Settings.setting_name == name)).scalar()
+            other.execute(Settings.__table__.update().where(Settings.setting_name == name)
+                          .values(setting_value=str(float(value) + change)))
+
+
+def test_allocation_committed_while_reconcile_waits_for_the_lock_is_counted(db, make_items):
+    items = make_items(5)
+    calculate_inventory_values(db, Item, Settings)
+    item = items[0]
+    locked = []
+
+    def allocate_when_values_are_locked(conn, cursor, statement, parameters, context, executemany):
+        # تخصیص دیگری درست پیش از گرفته شدن قفل ردیف‌های ارز ثبت می‌شود
+        if locked or not statement.startswith('SELECT') or 'FROM settings' not in statement:
+            return
+        locked.append(True)
+        allocate_elsewhere(db, item.id, item.unit_price)
+
+    event.listen(db.engine, 'before_cursor_execute', allocate_when_values_are_locked)
+    try:
+        calculate_inventory_values(db, Item, Settings)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', allocate_when_values_are_locked)
+    assert locked
+    assert_stored_values_match_table(db)
+
+
+def test_item_edit_counts_an_allocation_committed_after_the_item_was_loaded(app, db, make_items):
+    app.config['LOGIN_DISABLED'] = True
+    item = make_items(3)[0]
+    calculate_inventory_values(db, Item, Settings)
+    form = {
+        'document_number': '1', 'document_date': '2024-01-01', 'product_id': item.product_id,
+        'quantity': str(item.quantity + 5), 'unit_price': str(item.unit_price),
+    }
+    item_id, unit_price = item.id, item.unit_price
+    # کالا باید در خود درخواست بارگذاری شود، نه از identity map نشست آزمون
+    db.session.expunge_all()
+    statements = []
+
+    def allocate_after_item_is_loaded(conn, cursor, statement, parameters, context, executemany):
+        # تخصیص دیگری پس از بارگذاری کالا برای فرم و پیش از عبارت بعدی همین درخواست ثبت می‌شود
+        statements.append(statement)
+        if len(statements) == 2:
+            allocate_elsewhere(db, item_id, unit_price)
+
+    event.listen(db.engine, 'before_cursor_execute', allocate_after_item_is_loaded)
+    try:
+        response = app.test_client().post(f'/item/edit/{item_id}', data=form)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', allocate_after_item_is_loaded)
+    assert response.status_code == 302 and 'FROM item' in statements[0]
+    db.session.expire_all()
+    assert_stored_values_match_table(db)
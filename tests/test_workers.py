@@ -0,0 +1,20 @@
+# tests/test_workers.py
+from concurrent.futures import CancelledError, Future
+from app.workers import output_result
+
+
+def test_output_result_reports_any_failure():
+    future = Future()
+    future.set_exception(TypeError("cannot pickle '_thread.lock' object"))
+    assert output_result(future) == (None, "cannot pickle '_thread.lock' object")
+
+    cancelled = Future()
+    cancelled.cancel()
+    path, error = output_result(cancelled)
+    assert path is None and error == CancelledError.__name__
+
+
+def test_output_result_passes_render_result(app):
+    future = Future()
+    future.set_result((('/tmp/out.xlsm', None), 0.1))
+    assert output_result(future) == ('/tmp/out.xlsm', None)
@@ -0,0 +1,25 @@
+# wsgi.py
+"""
+Production entry point:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+With preload_app (see gunicorn.conf.py) this module is imported once in the
+gunicorn master: the application is created and warmed up there and the forked
+workers share it, so the first requests of every worker don't pay for imports
+and template compilation. run.py remains the development server.
+"""
+from app import create_app
+
+
+def warm_up(app):
+    """Compiles every template and builds the lookup tables used by invoice processing."""
+    # ماژول‌های پردازش (pandas، openpyxl و ...) با import شدن blueprint ها بارگذاری شده‌اند
+    from app import jalali, preview, exports  # noqa: F401
+    jalali._tables()
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+
+
+app = create_app()
+warm_up(app)